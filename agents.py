@@ -1,5 +1,6 @@
 from collections import namedtuple
-from contextlib import contextmanager
+from contextlib import ExitStack, contextmanager
+from typing import List
 
 import torch
 from gym.spaces import Box, Discrete
@@ -289,3 +290,84 @@ class MLPBase(NNBase):
         hidden_actor = self.actor(x)
 
         return self.critic_linear(hidden_critic), hidden_actor, rnn_hxs
+
+
+class AgentStack(nn.Module):
+    """
+    Independently initialized agents side by side: agent `s` acts on the `s`th of
+    equal, consecutive slices of the envs. Torch 1.4 has no `vmap`, so the agents run
+    one after another on their slices.
+    """
+
+    def __init__(self, agents: List[nn.Module]):
+        super().__init__()
+        self.agents = nn.ModuleList(agents)
+
+    @contextmanager
+    def evaluating(self, *args, **kwargs):
+        with ExitStack() as stack:
+            for agent in self.agents:
+                stack.enter_context(agent.evaluating(*args, **kwargs))
+            yield self
+
+    def forward(self, inputs, rnn_hxs, masks, action=None, **kwargs):
+        num_seeds = len(self.agents)
+        actions = [None] * num_seeds if action is None else action.chunk(num_seeds)
+        slices = inputs.chunk(num_seeds)
+        outputs = [
+            agent(inputs=i, rnn_hxs=h, masks=m, action=a, **kwargs)
+            for agent, i, h, m, a in zip(
+                self.agents,
+                slices,
+                rnn_hxs.chunk(num_seeds),
+                masks.chunk(num_seeds),
+                actions,
+            )
+        ]
+        return AgentOutputs(
+            value=torch.cat([o.value for o in outputs]),
+            action=torch.cat([o.action for o in outputs]),
+            action_log_probs=torch.cat([o.action_log_probs for o in outputs]),
+            aux_loss=sum(o.aux_loss for o in outputs),
+            rnn_hxs=torch.cat([o.rnn_hxs for o in outputs]),
+            log=self.stack_logs([o.log for o in outputs], slices),
+            dist=None,
+        )
+
+    @staticmethod
+    def stack_logs(logs: List[dict], slices: List[torch.Tensor]) -> dict:
+        # the entries with a row per env (e.g. P), in env order; not per-seed means
+        def per_env(values):
+            return all(
+                torch.is_tensor(v) and v.dim() and len(v) == len(i)
+                for v, i in zip(values, slices)
+            )
+
+        stacked = {}
+        for k in logs[0]:
+            values = [log.get(k) for log in logs]
+            if per_env(values):
+                stacked[k] = torch.cat(values)
+        return stacked
+
+    def get_value(self, inputs, rnn_hxs, masks):
+        return self.forward(inputs, rnn_hxs, masks).value
+
+    @property
+    def is_recurrent(self):
+        return self.agents[0].is_recurrent
+
+    @property
+    def recurrent_hidden_state_size(self):
+        return self.agents[0].recurrent_hidden_state_size
+
+
+def quantized(agent: nn.Module) -> nn.Module:
+    """
+    An int8 copy of `agent` for acting, with dynamically quantized Linear (and, where
+    torch supports it, GRU) layers. Quantized layers hold packed weights, so refresh
+    the copy by calling this again rather than with `load_state_dict`.
+    """
+    return torch.quantization.quantize_dynamic(
+        agent, {nn.Linear, nn.GRU}, dtype=torch.qint8
+    )
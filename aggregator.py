@@ -2,10 +2,22 @@ import time
 from abc import ABC, abstractmethod
 from collections import defaultdict, Counter
 from dataclasses import dataclass, field
-from typing import Collection, Generator, Tuple, Dict, Optional
+from typing import (
+    Callable,
+    Collection,
+    Generator,
+    Iterable,
+    Tuple,
+    Dict,
+    Optional,
+    Sequence,
+    Union,
+)
 
 import numpy as np
 
+from env_worker import InfoBatch
+
 
 class Aggregator(ABC):
     def update(self, *args, **kwargs):
@@ -21,8 +33,8 @@ class Timer:
         self.total = 0
         self.last_tick = time.time()
 
-    def update(self):
-        self.count += 1
+    def update(self, n: float = 1):
+        self.count += n
         tick = time.time()
         self.total = self.total + tick - self.last_tick
         self.last_tick = tick
@@ -64,56 +76,150 @@ class AverageTimeKeeper(TimeKeeper):
 
 
 class EpisodeAggregator(Aggregator):
+    """
+    Keeps a running sum per env and registered key in a (num_envs, num_keys) array.
+    When an episode ends, its sums are folded into per-key totals and counts, so
+    memory and per-step cost do not grow with episode length.
+    """
+
     def __init__(self):
-        self.complete_episodes = defaultdict(list)
-        self.incomplete_episodes = defaultdict(list)
-
-    def update(self, dones: Collection[bool], **values):
-        values.update({"time steps": [1 for _ in dones]})
-        for k, vs in values.items():
-            incomplete_episodes = self.incomplete_episodes[k]
-            if not incomplete_episodes:
-                incomplete_episodes = self.incomplete_episodes[k] = [[] for _ in vs]
-            assert len(incomplete_episodes) == len(vs) == len(dones)
-            for i, (value, done) in enumerate(zip(vs, dones)):
-                incomplete_episodes[i].append(value)
-                if done:
-                    self.complete_episodes[k].append(sum(incomplete_episodes[i]))
-                    incomplete_episodes[i] = []
+        self.keys = {}  # type: Dict[str, int]
+        self.sums = np.zeros((0, 0))
+        self.seen = np.zeros((0, 0), dtype=bool)
+        self.totals = np.zeros(0)
+        self.counts = np.zeros(0, dtype=np.int64)
+
+    def accumulate(
+        self,
+        columns: np.ndarray,
+        values: np.ndarray,
+        present: np.ndarray,
+        dones: np.ndarray,
+    ):
+        self.sums[:, columns] += np.where(present, values, 0)
+        self.seen[:, columns] |= present
+        if dones.any():
+            complete = self.seen[dones]
+            self.totals += np.where(complete, self.sums[dones], 0).sum(0)
+            self.counts += complete.sum(0)
+            self.sums[dones] = 0
+            self.seen[dones] = False
 
     def items(self) -> Generator[Tuple[str, any], None, None]:
-        for k, v in self.complete_episodes.items():
-            yield k, np.mean(v)
+        for k, j in self.keys.items():
+            if self.counts[j]:
+                yield k, self.totals[j] / self.counts[j]
+
+    def merge(self, summary: Dict[str, Tuple[float, int]]):
+        columns = self.register(summary, num_envs=len(self.sums))
+        for j, (total, count) in zip(columns, summary.values()):
+            self.totals[j] += total
+            self.counts[j] += count
+
+    def register(self, keys: Iterable[str], num_envs: int) -> np.ndarray:
+        if len(self.sums) != num_envs:
+            assert not len(self.sums), (len(self.sums), num_envs)
+            self.sums = np.zeros((num_envs, len(self.keys)))
+            self.seen = np.zeros((num_envs, len(self.keys)), dtype=bool)
+        keys = list(keys)
+        new = [k for k in keys if k not in self.keys]
+        if new:
+            for k in new:
+                self.keys[k] = len(self.keys)
+            self.sums = np.pad(self.sums, ((0, 0), (0, len(new))))
+            self.seen = np.pad(self.seen, ((0, 0), (0, len(new))))
+            self.totals = np.pad(self.totals, (0, len(new)))
+            self.counts = np.pad(self.counts, (0, len(new)))
+        return np.array([self.keys[k] for k in keys], dtype=np.int64)
 
     def reset(self):
-        self.complete_episodes = defaultdict(list)
+        self.totals[:] = 0
+        self.counts[:] = 0
+
+    def summary(self) -> Dict[str, Tuple[float, int]]:
+        return {
+            k: (self.totals[j], self.counts[j])
+            for k, j in self.keys.items()
+            if self.counts[j]
+        }
+
+    def update(
+        self, dones: Collection[bool], mask: Optional[np.ndarray] = None, **values
+    ):
+        """
+        `mask` marks the envs that stepped, when only some did.
+        """
+        dones = np.asarray(dones, dtype=bool).reshape(-1)
+        values.update({"time steps": np.ones(len(dones))})
+        columns = self.register(values, num_envs=len(dones))
+        values = np.stack(
+            [np.asarray(v, dtype=np.float64).reshape(-1) for v in values.values()],
+            axis=1,
+        )
+        present = np.ones_like(values, dtype=bool)
+        if mask is not None:
+            present &= mask[:, None]
+            dones = dones & mask
+        self.accumulate(columns, values, present, dones)
 
 
 class InfosAggregator(EpisodeAggregator):
-    def update(self, *infos: dict, dones: Collection[bool]):
-        assert len(dones) == len(infos)
-        for i, (done, info) in enumerate(zip(dones, infos)):
-            self.log_info(i, done, info, len(infos))
-
-    def log_info(self, i, done, info, n):
-        for k, v in info.items():
-            if k == "terminal_observation":
-                continue
-            incomplete_episodes = self.incomplete_episodes[k]
-            if not incomplete_episodes:
-                incomplete_episodes = self.incomplete_episodes[k] = [
-                    [] for _ in range(n)
-                ]
-            incomplete_episodes[i].append(v)
-            if done:
-                self.complete_episodes[k].append(sum(incomplete_episodes[i]))
-                incomplete_episodes[i] = []
+    def update(
+        self,
+        infos: Union[Sequence[dict], InfoBatch],
+        dones: Collection[bool],
+        mask: Optional[np.ndarray] = None,
+    ):
+        dones = np.asarray(dones, dtype=bool).reshape(-1)
+        if mask is not None:
+            dones = dones & mask
+        if isinstance(infos, InfoBatch):
+            assert len(infos.values) == len(dones)
+            columns = self.register(infos.keys, num_envs=len(dones))
+            present = ~np.isnan(infos.values)
+            if mask is not None:
+                present &= mask[:, None]
+            self.accumulate(columns, infos.values, present, dones)
+            return
+        assert len(infos) == len(dones)
+        keys = {}
+        for info in infos:
+            for k in info:
+                if k != "terminal_observation":
+                    keys.setdefault(k, len(keys))
+        values = np.zeros((len(infos), len(keys)))
+        present = np.zeros((len(infos), len(keys)), dtype=bool)
+        for i, info in enumerate(infos):
+            for k, v in info.items():
+                j = keys.get(k)
+                if j is not None:
+                    values[i, j] = v
+                    present[i, j] = True
+        columns = self.register(keys, num_envs=len(infos))
+        self.accumulate(columns, values, present, dones)
 
 
 class EvalAggregator(Aggregator, ABC):
+    """
+    Only counts the first episode of each env.
+    """
+
     def __init__(self):
         super().__init__()
-        self.complete = set()
+        self.complete = None  # type: Optional[np.ndarray]
+
+    def accumulate(
+        self,
+        columns: np.ndarray,
+        values: np.ndarray,
+        present: np.ndarray,
+        dones: np.ndarray,
+    ):
+        if self.complete is None:
+            self.complete = np.zeros_like(dones)
+        active = ~self.complete
+        super().accumulate(columns, values, present & active[:, None], dones & active)
+        self.complete |= dones
 
     def items(self) -> Generator[Tuple[str, any], None, None]:
         for k, v in super().items():
@@ -121,30 +227,50 @@ class EvalAggregator(Aggregator, ABC):
 
 
 class EvalEpisodeAggregator(EvalAggregator, EpisodeAggregator):
-    def update(self, dones: Collection[bool], **values):
-        values.update({"time steps": [1 for _ in dones]})
-        for k, vs in values.items():
-            incomplete_episodes = self.incomplete_episodes[k]
-            if not incomplete_episodes:
-                incomplete_episodes = self.incomplete_episodes[k] = [[] for _ in vs]
-            assert len(incomplete_episodes) == len(vs) == len(dones)
-            for i, (value, done) in enumerate(zip(vs, dones)):
-                if i in self.complete:
-                    continue
-                if done:
-                    self.complete.add(i)
-                incomplete_episodes[i].append(value)
-                if done:
-                    self.complete_episodes[k].append(sum(incomplete_episodes[i]))
-                    incomplete_episodes[i] = []
+    pass
 
 
 class EvalInfosAggregator(EvalAggregator, InfosAggregator):
-    def update(self, *infos: dict, dones: Collection[bool]):
-        assert len(dones) == len(infos)
-        for i, (done, info) in enumerate(zip(dones, infos)):
-            if i in self.complete:
-                continue
-            if done:
-                self.complete.add(i)
-            self.log_info(i, done, info, len(infos))
+    pass
+
+
+class SeedAggregator(Aggregator):
+    """
+    Splits every update into `num_seeds` equal, consecutive slices of the envs (see
+    `agents.AgentStack`) and aggregates each slice separately.
+    """
+
+    def __init__(self, build: Callable[[], EpisodeAggregator], num_seeds: int):
+        self.aggregators = [build() for _ in range(num_seeds)]
+
+    def items(self) -> Generator[Tuple[str, any], None, None]:
+        for s, aggregator in enumerate(self.aggregators):
+            for k, v in aggregator.items():
+                yield f"seed {s}/{k}", v
+
+    def reset(self):
+        for aggregator in self.aggregators:
+            aggregator.reset()
+
+    def split(self, x):
+        n = len(self.aggregators)
+        if x is None:
+            return [None] * n
+        if isinstance(x, InfoBatch):
+            return [InfoBatch(x.keys, v) for v in np.split(x.values, n)]
+        if isinstance(x, (list, tuple)):
+            size = len(x) // n
+            return [x[i * size : (i + 1) * size] for i in range(n)]
+        return np.split(np.asarray(x), n)
+
+    def update(self, *args, **kwargs):
+        args = [self.split(x) for x in args]
+        kwargs = {k: self.split(v) for k, v in kwargs.items()}
+        for s, aggregator in enumerate(self.aggregators):
+            aggregator.update(
+                *[x[s] for x in args], **{k: v[s] for k, v in kwargs.items()}
+            )
+
+
+def per_seed(build: Callable[[], EpisodeAggregator], num_seeds: int) -> Aggregator:
+    return build() if num_seeds == 1 else SeedAggregator(build, num_seeds)
@@ -7,88 +7,76 @@ import numpy as np
 from enum import Enum, auto
 from typing import Dict, Tuple, Generator, Optional, Iterable, List
 from tqdm import tqdm  # type: ignore
-import zipfile
-from lengths import L
+from lengths import L, match
+import store
 import csv
 
 
 def analyze_P(
-    instruction: np.ndarray, P: np.ndarray, start, stop
-) -> Generator[int, None, None]:
-    def line_type_generator():
-        yield from instruction[:, 0]
-
-    def go_to(it, val):
-        for j, i in enumerate(it):
-            if val == i:
-                return j
-
-    num_steps = None
-    line_type_iterator = line_type_generator()
-    while True:
-        i = go_to(line_type_iterator, start)
-        if i is None:
-            break
-        half = len(P) - 1
-        ex = np.arange(len(P[i])) @ P[i] - half
-        delta = go_to(line_type_iterator, stop)
-        if delta is not None:
-            yield delta, ex
+    episodes: store.Store, i: np.ndarray, rows: np.ndarray
+) -> np.ndarray:
+    """
+    `np.arange(len(P[row])) @ P[row] - (len(P) - 1)` for each episode in `i` and
+    its row of P in `rows`, as one (len(i), edges) array, without building the
+    matrices: the rows are gathered from the store's raveled Ps and weighted sums
+    are taken with one `bincount`.
+    """
+    shapes = episodes.P_shapes[i]
+    num_rows, size = shapes[:, 0], shapes[:, 1:].prod(axis=1)
+    # the gather below would silently read the next episode's P
+    assert (rows < num_rows).all(), "a row index is past the end of its episode's P"
+    num_edges = shapes[:, 2:].prod(axis=1)  # 1 if each row of P is a vector
+    assert (num_edges == num_edges[:1]).all(), "P has a varying number of edges"
+    num_edges = int(num_edges[0]) if len(num_edges) else 1
+    pair = np.repeat(np.arange(len(i)), size)
+    offset = np.arange(size.sum()) - np.repeat(np.cumsum(size) - size, size)
+    values = episodes.Ps[np.repeat(episodes.P_offsets[i] + rows * size, size) + offset]
+    sums = np.bincount(
+        pair * num_edges + offset % num_edges,
+        weights=values * (offset // num_edges),
+        minlength=len(i) * num_edges,
+    ).reshape(len(i), num_edges)
+    half = num_rows - 1
+    return sums - half[:, None]
 
 
 def generate_offsets(
-    instruction_paths: Iterable[Path],
-    P_paths: Iterable[Path],
-    success_paths: Iterable[Path],
-    pairs: Iterable[Tuple[L, L]],
+    episodes: store.Store, pairs: Iterable[Tuple[L, L]]
 ) -> Generator[Tuple[str, List[int]], None, None]:
+    types = episodes.padded()[:, :, 0]
     for start, stop in pairs:
-        for instruction_path, P_path, success_path in tqdm(
-            list(zip(instruction_paths, P_paths, success_paths))
+        i, start_position, stop_position = match(types, start, stop)
+        # P is indexed by the lines from the previous stop, not from the start of
+        # the instruction, as it always has been
+        rows = start_position.copy()
+        same = i[1:] == i[:-1]
+        rows[1:][same] = start_position[1:][same] - stop_position[:-1][same] - 1
+        found = stop_position >= 0
+        i, start_position, stop_position, rows = (
+            i[found],
+            start_position[found],
+            stop_position[found],
+            rows[found],
+        )
+        expected = analyze_P(episodes, i, rows)
+        for success, episode, delta, x in zip(
+            episodes.successes[i],
+            episodes.episode(i),
+            stop_position - start_position - 1,
+            expected,
         ):
-            try:
-                instructions = np.load(instruction_path)
-                Ps = np.load(P_path)
-                successes = np.load(success_path)
-            except zipfile.BadZipFile as e:
-                print(e)
-                continue
-            assert len(instructions) == len(Ps)
-            for i, (instruction, P, success) in enumerate(
-                zip(instructions.values(), Ps.values(), successes)
-            ):
-                # if not P.shape[:2] == (1, 1):
-                # import ipdb
-
-                # ipdb.set_trace()
-                for d, x in analyze_P(
-                    instruction, np.squeeze(P, axis=(0,)), start, stop
-                ):
-                    yield (success, L(start).name, L(stop).name, i, d, *x)
+            yield (success, L(start).name, L(stop).name, episode, delta, *x)
 
 
 def main(root: Path, path: Path, out: Path, evaluation: bool, **kwargs) -> None:
-    def get_paths(filename):
-        if evaluation:
-            filename = "eval_" + filename
-        return Path(root, path).glob("**/" + filename)
-
-    instruction_paths = list(get_paths("instruction.npz"))
-    success_paths = list(get_paths("successes.npy"))
-    P_paths = list(get_paths("P.npz"))
-    assert len(instruction_paths) == len(P_paths)
-    assert len(instruction_paths) == len(success_paths)
+    episodes = store.load(root, path, evaluation=evaluation)
+    assert episodes.Ps is not None, "Some runs have no P.npz."
     with out.open("w") as f:
         writer = csv.writer(f)
         writer.writerow(
             ["success", "start", "end", "episode", "length", "learned edge"]
         )
-        for row in generate_offsets(
-            instruction_paths=instruction_paths,
-            P_paths=P_paths,
-            success_paths=success_paths,
-            **kwargs
-        ):
+        for row in generate_offsets(episodes=episodes, **kwargs):
             print(row)
             writer.writerow(row)
     # names, lists = zip(
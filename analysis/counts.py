@@ -8,7 +8,7 @@ import numpy as np
 from enum import Enum, auto
 from typing import Dict, Tuple, Generator, Optional, Iterable, List
 from tqdm import tqdm  # type: ignore
-import zipfile
+import store
 
 
 class L(Enum):
@@ -27,8 +27,15 @@ class L(Enum):
         return i == self.value
 
 
-def count(instruction: np.ndarray, line_type: L) -> Generator[int, None, None]:
-    return int(np.sum(line_type == instruction[:, 0]))
+def count(types: np.ndarray, line_types: Iterable[L]) -> np.ndarray:
+    """
+    Number of lines of each of `line_types` in each row of `types` (line types,
+    padded with -1), as an (episodes, line types) array.
+    """
+    return np.stack(
+        [np.sum(types == L(line_type).value, axis=1) for line_type in line_types],
+        axis=1,
+    ).reshape(len(types), -1)
 
 
 def measure_length(instruction: np.ndarray, start, stop) -> Generator[int, None, None]:
@@ -53,22 +60,14 @@ def measure_length(instruction: np.ndarray, start, stop) -> Generator[int, None,
 
 
 def generate_counts(
-    instruction_paths: Iterable[Path],
-    success_paths: Iterable[Path],
+    episodes: store.Store,
     line_types: Iterable[L],
     # pairs: Iterable[Tuple[L, L]],
 ) -> Generator[Tuple[str, List[int]], None, None]:
-    for instruction_path, success_path in tqdm(zip(instruction_paths, success_paths)):
-        try:
-            instructions = np.load(instruction_path)
-            successes = np.load(success_path)
-        except zipfile.BadZipFile:
-            continue
-        assert len(instructions) == len(successes)
-        for instruction, success in zip(instructions.values(), successes):
-            yield [success, len(instruction)] + [
-                count(instruction, line_type) for line_type in line_types
-            ]
+    counts = count(episodes.padded()[:, :, 0], line_types)
+    lengths = np.diff(episodes.offsets)
+    for success, length, row in zip(episodes.successes, lengths, counts.tolist()):
+        yield [success, length] + row
 
     # for start, stop in pairs:
     # name = f"{start.name}-{stop.name} length"
@@ -92,24 +91,13 @@ def generate_counts(
 def main(
     root: Path, path: Path, training: bool, out: Path, line_types: Iterable[L], **kwargs
 ) -> None:
-    instruction_filename = "instruction.npz"
-    success_filename = "successes.npy"
-    if not training:
-        instruction_filename = "eval_" + instruction_filename
-        success_filename = "eval_" + success_filename
-    instruction_paths = list(Path(root, path).glob("**/" + instruction_filename))
-    success_paths = list(Path(root, path).glob("**/" + success_filename))
+    episodes = store.load(root, path, evaluation=not training)
     with out.open("w") as f:
         writer = csv.writer(f)
         header = ["success", "instruction length"] + [L(l).name for l in line_types]
         writer.writerow(header)
         print(header)
-        for row in generate_counts(
-            instruction_paths=instruction_paths,
-            success_paths=success_paths,
-            line_types=line_types,
-            **kwargs,
-        ):
+        for row in generate_counts(episodes=episodes, line_types=line_types, **kwargs):
             print(row)
             writer.writerow(row)
 
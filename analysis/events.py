@@ -0,0 +1,261 @@
+"""
+Reads scalars from TensorFlow event files without TensorFlow.
+
+An event file is a sequence of TFRecords (length, masked CRC-32C of the length,
+an `Event` protobuf, masked CRC-32C of the data). `index` parses the records with
+`struct` and a minimal protobuf decoder, and keeps what it found in a persistent
+index: the byte offset up to which the file was read and, for each scalar tag, its
+steps, wall times and values. Queries load the index and read only the bytes that
+were appended since (e.g. by a run that is still training). CRCs are only checked
+with `verify=True`.
+
+    scalars = read(Path(".runs/logdir/my-sweep").glob("**/events*"), cache)
+    for path, tags in scalars.items():
+        rewards = tags["rewards"]  # Scalars(step, wall_time, value)
+"""
+import hashlib
+import os
+import struct
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Dict, Generator, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+Scalars = namedtuple("Scalars", "step wall_time value")
+
+# TensorProto dtypes
+DT_FLOAT = 1
+DT_DOUBLE = 2
+
+
+def crc32c_table() -> List[int]:
+    table = []
+    for i in range(256):
+        crc = i
+        for _ in range(8):
+            crc = (crc >> 1) ^ (0x82F63B78 if crc & 1 else 0)
+        table.append(crc)
+    return table
+
+
+CRC32C_TABLE = crc32c_table()
+
+
+def masked_crc32c(data: memoryview) -> int:
+    crc = 0xFFFFFFFF
+    for byte in bytes(data):
+        crc = CRC32C_TABLE[(crc ^ byte) & 0xFF] ^ (crc >> 8)
+    crc ^= 0xFFFFFFFF
+    return (((crc >> 15) | (crc << 17)) + 0xA282EAD8) & 0xFFFFFFFF
+
+
+def varint(data: memoryview, pos: int) -> Tuple[int, int]:
+    result = shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        result |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            return result, pos
+        shift += 7
+
+
+def fields(data: memoryview) -> Generator[Tuple[int, int, object], None, None]:
+    """
+    Field number, wire type and value of each field of a protobuf message: an int
+    for varints and a memoryview of the bytes otherwise.
+    """
+    pos = 0
+    while pos < len(data):
+        key, pos = varint(data, pos)
+        number, wire_type = key >> 3, key & 7
+        if wire_type == 0:
+            value, pos = varint(data, pos)
+        elif wire_type == 1:
+            value, pos = data[pos : pos + 8], pos + 8
+        elif wire_type == 2:
+            length, pos = varint(data, pos)
+            value, pos = data[pos : pos + length], pos + length
+        elif wire_type == 5:
+            value, pos = data[pos : pos + 4], pos + 4
+        else:
+            raise ValueError(f"Unsupported wire type {wire_type}")
+        yield number, wire_type, value
+
+
+def tensor_value(data: memoryview) -> Optional[float]:
+    # the first element of a float or double TensorProto (as tf.summary.scalar writes)
+    dtype, value = None, None
+    for number, wire_type, x in fields(data):
+        if number == 1:
+            dtype = x
+        elif number == 4 and len(x):  # tensor_content
+            value = x
+        elif number in (5, 6) and len(x):  # float_val, double_val
+            fmt = "<f" if number == 5 else "<d"
+            return struct.unpack_from(fmt, x)[0]
+    if value is None or dtype not in (DT_FLOAT, DT_DOUBLE):
+        return None
+    values = np.frombuffer(value, np.float32 if dtype == DT_FLOAT else np.float64)
+    return float(values[0])
+
+
+def scalars(event: memoryview) -> Generator[Tuple[str, int, float, float], None, None]:
+    """
+    Tag, step, wall time and value of each scalar in an `Event`.
+    """
+    wall_time, step, summary = 0.0, 0, None
+    for number, wire_type, x in fields(event):
+        if number == 1 and wire_type == 1:
+            wall_time = struct.unpack("<d", x)[0]
+        elif number == 2 and wire_type == 0:
+            step = x
+        elif number == 5 and wire_type == 2:
+            summary = x
+    if summary is None:
+        return
+    for number, _, value_message in fields(summary):
+        if number != 1:
+            continue
+        tag = value = None
+        for n, wire_type, x in fields(value_message):
+            if n == 1:
+                tag = bytes(x).decode()
+            elif n == 2 and wire_type == 5:  # simple_value
+                value = struct.unpack("<f", x)[0]
+            elif n == 8:  # tensor
+                value = tensor_value(x)
+        if tag is not None and value is not None:
+            yield tag, step, wall_time, value
+
+
+def records(
+    data: memoryview, verify: bool
+) -> Generator[Tuple[int, memoryview], None, None]:
+    """
+    End offset and data of each complete record in `data`. Stops at a truncated
+    record (e.g. one that is still being written) or, with `verify`, at a corrupt one.
+    """
+    pos = 0
+    while pos + 12 <= len(data):
+        (length,) = struct.unpack_from("<Q", data, pos)
+        end = pos + 12 + length + 4
+        if end > len(data):
+            return
+        if verify:
+            (length_crc,) = struct.unpack_from("<I", data, pos + 8)
+            (data_crc,) = struct.unpack_from("<I", data, end - 4)
+            if length_crc != masked_crc32c(data[pos : pos + 8]) or (
+                data_crc != masked_crc32c(data[pos + 12 : end - 4])
+            ):
+                print(f"Corrupt record at byte {pos}")
+                return
+        yield end, data[pos + 12 : end - 4]
+        pos = end
+
+
+def index_path(event_path: Path, cache: Path) -> Path:
+    key = hashlib.md5(str(event_path.resolve()).encode()).hexdigest()
+    return Path(cache, key + ".npz")
+
+
+def load_index(path: Path) -> Tuple[int, Dict[str, Scalars]]:
+    if not path.exists():
+        return 0, {}
+    with np.load(path) as index:
+        tags = {
+            str(tag): Scalars(*(index[f"{i}/{k}"] for k in Scalars._fields))
+            for i, tag in enumerate(index["tags"])
+        }
+        return int(index["offset"]), tags
+
+
+def save_index(path: Path, offset: int, tags: Dict[str, Scalars]):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    arrays = dict(offset=np.array(offset), tags=np.array(list(tags), dtype=str))
+    for i, columns in enumerate(tags.values()):
+        arrays.update({f"{i}/{k}": v for k, v in columns._asdict().items()})
+    temporary = path.with_suffix(f".{os.getpid()}.tmp")
+    with temporary.open("wb") as f:
+        np.savez(f, **arrays)
+    os.replace(temporary, path)  # readers never see a partial index
+
+
+def index(event_path: Path, cache: Path, verify: bool = False) -> Dict[str, Scalars]:
+    """
+    Every scalar in `event_path`, by tag, reading only the bytes after those that
+    the index in `cache` already covers.
+    """
+    path = index_path(event_path, cache)
+    offset, tags = load_index(path)
+    size = event_path.stat().st_size
+    if size < offset:  # rewritten
+        offset, tags = 0, {}
+    if size == offset:
+        return tags
+    with event_path.open("rb") as f:
+        f.seek(offset)
+        data = memoryview(f.read())
+    new = {}  # type: Dict[str, Tuple[list, list, list]]
+    read_to = 0
+    for end, event in records(data, verify):
+        try:
+            found = list(scalars(event))
+        except (IndexError, ValueError, struct.error):
+            print("Data loss in", event_path)
+            break
+        for tag, step, wall_time, value in found:
+            columns = new.setdefault(tag, ([], [], []))
+            for column, x in zip(columns, (step, wall_time, value)):
+                column.append(x)
+        read_to = end
+    for tag, (step, wall_time, value) in new.items():
+        appended = Scalars(
+            np.array(step, dtype=np.int64),
+            np.array(wall_time, dtype=np.float64),
+            np.array(value, dtype=np.float64),
+        )
+        if tag in tags:
+            appended = Scalars(*map(np.concatenate, zip(tags[tag], appended)))
+        tags[tag] = appended
+    if read_to:
+        save_index(path, offset + read_to, tags)
+    return tags
+
+
+def read(
+    event_paths: Iterable[Path],
+    cache: Path,
+    verify: bool = False,
+    processes: Optional[int] = None,
+) -> Dict[Path, Dict[str, Scalars]]:
+    """
+    `index` of each of `event_paths`, in a process pool.
+    """
+    event_paths = list(event_paths)
+    with ProcessPoolExecutor(processes or os.cpu_count()) as executor:
+        futures = [executor.submit(index, p, cache, verify) for p in event_paths]
+        return {p: f.result() for p, f in zip(event_paths, futures)}
+
+
+def smoothed(
+    scalars: Scalars,
+    smoothing: int,
+    until_step: Optional[int] = None,
+    until_time: Optional[float] = None,
+) -> Optional[float]:
+    """
+    Mean of the last `smoothing` values up to `until_step` and `until_time` seconds
+    after the first value, or None if there are none.
+    """
+    keep = np.ones(len(scalars.value), dtype=bool)
+    if until_step is not None:
+        keep &= scalars.step <= until_step
+    if until_time is not None and len(scalars.wall_time):
+        keep &= scalars.wall_time - scalars.wall_time[0] <= until_time
+    values = scalars.value[keep][-smoothing:]
+    if not len(values):
+        return None
+    return float(values.mean())
@@ -1,6 +1,7 @@
 #! /usr/bin/env python
 import argparse
 import csv
+import itertools
 from pathlib import Path
 import torch
 import torch.nn.functional as F
@@ -8,7 +9,7 @@ import numpy as np
 from enum import Enum, auto
 from typing import Dict, Tuple, Generator, Optional, Iterable, List
 from tqdm import tqdm  # type: ignore
-import zipfile
+import store
 
 
 class L(Enum):
@@ -27,30 +28,43 @@ class L(Enum):
         return i == self.value
 
 
-def measure_length(instruction: np.ndarray, start, stop) -> Generator[int, None, None]:
-    def line_type_generator():
-        yield from instruction[:, 0]
-
-    def go_to_stop(it):
-        for j, i in enumerate(it):
-            if stop == i:
-                return j
-
-    def go_to_start(it):
-        for i in it:
-            if start == i:
-                return True
-        return False
-
-    num_steps = None
-    line_type_iterator = line_type_generator()
-    while go_to_start(line_type_iterator):
-        yield go_to_stop(line_type_iterator)
+def match(
+    types: np.ndarray, start, stop
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Scans each row of `types` (line types, padded with -1) for a `start` line, then
+    the next `stop` line, then the next `start` line after that, and so on. Returns
+    the row, start position and stop position of each start found, in order; the
+    stop position is -1 where the row ends first.
+    """
+    start, stop = L(start).value, L(stop).value
+    num_lines = types.shape[1]
+    position = np.arange(num_lines)
+    is_start = types == start
+    is_stop = types == stop
+    # first stop after each position
+    next_stop = np.where(is_stop, position, num_lines)[:, ::-1]
+    next_stop = np.minimum.accumulate(next_stop, axis=1)[:, ::-1]
+    next_stop = np.concatenate(
+        [next_stop[:, 1:], np.full((len(types), 1), num_lines)], axis=1
+    )
+    if start == stop:
+        # starts and stops alternate
+        rank = np.cumsum(is_start, axis=1) - 1
+        selected = is_start & (rank % 2 == 0)
+    else:
+        # a start is found if it is the first since the last stop
+        last_stop = np.maximum.accumulate(np.where(is_stop, position, -1), axis=1)
+        starts = np.cumsum(is_start, axis=1)
+        before = np.take_along_axis(starts, np.maximum(last_stop, 0), axis=1)
+        selected = is_start & (starts - np.where(last_stop < 0, 0, before) == 1)
+    row, start_position = np.nonzero(selected)
+    stop_position = next_stop[row, start_position]
+    return row, start_position, np.where(stop_position < num_lines, stop_position, -1)
 
 
 def generate_lengths(
-    instruction_paths: Iterable[Path],
-    success_paths: Iterable[Path],
+    episodes: store.Store,
     line_types: Iterable[L],
     pairs: Iterable[Tuple[L, L]],
 ) -> Generator[Tuple[str, List[int]], None, None]:
@@ -66,30 +80,26 @@ def generate_lengths(
     # count(instruction, line_type) for line_type in line_types
     # ]
 
+    types = episodes.padded()[:, :, 0]
+    lengths = np.diff(episodes.offsets)
     for start, stop in pairs:
-        for instruction_path, success_path in tqdm(
-            zip(instruction_paths, success_paths)
-        ):
-            try:
-                instructions = np.load(instruction_path)
-                successes = np.load(success_path)
-            except zipfile.BadZipFile:
-                continue
-            assert len(instructions) == len(successes)
-            for i, (instruction, success) in enumerate(
-                zip(instructions.values(), successes)
-            ):
-                # yield from measure_length(instruction, start, stop)
-                for length in measure_length(instruction, start, stop):
-                    if length is not None:
-                        yield (
-                            success,
-                            len(instruction),
-                            L(start).name,
-                            L(stop).name,
-                            i,
-                            length,
-                        )
+        i, start_position, stop_position = match(types, start, stop)
+        found = stop_position >= 0
+        i, start_position, stop_position = (
+            i[found],
+            start_position[found],
+            stop_position[found],
+        )
+        # lines strictly between the start and the stop
+        block_lengths = stop_position - start_position - 1
+        yield from zip(
+            episodes.successes[i],
+            lengths[i],
+            itertools.repeat(L(start).name),
+            itertools.repeat(L(stop).name),
+            episodes.episode(i),
+            block_lengths,
+        )
 
         # yield name, list(iterator())
 
@@ -97,24 +107,13 @@ def generate_lengths(
 def main(
     root: Path, path: Path, training: bool, out: Path, line_types: Iterable[L], **kwargs
 ) -> None:
-    instruction_filename = "instruction.npz"
-    success_filename = "successes.npy"
-    if not training:
-        instruction_filename = "eval_" + instruction_filename
-        success_filename = "eval_" + success_filename
-    instruction_paths = list(Path(root, path).glob("**/" + instruction_filename))
-    success_paths = list(Path(root, path).glob("**/" + success_filename))
+    episodes = store.load(root, path, evaluation=not training)
     with out.open("w") as f:
         writer = csv.writer(f)
         writer.writerow(
             ["success", "instruction length", "start", "end", "episode", "block length"]
         )
-        for row in generate_lengths(
-            instruction_paths=instruction_paths,
-            success_paths=success_paths,
-            line_types=line_types,
-            **kwargs,
-        ):
+        for row in generate_lengths(episodes=episodes, line_types=line_types, **kwargs):
             print(row)
             writer.writerow(row)
 
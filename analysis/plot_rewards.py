@@ -2,18 +2,18 @@
 
 # stdlib
 import argparse
-from collections import Counter, deque
-import itertools
+from collections import Counter
 from pathlib import Path
 from typing import List
 
 # third party
-from tensorflow.python.framework.errors_impl import DataLossError
-import tensorflow.compat.v1.train
 import matplotlib.pyplot as plt
 import pandas as pd
 import seaborn as sns
 
+# first party
+import events
+
 
 def cli():
     parser = argparse.ArgumentParser(
@@ -27,41 +27,28 @@ def cli():
     parser.add_argument("--fname", type=str, default="plot")
     parser.add_argument("--quality", type=int)
     parser.add_argument("--dpi", type=int, default=256)
+    parser.add_argument("--verify", action="store_true", help="check record CRCs")
     main(**vars(parser.parse_args()))
 
 
 def main(
-    path: Path, tag: str, smoothing: int, until_time: int, until_step: int, **kwargs
+    path: Path,
+    tag: str,
+    smoothing: int,
+    until_time: int,
+    until_step: int,
+    verify: bool,
+    **kwargs
 ):
-    def get_value_from_path(event_path):
-        values = deque(maxlen=smoothing)
-        max_line = int(event_path.parts[-3])
-
-        def get_value_from_event(event):
-            for value in event.summary.value:
-                if value.tag == tag:
-                    values.append(value.simple_value)
-
-        iterator = tensorflow.compat.v1.train.summary_iterator(str(event_path))
-        for _ in itertools.count():
-            try:
-                event = next(iterator)
-                start_time = event.wall_time
-                get_value_from_event(event)
-                if until_time is not None and event.wall_time - start_time > until_time:
-                    return sum(values) / smoothing
-                if until_step is not None and event.step > until_step:
-                    return sum(values) / smoothing
-            except DataLossError:
-                print("Data loss in", path)
-            except StopIteration:
-                if len(values) > 0:
-                    return sum(values) / len(values)
-
+    scalars = events.read(
+        path.glob("**/events*"), cache=Path(path, ".event-index"), verify=verify
+    )
     counter = Counter({"max line": [], "reward": []})
-    for event_path in path.glob("**/events*"):
+    for event_path, tags in scalars.items():
         max_line = int(event_path.parts[-3])
-        reward = get_value_from_path(event_path)
+        reward = None
+        if tag in tags:
+            reward = events.smoothed(tags[tag], smoothing, until_step, until_time)
         if reward is not None:
             counter.update({"max line": [max_line], "reward": [reward]})
 
@@ -0,0 +1,231 @@
+"""
+Consolidates the `instruction.npz`, `successes.npy` and `P.npz` files of many runs
+into one memory-mapped, columnar store, so that analyses do not re-read and
+re-decompress every run each time they are invoked.
+
+Each run directory is converted in a process pool into a cached part (plain `.npy`
+columns) that is rebuilt only when the mtime or size of one of its files changes.
+The parts are then concatenated into the store, which is rebuilt only when the set
+of parts changes. Episodes are concatenated along the first axis and indexed with
+offsets:
+
+    store = load(Path(".runs/logdir"), Path("my-sweep"), evaluation=True)
+    for i in range(len(store)):
+        instruction, success = store.instruction(i), store.successes[i]
+"""
+import hashlib
+import json
+import os
+import zipfile
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from tqdm import tqdm  # type: ignore
+
+FILENAMES = ("instruction.npz", "successes.npy", "P.npz")
+# columns of a part and of the store; `P` only if every run has a P.npz
+COLUMNS = ("instructions", "offsets", "successes", "Ps", "P_offsets", "P_shapes")
+MANIFEST_NAME = "manifest.json"
+
+
+class Store(
+    namedtuple(
+        "Store",
+        "instructions offsets successes Ps P_offsets P_shapes run_offsets run_dirs",
+    )
+):
+    """
+    `instructions` holds the (line type, value) rows of every episode, episode `i`
+    spanning `offsets[i]` to `offsets[i + 1]`. `Ps` holds every episode's P
+    (squeezed, as in `analyze_P`) raveled; see `P`. Run `r` (`run_dirs[r]`) has
+    episodes `run_offsets[r]` to `run_offsets[r + 1]`.
+    """
+
+    def __len__(self) -> int:
+        return len(self.successes)
+
+    def episode(self, i):
+        """
+        Index of episode `i` (or of each of an array of episodes) within its run's
+        files.
+        """
+        run = np.searchsorted(self.run_offsets, i, side="right") - 1
+        return i - self.run_offsets[run]
+
+    def instruction(self, i: int) -> np.ndarray:
+        return self.instructions[self.offsets[i] : self.offsets[i + 1]]
+
+    def padded(self, fill: int = -1) -> np.ndarray:
+        """
+        Every instruction as one (episodes, lines, 2) array, padded with `fill` (not
+        a line type) after each episode's last line.
+        """
+        lengths = np.diff(self.offsets)
+        padded = np.full(
+            (len(self), lengths.max(initial=0), 2),
+            fill,
+            dtype=np.result_type(self.instructions, fill),
+        )
+        padded[np.arange(padded.shape[1]) < lengths[:, None]] = self.instructions
+        return padded
+
+    def P(self, i: int) -> np.ndarray:
+        P = self.Ps[self.P_offsets[i] : self.P_offsets[i + 1]]
+        return P.reshape(self.P_shapes[i])
+
+
+def stamp(run_dir: Path, prefix: str) -> Dict[str, Tuple[int, int]]:
+    # mtime and size of each of the run's files
+    stamps = {}
+    for name in FILENAMES:
+        path = Path(run_dir, prefix + name)
+        if path.exists():
+            stat = path.stat()
+            stamps[name] = (stat.st_mtime_ns, stat.st_size)
+    return stamps
+
+
+def part_dir(cache: Path, run_dir: Path, prefix: str) -> Path:
+    key = hashlib.md5(f"{run_dir.resolve()}:{prefix}".encode()).hexdigest()
+    return Path(cache, "parts", key)
+
+
+def consolidate(run_dir: Path, prefix: str, cache: Path) -> Optional[Path]:
+    """
+    Writes the columns of one run to its part, unless the part is up to date.
+    Returns None if the run's files cannot be read.
+    """
+    part = part_dir(cache, run_dir, prefix)
+    stamps = stamp(run_dir, prefix)
+    stamp_path = Path(part, "stamp.json")
+    if stamp_path.exists():
+        with stamp_path.open() as f:
+            if json.load(f) == json.loads(json.dumps(stamps)):
+                return part
+    try:
+        instructions = list(np.load(Path(run_dir, prefix + "instruction.npz")).values())
+        successes = np.load(Path(run_dir, prefix + "successes.npy"))
+        Ps = None
+        if "P.npz" in stamps:
+            Ps = [
+                np.squeeze(P, axis=(0,))
+                for P in np.load(Path(run_dir, prefix + "P.npz")).values()
+            ]
+    except (zipfile.BadZipFile, OSError, ValueError) as e:
+        print(f"Skipping {run_dir}: {e}")
+        return None
+    assert len(instructions) == len(successes), run_dir
+
+    columns = dict(
+        instructions=np.zeros((0, 2), dtype=np.int64),
+        offsets=np.cumsum([0] + [len(i) for i in instructions]),
+        successes=successes,
+    )
+    if instructions:
+        columns.update(instructions=np.concatenate(instructions))
+    if Ps is not None:
+        assert len(Ps) == len(instructions), run_dir
+        columns.update(
+            Ps=np.zeros(0, dtype=np.float32),
+            P_offsets=np.cumsum([0] + [P.size for P in Ps]),
+            P_shapes=np.zeros((0, 2), dtype=np.int64),
+        )
+        if Ps:
+            columns.update(
+                Ps=np.concatenate([P.ravel() for P in Ps]),
+                P_shapes=np.array([P.shape for P in Ps], dtype=np.int64),
+            )
+    part.mkdir(parents=True, exist_ok=True)
+    for stale in part.glob("*"):
+        stale.unlink()
+    for k, v in columns.items():
+        np.save(Path(part, k + ".npy"), v)
+    with stamp_path.open("w") as f:  # last, so that partial parts are rebuilt
+        json.dump(stamps, f)
+    return part
+
+
+def concatenate(parts: List[Path], store_dir: Path, columns: List[str]):
+    # writes each column through a memory map, one part at a time
+    for k in columns:
+        arrays = [np.load(Path(part, k + ".npy"), mmap_mode="r") for part in parts]
+        offset_column = k in ("offsets", "P_offsets")
+        shape = list(arrays[0].shape)
+        shape[0] = sum(len(a) - offset_column for a in arrays) + offset_column
+        out = np.lib.format.open_memmap(
+            Path(store_dir, k + ".npy"),
+            mode="w+",
+            dtype=np.result_type(*arrays),
+            shape=tuple(shape),
+        )
+        start = base = 0
+        for a in arrays:
+            if offset_column:
+                # per-part offsets start at 0; shift them past the previous parts
+                out[start : start + len(a)] = a + base
+                base += a[-1]
+                start += len(a) - 1
+            else:
+                out[start : start + len(a)] = a
+                start += len(a)
+        out.flush()
+        del out
+
+
+def load(
+    root: Path,
+    path: Path,
+    evaluation: bool,
+    cache: Optional[Path] = None,
+    processes: Optional[int] = None,
+) -> Store:
+    """
+    Loads every run under `root/path` that has an `instruction.npz` (with the "eval_"
+    prefix if `evaluation`) from the store in `cache` (by default
+    `root/.cache/path`), updating it first if any run changed.
+    """
+    prefix = "eval_" if evaluation else ""
+    cache = Path(root, ".cache", path) if cache is None else cache
+    run_dirs = sorted(
+        p.parent for p in Path(root, path).glob("**/" + prefix + "instruction.npz")
+    )
+    with ProcessPoolExecutor(processes or os.cpu_count()) as executor:
+        futures = [
+            executor.submit(consolidate, run_dir, prefix, cache) for run_dir in run_dirs
+        ]
+        parts = [f.result() for f in tqdm(futures, desc="Scanning runs")]
+    readable = [(r, p) for r, p in zip(run_dirs, parts) if p is not None]
+    if not readable:
+        raise FileNotFoundError(f"No readable runs under {Path(root, path)}")
+    run_dirs, parts = zip(*readable)
+    has_P = all(Path(part, "Ps.npy").exists() for part in parts)
+    columns = [c for c in COLUMNS if has_P or not c.startswith("P")]
+
+    store_dir = Path(cache, prefix + "store")
+    manifest = dict(
+        columns=columns,
+        parts={
+            str(part): Path(part, "stamp.json").read_text() for part in parts
+        },
+    )
+    manifest_path = Path(store_dir, MANIFEST_NAME)
+    if not manifest_path.exists() or json.loads(manifest_path.read_text()) != manifest:
+        store_dir.mkdir(parents=True, exist_ok=True)
+        if manifest_path.exists():
+            manifest_path.unlink()  # until the columns are complete again
+        concatenate(list(parts), store_dir, columns)
+        manifest_path.write_text(json.dumps(manifest))
+
+    arrays = {
+        k: np.load(Path(store_dir, k + ".npy"), mmap_mode="r") if k in columns else None
+        for k in COLUMNS
+    }
+    lengths = [len(np.load(Path(p, "successes.npy"), mmap_mode="r")) for p in parts]
+    return Store(
+        **arrays,
+        run_offsets=np.cumsum([0] + lengths),
+        run_dirs=list(run_dirs),
+    )
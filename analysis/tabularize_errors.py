@@ -2,14 +2,12 @@
 
 # stdlib
 import argparse
-from collections import deque, defaultdict
-import itertools
+from collections import defaultdict
 from pathlib import Path
 from typing import List
 
-# third party
-from tensorflow.python.framework.errors_impl import DataLossError
-import tensorflow.compat.v1.train
+# first party
+import events
 
 
 def cli():
@@ -25,6 +23,7 @@ def cli():
     parser.add_argument("--quality", type=int)
     parser.add_argument("--dpi", type=int, default=256)
     parser.add_argument("--print-tag", action="store_true")
+    parser.add_argument("--verify", action="store_true", help="check record CRCs")
     main(**vars(parser.parse_args()))
 
 
@@ -45,35 +44,24 @@ def main(
     until_time: int,
     until_step: int,
     print_tag: bool,
+    verify: bool,
     **kwargs
 ):
-    def get_values_from_path(event_path):
-        values = defaultdict(lambda: deque(maxlen=smoothing))
-        iterator = tensorflow.compat.v1.train.summary_iterator(str(event_path))
-        for _ in itertools.count():
-            try:
-                event = next(iterator)
-                start_time = event.wall_time
-                for value in event.summary.value:
-                    if value.tag in tags:
-                        values[value.tag].append(value.simple_value)
-                if until_time is not None and event.wall_time - start_time > until_time:
-                    return values
-                if until_step is not None and event.step > until_step:
-                    return values
-            except DataLossError:
-                print("Data loss in", path)
-            except StopIteration:
-                return values
-
     def avg(x):
         return sum(x) / len(x)
 
+    scalars = events.read(
+        path.glob("**/events*"), cache=Path(path, ".event-index"), verify=verify
+    )
     value_dict = defaultdict(list)
-    for event_path in path.glob("**/events*"):
-        for tag, values in get_values_from_path(event_path).items():
-            if len(values) > 0:
-                value_dict[tag].append(avg(values))
+    for event_path, path_tags in scalars.items():
+        for tag in tags:
+            if tag in path_tags:
+                value = events.smoothed(
+                    path_tags[tag], smoothing, until_step, until_time
+                )
+                if value is not None:
+                    value_dict[tag].append(value)
 
     for tag, values in value_dict.items():
         if print_tag:
@@ -0,0 +1,251 @@
+#! /usr/bin/env python
+"""
+Finds the fastest `num_processes`, `train_steps`, `num_batch`, `synchronous` and
+`ppo_epoch` for this machine by successive halving: every configuration trains for
+a few updates, the fastest 1/`--eta` (by frames per second) train again for `--eta`
+times as many frames, and so on until one is left. Trials run one at a time on all
+cores, without evaluation, and are killed if they exceed `--max-memory` or
+`--timeout`. Run from the repository root:
+
+    python autotune.py
+    python autotune.py num_processes=50,100,200 ppo_epoch=5 --max-memory 16000
+
+Each trial logs to `<output>/<rung>-<index>/` and `<output>/trials.jsonl` gets one
+line per trial. The winner is written to `<output>/overrides.yaml` in the format of
+Hydra's `.hydra/overrides.yaml`, e.g. for
+
+    python ours.py $(sed -n 's/^- //p' <output>/overrides.yaml)
+"""
+import argparse
+import itertools
+import json
+import os
+import signal
+import sys
+import time
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import yaml
+
+from benchmarks.common import metadata
+from config import BaseConfig
+from local_sweep import grid, launch
+from metrics import METRICS_NAME
+from planner import available_cores
+
+RESULTS_NAME = "trials.jsonl"
+OVERRIDES_NAME = "overrides.yaml"
+SPACE = [
+    "num_processes=25,50,100,200",
+    "train_steps=25,50",
+    "num_batch=1,2",
+    "synchronous=true,false",
+    "ppo_epoch=3,5",
+]
+
+
+def available_memory() -> Optional[float]:
+    # MB, or None where /proc is not available
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) / 2 ** 10
+    except OSError:
+        pass
+    return None
+
+
+def descendants(pid: int) -> List[int]:
+    """
+    `pid` and the processes it started (e.g. its env workers), recursively.
+    """
+    pids = [pid]
+    for task in Path(f"/proc/{pid}/task").glob("*"):
+        try:
+            children = Path(task, "children").read_text().split()
+        except OSError:
+            continue
+        for child in children:
+            pids.extend(descendants(int(child)))
+    return pids
+
+
+def resident_memory(pids: List[int]) -> float:
+    # MB, summed over `pids`; shared pages count once per process
+    rss = 0
+    for pid in pids:
+        try:
+            with open(f"/proc/{pid}/statm") as f:
+                rss += int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2 ** 20
+        except (OSError, ValueError):
+            pass
+    return rss
+
+
+def trial(
+    program: str,
+    params: Dict[str, str],
+    num_frames: int,
+    run_dir: Path,
+    max_memory: Optional[float],
+    timeout: float,
+    poll_interval: float,
+) -> dict:
+    """
+    Trains with `params` for `num_frames` frames and measures frames per second
+    between the first and last reports, the average update time and the peak memory
+    of the run.
+    """
+    params = dict(params, eval="no", num_frames=num_frames)
+    process = launch(program, params, run_dir, available_cores())
+    start = time.time()
+    peak_memory = 0.0
+    status = None
+    while process.poll() is None:
+        time.sleep(poll_interval)
+        pids = descendants(process.pid)
+        peak_memory = max(peak_memory, resident_memory(pids))
+        if max_memory is not None and peak_memory > max_memory:
+            status = "out of memory"
+        elif time.time() - start > timeout:
+            status = "timed out"
+        if status is not None:
+            for pid in pids:
+                try:
+                    os.kill(pid, signal.SIGKILL)
+                except ProcessLookupError:
+                    pass
+            process.wait()
+    seconds = time.time() - start
+    if status is None and process.returncode:
+        status = f"exited with code {process.returncode}"
+
+    reports = []
+    path = Path(run_dir, METRICS_NAME)
+    if path.exists():
+        with path.open() as f:
+            reports = [json.loads(line) for line in f]
+    fps = None
+    if status is None and len(reports) > 1:
+        # Each report's frames already count the iteration that is about to be
+        # collected (the last one only saves), so the difference between the first
+        # and last reports is what was collected between them.
+        first, last = reports[0], reports[-1]
+        elapsed = last["wall time"] - first["wall time"]
+        fps = (last["frames"] - first["frames"]) / max(elapsed, 1e-6)
+    return dict(
+        num_frames=num_frames,
+        status=status or "ok",
+        seconds=seconds,
+        frames_per_second=fps,
+        time_per_update=reports[-1].get("time per update") if reports else None,
+        peak_memory=peak_memory,
+    )
+
+
+def main(
+    eta: int,
+    max_memory: Optional[float],
+    min_frames: int,
+    min_updates: int,
+    output: Path,
+    overrides: List[str],
+    poll_interval: float,
+    program: str,
+    timeout: float,
+):
+    space = {o.split("=", 1)[0]: o for o in SPACE}
+    space.update({o.split("=", 1)[0]: o for o in overrides})
+    configs = grid(list(space.values()))
+    max_memory = max_memory or available_memory()
+    output.mkdir(parents=True, exist_ok=True)
+    with Path(output, "metadata.json").open("w") as f:
+        json.dump(metadata(), f, indent=2)
+    print(f"Tuning {len(configs)} configurations, logging to {output}")
+
+    ranked = []
+    num_frames = min_frames
+    with Path(output, RESULTS_NAME).open("a") as results:
+        for rung in itertools.count():
+            trials = []
+            for index, params in enumerate(configs):
+                num_processes = int(
+                    params.get("num_processes", BaseConfig.num_processes)
+                )
+                train_steps = int(params.get("train_steps", BaseConfig.train_steps))
+                # every trial gets a few updates, however large they are (the
+                # iteration that reaches num_frames only saves)
+                frames = max(
+                    num_frames, (min_updates + 1) * num_processes * train_steps
+                )
+                record = trial(
+                    program=program,
+                    params=params,
+                    num_frames=frames,
+                    run_dir=Path(output, f"{rung}-{index}"),
+                    max_memory=max_memory,
+                    timeout=timeout,
+                    poll_interval=poll_interval,
+                )
+                record.update(rung=rung, params=params)
+                results.write(json.dumps(record) + "\n")
+                results.flush()
+                print(
+                    f"Rung {rung}, trial {index}: {record['status']}, "
+                    f"{record['frames_per_second'] or 0:.1f} frames/s, {params}"
+                )
+                if record["frames_per_second"] is not None:
+                    trials.append(record)
+            ranked = sorted(trials, key=lambda r: -r["frames_per_second"])
+            configs = [r["params"] for r in ranked[: max(len(ranked) // eta, 1)]]
+            if len(configs) <= 1:
+                break
+            num_frames *= eta
+
+    if not ranked:
+        print("Every trial failed. See the output.log of each trial.")
+        return 1
+    best = ranked[0]
+    with Path(output, OVERRIDES_NAME).open("w") as f:
+        yaml.safe_dump([f"{k}={v}" for k, v in best["params"].items()], f)
+    print(
+        f"Best: {best['frames_per_second']:.1f} frames/s, "
+        f"{best['time_per_update']} s per update with {best['params']}. "
+        f"Wrote {Path(output, OVERRIDES_NAME)}"
+    )
+    return 0
+
+
+if __name__ == "__main__":
+    PARSER = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    PARSER.add_argument(
+        "overrides",
+        nargs="*",
+        help="Hydra overrides, with comma-separated values, that replace the "
+        "default search space of each key they set",
+    )
+    PARSER.add_argument(
+        "--eta", type=int, default=3, help="keep the fastest 1/eta at each rung"
+    )
+    PARSER.add_argument(
+        "--max-memory",
+        type=float,
+        help="MB of resident memory per trial, by default what is available",
+    )
+    PARSER.add_argument("--min-frames", type=int, default=int(2e4))
+    PARSER.add_argument("--min-updates", type=int, default=5)
+    PARSER.add_argument(
+        "--output",
+        type=Path,
+        default=Path(".runs", "autotune", time.strftime("%Y-%m-%d-%H-%M-%S")),
+    )
+    PARSER.add_argument("--poll-interval", type=float, default=1.0)
+    PARSER.add_argument("--program", default="ours.py")
+    PARSER.add_argument(
+        "--timeout", type=float, default=600.0, help="seconds per trial"
+    )
+    sys.exit(main(**vars(PARSER.parse_args())))
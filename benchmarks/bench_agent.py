@@ -0,0 +1,46 @@
+import itertools
+from typing import Dict
+
+import numpy as np
+import torch
+
+import baseline_agent
+import our_agent
+from agents import quantized
+from benchmarks.common import build_agent, build_env, config, measure
+from env_worker import flatten_obs
+
+
+def run(quick: bool) -> Dict[str, float]:
+    batch_sizes = [1, 64] if quick else [1, 16, 64, 256]
+    max_lines = [10] if quick else [5, 10, 20]
+    agents = dict(ours=our_agent.Agent, baseline=baseline_agent.Agent)
+    results = {}
+    for lines, (name, agent_cls) in itertools.product(max_lines, agents.items()):
+        cfg = config(max_lines=lines)
+        env = build_env(cfg)
+        agent = build_agent(agent_cls, cfg, env)
+        int8 = quantized(agent)
+        obs = torch.from_numpy(flatten_obs(env.reset()))
+        for n in batch_sizes:
+            inputs = obs.unsqueeze(0).expand(n, -1).contiguous()
+            rnn_hxs = torch.zeros(n, agent.recurrent_hidden_state_size)
+            masks = torch.ones(n, 1)
+
+            def forward(module=agent):
+                with torch.no_grad():
+                    module(inputs=inputs, rnn_hxs=rnn_hxs, masks=masks)
+
+            results[f"{name} forward [nl={lines},batch={n}]"] = measure(
+                forward, number=10
+            )
+            results[f"{name} forward int8 [nl={lines},batch={n}]"] = measure(
+                lambda: forward(int8), number=10
+            )
+            if name == "ours" and our_agent.bf16_available():
+                agent.bf16 = True
+                results[f"{name} forward bf16 [nl={lines},batch={n}]"] = measure(
+                    forward, number=10
+                )
+                agent.bf16 = False
+    return results
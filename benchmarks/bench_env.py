@@ -0,0 +1,26 @@
+import itertools
+from typing import Dict
+
+from benchmarks.common import RandomPolicy, build_env, config, measure
+
+
+def run(quick: bool) -> Dict[str, float]:
+    world_sizes = [4] if quick else [4, 6, 8]
+    max_lines = [10] if quick else [5, 10, 20]
+    results = {}
+    for world_size, lines in itertools.product(world_sizes, max_lines):
+        cfg = config(world_size=world_size, max_lines=lines, min_lines=1)
+        env = build_env(cfg)
+        policy = RandomPolicy(env.action_space, seed=cfg.seed)
+        obs = env.reset()
+
+        def step():
+            nonlocal obs
+            obs, _, done, _ = env.step(policy(obs))
+            if done:
+                obs = env.reset()
+
+        name = f"world_size={world_size},max_lines={lines}"
+        results[f"env step [{name}]"] = measure(step, number=1000)
+        results[f"env reset [{name}]"] = measure(env.reset, number=100)
+    return results
@@ -0,0 +1,31 @@
+import inspect
+from typing import Dict
+
+import our_agent
+from benchmarks.common import build_agent, build_env, collect, config, measure
+from ppo import PPO
+
+
+def run(quick: bool) -> Dict[str, float]:
+    cfg = config()
+    num_processes = 8 if quick else cfg.num_processes
+    agent = build_agent(our_agent.Agent, cfg, build_env(cfg))
+    rollouts = collect(
+        cfg, agent, num_processes=num_processes, num_steps=cfg.train_steps
+    )
+    ppo_args = {
+        k: getattr(cfg, k)
+        for k in inspect.signature(PPO.__init__).parameters
+        if k != "agent" and hasattr(cfg, k)
+    }
+    ppo = PPO(agent=agent, **ppo_args)
+    name = f"num_processes={num_processes},num_steps={cfg.train_steps}"
+    results = {
+        f"PPO.update [{name}]": measure(lambda: ppo.update(rollouts), number=1)
+    }
+    if our_agent.bf16_available():
+        agent.bf16 = True
+        results[f"PPO.update bf16 [{name}]"] = measure(
+            lambda: ppo.update(rollouts), number=1
+        )
+    return results
@@ -0,0 +1,32 @@
+from typing import Dict
+
+import our_agent
+from benchmarks.common import build_agent, build_env, collect, config, measure
+
+
+def run(quick: bool) -> Dict[str, float]:
+    cfg = config()
+    num_processes = 8 if quick else cfg.num_processes
+    agent = build_agent(our_agent.Agent, cfg, build_env(cfg))
+    rollouts = collect(
+        cfg, agent, num_processes=num_processes, num_steps=cfg.train_steps
+    )
+    next_value = rollouts.value_preds[-1]
+    advantages = rollouts.returns[:-1] - rollouts.value_preds[:-1]
+    name = f"num_processes={num_processes},num_steps={cfg.train_steps}"
+
+    def feed_forward():
+        for _ in rollouts.feed_forward_generator(advantages, cfg.num_batch):
+            pass
+
+    def recurrent():
+        for _ in rollouts.recurrent_generator(advantages, cfg.num_batch):
+            pass
+
+    return {
+        f"compute_returns [{name}]": measure(
+            lambda: rollouts.compute_returns(next_value), number=100
+        ),
+        f"feed_forward_generator [{name}]": measure(feed_forward, number=10),
+        f"recurrent_generator [{name}]": measure(recurrent, number=10),
+    }
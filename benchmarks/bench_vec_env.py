@@ -0,0 +1,39 @@
+from typing import Dict
+
+import numpy as np
+
+from benchmarks.common import RandomPolicy, build_env, config, measure
+from vec_env import SharedMemoryVecEnv
+
+from stable_baselines3.common.vec_env import DummyVecEnv, SubprocVecEnv
+
+
+def run(quick: bool) -> Dict[str, float]:
+    cfg = config()
+    num_envs = [1, 4, 16] if quick else [1, 2, 4, 8, 16, 32, 64, 128]
+    vec_envs = dict(
+        DummyVecEnv=DummyVecEnv,
+        SubprocVecEnv=lambda env_fns: SubprocVecEnv(env_fns, start_method="fork"),
+        SharedMemoryVecEnv=SharedMemoryVecEnv,
+        # one env per process, as before workers hosted several
+        SharedMemoryVecEnv1=lambda env_fns: SharedMemoryVecEnv(
+            env_fns, envs_per_worker=1
+        ),
+    )
+    results = {}
+    for n in num_envs:
+        env_fns = [lambda i=i: build_env(cfg, rank=i) for i in range(n)]
+        for name, vec_env in vec_envs.items():
+            envs = vec_env(env_fns)
+            policy = RandomPolicy(envs.action_space, seed=cfg.seed)
+            actions = np.stack([policy() for _ in range(n)])
+            envs.reset()
+
+            def step():
+                envs.step_async(actions)
+                envs.step_wait()
+
+            # seconds per frame, so that vec envs of different sizes are comparable
+            results[f"{name} frame [num_envs={n}]"] = measure(step, number=100) / n
+            envs.close()
+    return results
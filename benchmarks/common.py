@@ -0,0 +1,144 @@
+import os
+import platform
+import socket
+import subprocess
+import time
+import timeit
+from dataclasses import fields, replace
+from multiprocessing import Queue
+from typing import Callable, Type
+
+import gym
+import numpy as np
+import torch
+
+import env
+import our_agent
+from ours import OurConfig
+from rollouts import RolloutStorage
+from trainer import Trainer
+from wrappers import VecPyTorch
+
+from stable_baselines3.common.vec_env import DummyVecEnv
+
+
+class RandomPolicy:
+    """
+    Samples uniformly from the action space, so env benchmarks need no network.
+    """
+
+    def __init__(self, action_space: gym.Space, seed: int = 0):
+        self.action_space = action_space
+        self.action_space.seed(seed)
+
+    def __call__(self, obs=None) -> np.ndarray:
+        return self.action_space.sample()
+
+
+def build_agent(agent_cls: Type[our_agent.Agent], cfg: OurConfig, envs):
+    kwargs = {
+        f.name: getattr(cfg, f.name)
+        for f in fields(agent_cls)
+        if hasattr(cfg, f.name)
+        and f.name not in ("action_space", "observation_space")
+    }
+    return agent_cls(
+        observation_space=envs.observation_space,
+        action_space=envs.action_space,
+        **kwargs,
+    )
+
+
+def build_env(cfg: OurConfig, rank: int = 0, eval_steps: int = 500) -> env.Env:
+    kwargs = {
+        f.name: getattr(cfg, f.name) for f in fields(env.Env) if hasattr(cfg, f.name)
+    }
+    return env.Env(
+        **kwargs,
+        eval_steps=eval_steps,
+        failure_buffer=Queue(),
+        rank=rank,
+        random_seed=cfg.seed + rank,
+    )
+
+
+def collect(
+    cfg: OurConfig, agent: our_agent.Agent, num_processes: int, num_steps: int
+) -> RolloutStorage:
+    """
+    Fills a rollout buffer by running the agent in a synchronous vec env.
+    """
+    envs = VecPyTorch(
+        DummyVecEnv(
+            [lambda i=i: build_env(cfg, rank=i) for i in range(num_processes)]
+        )
+    )
+    rollouts = RolloutStorage(
+        num_steps=num_steps,
+        num_processes=num_processes,
+        obs_space=envs.observation_space,
+        action_space=envs.action_space,
+        recurrent_hidden_state_size=agent.recurrent_hidden_state_size,
+        use_gae=cfg.use_gae,
+        gamma=cfg.gamma,
+        tau=cfg.tau,
+    )
+    rollouts.obs[0].copy_(envs.reset())
+    for output in Trainer.run_epoch(
+        obs=rollouts.obs[0],
+        rnn_hxs=rollouts.recurrent_hidden_states[0],
+        masks=rollouts.masks[0],
+        envs=envs,
+        num_steps=num_steps,
+        agent=agent,
+    ):
+        rollouts.insert(
+            obs=output.obs,
+            recurrent_hidden_states=output.act.rnn_hxs,
+            actions=output.act.action,
+            action_log_probs=output.act.action_log_probs,
+            values=output.act.value,
+            rewards=output.reward,
+            masks=output.masks,
+        )
+    envs.close()
+    with torch.no_grad():
+        next_value = agent.get_value(
+            rollouts.obs[-1], rollouts.recurrent_hidden_states[-1], rollouts.masks[-1]
+        )
+    rollouts.compute_returns(next_value)
+    return rollouts
+
+
+def config(**kwargs) -> OurConfig:
+    return replace(OurConfig(), **kwargs)
+
+
+def measure(fn: Callable[[], any], number: int, repeat: int = 3) -> float:
+    """
+    Best-of-`repeat` seconds per call of `fn`, after one warm-up call.
+    """
+    fn()
+    return min(timeit.repeat(fn, number=number, repeat=repeat)) / number
+
+
+def metadata() -> dict:
+    try:
+        commit = subprocess.check_output(
+            ["git", "rev-parse", "HEAD"], stderr=subprocess.DEVNULL, text=True
+        ).strip()
+    except (subprocess.CalledProcessError, FileNotFoundError):
+        commit = None
+    return dict(
+        commit=commit,
+        cpu_count=os.cpu_count(),
+        hostname=socket.gethostname(),
+        machine=platform.machine(),
+        numpy=np.__version__,
+        platform=platform.platform(),
+        processor=platform.processor(),
+        python=platform.python_version(),
+        time=time.strftime("%Y-%m-%dT%H:%M:%S"),
+        torch=torch.__version__,
+        torch_threads=torch.get_num_threads(),
+    )
@@ -0,0 +1,86 @@
+#! /usr/bin/env python
+"""
+Checks that bf16 training (see `our_agent.autocast`) learns like fp32: trains
+`ours.py` twice from the same seed, once with each precision, and compares the
+mean of each metric over the last `--window` reports. Run from the repository
+root:
+
+    python -m benchmarks.parity --frames 1000000
+"""
+import argparse
+import json
+import sys
+from pathlib import Path
+from typing import Dict, List
+
+import numpy as np
+
+from local_sweep import launch
+from metrics import METRICS_NAME
+from our_agent import bf16_available
+from planner import available_cores
+
+
+def curve(run_dir: Path, key: str) -> np.ndarray:
+    with Path(run_dir, METRICS_NAME).open() as f:
+        reports = [json.loads(line) for line in f]
+    return np.array([r[key] for r in reports if key in r])
+
+
+def main(
+    frames: int, keys: List[str], output: Path, seed: int, tolerance: float, window: int
+):
+    if not bf16_available():
+        # autocast would be a no-op, so both runs would train in fp32
+        print("bf16 needs CPU autocast (torch >= 1.10); nothing to compare.")
+        return 1
+    run_dirs = {}  # type: Dict[str, Path]
+    for precision in ("fp32", "bf16"):
+        run_dir = Path(output, precision)
+        params = dict(
+            bf16=str(precision == "bf16").lower(),
+            eval="no",
+            num_frames=frames,
+            seed=seed,
+        )
+        print(f"Training with {precision} in {run_dir}...")
+        returncode = launch("ours.py", params, run_dir, available_cores()).wait()
+        if returncode:
+            print(f"Training with {precision} failed. See {run_dir}/output.log.")
+            return returncode
+        run_dirs[precision] = run_dir
+
+    failed = False
+    for key in keys:
+        fp32, bf16 = (curve(run_dirs[p], key)[-window:] for p in run_dirs)
+        if not (len(fp32) and len(bf16)):
+            print(f"{key}: not logged")
+            continue
+        gap = abs(bf16.mean() - fp32.mean()) / (abs(fp32.mean()) + 1e-8)
+        failed |= gap > tolerance
+        print(
+            f"{key}: fp32 {fp32.mean():.4g}, bf16 {bf16.mean():.4g} ({gap:.1%} apart)"
+            + (" MISMATCH" if gap > tolerance else "")
+        )
+    return int(failed)
+
+
+if __name__ == "__main__":
+    PARSER = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    PARSER.add_argument("--frames", type=int, default=int(1e6))
+    PARSER.add_argument("--keys", nargs="+", default=["reward"])
+    PARSER.add_argument(
+        "--output", type=Path, default=Path("benchmarks", "results", "parity")
+    )
+    PARSER.add_argument("--seed", type=int, default=0)
+    PARSER.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.1,
+        help="largest relative gap between the final fp32 and bf16 means",
+    )
+    PARSER.add_argument("--window", type=int, default=5)
+    args = PARSER.parse_args()
+    sys.exit(main(**vars(args)))
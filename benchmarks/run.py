@@ -0,0 +1,103 @@
+#! /usr/bin/env python
+"""
+Runs the benchmarks on CPU and writes the results (seconds per call, lower is
+better) along with machine metadata to JSON. Results are compared against the
+stored baseline for this machine and any benchmark that got slower by more than
+`--tolerance` is flagged. Run from the repository root:
+
+    python -m benchmarks.run --quick
+    python -m benchmarks.run --save-baseline
+"""
+import argparse
+import json
+import socket
+import sys
+import time
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+import torch
+
+from benchmarks import bench_agent, bench_env, bench_ppo, bench_rollouts, bench_vec_env
+from benchmarks.common import metadata
+
+BENCHMARKS = dict(
+    env=bench_env,
+    vec_env=bench_vec_env,
+    agent=bench_agent,
+    rollouts=bench_rollouts,
+    ppo=bench_ppo,
+)
+DIRECTORY = Path(__file__).parent
+
+
+def compare(
+    results: Dict[str, float], baseline: Dict[str, float], tolerance: float
+) -> List[Tuple[str, float, float]]:
+    return [
+        (k, baseline[k], v)
+        for k, v in results.items()
+        if k in baseline and v > baseline[k] * (1 + tolerance)
+    ]
+
+
+def main(
+    baseline: Path,
+    only: List[str],
+    output: Path,
+    quick: bool,
+    save_baseline: bool,
+    tolerance: float,
+):
+    torch.set_num_threads(1)
+    results = {}
+    for name in only:
+        print(f"Running {name} benchmarks...")
+        for k, v in BENCHMARKS[name].run(quick).items():
+            print(f"{k}: {v:.3e}s")
+            results[f"{name}/{k}"] = v
+
+    report = dict(metadata=metadata(), quick=quick, results=results)
+    paths = [output, baseline] if save_baseline else [output]
+    for path in paths:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with path.open("w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Wrote results to {path}")
+    if save_baseline:
+        return 0
+    if not baseline.exists():
+        print(f"No baseline at {baseline}. Run with --save-baseline to record one.")
+        return 0
+    with baseline.open() as f:
+        stored = json.load(f)
+    if stored["quick"] != quick:
+        print("Baseline was recorded with a different --quick setting.")
+        return 0
+    regressions = compare(results, stored["results"], tolerance)
+    for k, old, new in regressions:
+        print(f"REGRESSION {k}: {old:.3e}s -> {new:.3e}s ({new / old - 1:+.0%})")
+    if not regressions:
+        print(f"No regressions against {baseline}")
+    return int(bool(regressions))
+
+
+if __name__ == "__main__":
+    PARSER = argparse.ArgumentParser()
+    PARSER.add_argument(
+        "--baseline",
+        type=Path,
+        default=Path(DIRECTORY, "baselines", f"{socket.gethostname()}.json"),
+    )
+    PARSER.add_argument(
+        "--only", nargs="+", choices=list(BENCHMARKS), default=list(BENCHMARKS)
+    )
+    PARSER.add_argument(
+        "--output",
+        type=Path,
+        default=Path(DIRECTORY, "results", time.strftime("%Y%m%d-%H%M%S") + ".json"),
+    )
+    PARSER.add_argument("--quick", action="store_true")
+    PARSER.add_argument("--save-baseline", action="store_true")
+    PARSER.add_argument("--tolerance", type=float, default=0.2)
+    sys.exit(main(**vars(PARSER.parse_args())))
@@ -0,0 +1,102 @@
+import copy
+import os
+import re
+import shutil
+import threading
+from pathlib import Path
+from queue import Queue
+from typing import Optional
+
+import torch
+
+CHECKPOINT_NAME = "checkpoint.pt"
+
+
+def read_checkpoint(path: Path, map_location=None) -> dict:
+    """
+    Loads a checkpoint written by `CheckpointWriter`. Besides tensors, it pickles
+    aggregators, counters and RNG states, which torch >= 2.6 only unpickles with
+    `weights_only=False` (an argument that torch 1.4 does not take).
+    """
+    version = tuple(map(int, re.match(r"(\d+)\.(\d+)", torch.__version__).groups()))
+    kwargs = dict(weights_only=False) if version >= (2, 6) else {}
+    return torch.load(str(path), map_location=map_location, **kwargs)
+
+
+class CheckpointWriter:
+    """
+    Writes checkpoints from a background thread. Each checkpoint is written to a
+    temporary file and renamed into place, so a preempted write never corrupts an
+    existing checkpoint. `checkpoint.pt` always points at the newest checkpoint and
+    only the last `keep` numbered checkpoints are kept. A failed write is re-raised
+    by the next `save` or `close`.
+    """
+
+    pattern = re.compile(r"checkpoint-(\d+)\.pt")
+
+    def __init__(self, log_dir: Path, keep: int):
+        assert keep >= 1, "keep_checkpoints must be at least 1"
+        self.log_dir = Path(log_dir)
+        self.keep = keep
+        self.error = None  # type: Optional[Exception]
+        self.queue = Queue(maxsize=1)
+        self.thread = threading.Thread(target=self.work, daemon=True)
+        self.thread.start()
+
+    def check(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise RuntimeError("Writing a checkpoint failed.") from error
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        self.check()
+
+    def prune(self):
+        def step(path: Path):
+            return int(self.pattern.fullmatch(path.name).group(1))
+
+        checkpoints = sorted(
+            (p for p in self.log_dir.iterdir() if self.pattern.fullmatch(p.name)),
+            key=step,
+        )
+        for path in checkpoints[: max(len(checkpoints) - self.keep, 0)]:
+            path.unlink()
+
+    def save(self, step: int, state: dict):
+        # state is cloned on the calling thread
+        self.check()
+        self.queue.put((step, copy.deepcopy(state)))
+
+    def work(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            step, state = item
+            try:
+                self.write(step, dict(state, step=step))
+            except Exception as e:
+                # keep consuming, so that the next `save` does not block forever
+                print(f"Failed to write checkpoint {step}: {e!r}")
+                self.error = e
+
+    def write(self, step: int, state: dict):
+        path = Path(self.log_dir, f"checkpoint-{step}.pt")
+        tmp = path.with_suffix(".tmp")
+        with tmp.open("wb") as f:
+            torch.save(state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+
+        latest = Path(self.log_dir, CHECKPOINT_NAME)
+        tmp = latest.with_suffix(".tmp")
+        try:
+            os.link(path, tmp)
+        except OSError:
+            shutil.copyfile(path, tmp)
+        os.replace(tmp, latest)
+        self.prune()
+        print(f"Saved parameters to {latest}")
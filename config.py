@@ -21,6 +21,7 @@ def flatten(cfg: DictConfig):
 
 @dataclass
 class Eval:
+    concurrent: bool = True
     interval: Optional[int] = MISSING
     steps: Optional[int] = MISSING
 
@@ -40,13 +41,20 @@ class YesEval(Eval):
 @dataclass
 class BaseConfig:
     activation_name: str = "ReLU"
+    allreduce_advantages: bool = False
+    async_update: bool = False
     clip_param: float = 0.2
     cuda_deterministic: bool = True
     entropy_coef: float = 0.25
+    envs_per_worker: Optional[int] = None
     eval: Any = MISSING
     gamma: float = 0.99
     group: Optional[str] = None
     hidden_size: int = 150
+    inference_batch_size: int = 32
+    inference_server: bool = False
+    inference_timeout: float = 0.005
+    keep_checkpoints: int = 3
     learning_rate: float = 0.0025
     load_path: Optional[str] = None
     log_interval: int = int(1e5)
@@ -54,9 +62,17 @@ class BaseConfig:
     name: Optional[str] = None
     normalize: bool = False
     num_batch: int = 1
+    num_learners: int = 1
     num_processes: int = 100
+    num_seeds: int = 1
     optimizer: str = "Adam"
+    persistent_workers: bool = False
+    plan_cores: bool = False
+    profile: bool = False
+    profile_trace: bool = False
     ppo_epoch: int = 5
+    quantize_actor: bool = False
+    record_rate: float = 0.0
     cuda: bool = True
     use_wandb: bool = True
     num_frames: Optional[int] = None
@@ -64,11 +80,13 @@ class BaseConfig:
     render_eval: bool = False
     save_interval: int = int(1e5)
     seed: int = 0
+    step_deadline: Optional[float] = None
     synchronous: bool = False
     tau: float = 0.95
     train_steps: int = 25
     use_gae: bool = False
     value_loss_coef: float = 0.5
+    worker_start_method: str = "fork"
     wandb_version: Optional[str] = None
     _wandb: Optional[str] = None
     defaults: List[Any] = field(default_factory=lambda: [dict(eval="yes")])
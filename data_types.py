@@ -9,11 +9,12 @@ from typing import Tuple, Union, List, Generator, Dict, Generic, Optional
 
 import gym
 import numpy as np
-import torch
-from colored import fg
 from gym import spaces
 
-from utils import RESET
+from env_utils import RESET
+
+if typing.TYPE_CHECKING:
+    import torch
 
 CoordType = Tuple[int, int]
 IntGenerator = Generator[int, None, None]
@@ -37,6 +38,12 @@ class InvalidInput(Exception):
     pass
 
 
+def fg(color: str) -> str:
+    from colored import fg as _fg  # only needed for rendering
+
+    return _fg(color)
+
+
 """ abstract classes """
 
 
@@ -373,7 +380,7 @@ class DoNothing(Assignment):
 
 Command = Union[BuildOrder, Resource]
 
-O = typing.TypeVar("O", torch.Tensor, np.ndarray, int, gym.Space)
+O = typing.TypeVar("O", "torch.Tensor", np.ndarray, int, gym.Space)
 
 
 @dataclass(frozen=True)
@@ -392,10 +399,10 @@ X = typing.TypeVar("X")
 
 @dataclass(frozen=True)
 class RawAction:
-    delta: Union[np.ndarray, torch.Tensor, X]
-    dg: Union[np.ndarray, torch.Tensor, X]
-    ptr: Union[np.ndarray, torch.Tensor, X]
-    a: Union[np.ndarray, torch.Tensor, X]
+    delta: Union[np.ndarray, "torch.Tensor", X]
+    dg: Union[np.ndarray, "torch.Tensor", X]
+    ptr: Union[np.ndarray, "torch.Tensor", X]
+    a: Union[np.ndarray, "torch.Tensor", X]
 
     @staticmethod
     def parse(*xs) -> "RawAction":
@@ -1039,3 +1046,13 @@ Buildings: List[Building] = [
     TwilightCouncil(),
 ]
 WorldObjects = list(Buildings) + list(Resource) + list(Worker)
+
+
+def precompute_tables():
+    """
+    Fills the action-mask caches (which depend on WORLD_SIZE) so that env workers
+    forked afterwards share them instead of each computing their own.
+    """
+    for stage in ActionStage._children():
+        stage.mask()
+        stage.gate_openers()
@@ -13,14 +13,9 @@ from queue import Full, Empty
 from typing import Union, Dict, Generator, Tuple, List, Optional
 
 import gym
-import hydra
 import numpy as np
-from colored import fg
 from gym import spaces
 from gym.utils import seeding
-from hydra.core.config_store import ConfigStore
-from omegaconf import DictConfig
-from treelib import Tree
 
 import data_types
 import keyboard_control
@@ -45,8 +40,14 @@ from data_types import (
     Buildings,
     Assimilator,
     Nexus,
+    fg,
 )
-from utils import RESET, Discrete
+from profiler import PROFILER
+from env_utils import RESET, Discrete
+
+if typing.TYPE_CHECKING:
+    from omegaconf import DictConfig
+    from treelib import Tree
 
 Dependencies = Dict[Building, Building]
 
@@ -207,7 +208,8 @@ class Env(gym.Env):
         return instructions
 
     @staticmethod
-    def build_trees(dependencies: Dependencies) -> typing.Set[Tree]:
+    def build_trees(dependencies: Dependencies) -> typing.Set["Tree"]:
+        from treelib import Tree  # only needed for rendering
 
         trees: Dict[Building, Tree] = {}
 
@@ -245,6 +247,10 @@ class Env(gym.Env):
             pickle.dump(x, f)
         return path.absolute()
 
+    @staticmethod
+    def failure_buffer_key(key: str, used: bool) -> str:
+        return f"{key} ({'with' if used else 'without'} failure buffer)"
+
     def failure_buffer_wrapper(self, iterator):
         use_failure_buf = False
         size = self.failure_buffer.qsize()
@@ -306,7 +312,7 @@ class Env(gym.Env):
                 if not self.evaluating:
                     i.update(
                         {
-                            f"{k} ({'with' if use_failure_buf else 'without'} failure buffer)": v
+                            self.failure_buffer_key(k, use_failure_buf): v
                             for k, v in i.items()
                         }
                     )
@@ -344,20 +350,10 @@ class Env(gym.Env):
 
         while True:
             if done:
-                if self.evaluating:
-                    lower = (len(lines) - 1) // self.bucket_size * self.bucket_size + 1
-                    upper = (
-                        1 + (len(lines) - 1) // self.bucket_size
-                    ) * self.bucket_size
-                    key = (
-                        f"success on instructions length-{lower} through length-{upper}"
-                    )
-                else:
-                    key = f"success on length-{len(lines)} instructions"
                 info.update(
                     {
                         f"success": float(state.success),
-                        key: float(state.success),
+                        self.length_key(len(lines)): float(state.success),
                         "instruction length": len(lines),
                         "time per line": elapsed_time / len(lines),
                     },
@@ -372,11 +368,38 @@ class Env(gym.Env):
             info = {}
             elapsed_time += 1
 
+    def info_keys(self) -> List[str]:
+        """
+        Every key that `step` can put in an info dict, in a fixed order.
+        """
+        lengths = range(self.min_lines, self.max_lines + 1)
+        keys = [
+            "success",
+            *dict.fromkeys(self.length_key(n) for n in lengths),
+            "instruction length",
+            "time per line",
+            "success on gas buildings",
+        ]
+        if not self.evaluating:
+            keys += [
+                self.failure_buffer_key(k, used)
+                for used in (True, False)
+                for k in keys
+            ]
+        return keys + ["used failure buffer"]
+
     @staticmethod
     def load(path: str) -> State:
         with Path(path).open("rb") as f:
             return pickle.load(f)
 
+    def length_key(self, n_lines: int) -> str:
+        if self.evaluating:
+            lower = (n_lines - 1) // self.bucket_size * self.bucket_size + 1
+            upper = (1 + (n_lines - 1) // self.bucket_size) * self.bucket_size
+            return f"success on instructions length-{lower} through length-{upper}"
+        return f"success on length-{n_lines} instructions"
+
     def main(self):
         keyboard_control.run(self, lambda: None)
 
@@ -609,10 +632,14 @@ class Env(gym.Env):
             print(RESET)
 
         while True:
-            s, render_s = obs_iterator.send(state)
-            r, render_r = reward_iterator.send(state)
-            t, render_t = done_iterator.send(state)
-            i, render_i = info_iterator.send((state, t))
+            with PROFILER.span("obs"):
+                s, render_s = obs_iterator.send(state)
+            with PROFILER.span("reward"):
+                r, render_r = reward_iterator.send(state)
+            with PROFILER.span("done"):
+                t, render_t = done_iterator.send(state)
+            with PROFILER.span("info"):
+                i, render_i = info_iterator.send((state, t))
 
             if self.break_on_fail and t and not i["success"]:
                 import ipdb
@@ -625,7 +652,8 @@ class Env(gym.Env):
             # noinspection PyTypeChecker
             a = yield s, r, t, i
 
-            state, render_state = state_iterator.send(a)
+            with PROFILER.span("state"):
+                state, render_state = state_iterator.send(a)
             if self.evaluating:
                 time_remaining -= 1
                 state = replace(state, time_remaining=time_remaining)
@@ -754,13 +782,13 @@ class Env(gym.Env):
                     del building_positions[coord]
 
     def step(self, action: Union[np.ndarray, ActionStage]):
-        if isinstance(action, np.ndarray):
-            action = RawAction.parse(*action)
-        return self.iterator.send(action)
+        with PROFILER.span("env step"):
+            if isinstance(action, np.ndarray):
+                action = RawAction.parse(*action)
+            return self.iterator.send(action)
 
 
-@hydra.main(config_name="config")
-def app(cfg: DictConfig) -> None:
+def app(cfg: "DictConfig") -> None:
     failure_buffer = Queue()
     try:
         failure_buffer.qsize()
@@ -775,6 +803,9 @@ def app(cfg: DictConfig) -> None:
 
 
 if __name__ == "__main__":
+    # hydra is only needed to run this module directly, so env workers never load it
+    import hydra
+    from hydra.core.config_store import ConfigStore
 
     @dataclass
     class Config(EnvConfig):
@@ -782,4 +813,4 @@ if __name__ == "__main__":
 
     cs = ConfigStore.instance()
     cs.store(name="config", node=Config)
-    app()
+    hydra.main(config_name="config")(app)()
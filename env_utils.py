@@ -0,0 +1,30 @@
+"""
+Helpers for the env modules. Unlike utils.py, this module does not import torch, so
+env worker processes can load it cheaply.
+"""
+from gym import spaces
+
+RESET = "\033[0m"
+
+
+class Discrete(spaces.Discrete):
+    def __init__(self, low: int, high: int):
+        self.low = low
+        self.high = high
+        super().__init__(1 + high - low)
+
+    def sample(self) -> int:
+        return self.low + super().sample()
+
+    def contains(self, x) -> bool:
+        return super().contains(x - self.low)
+
+    def __repr__(self) -> str:
+        return f"Discrete({self.low}, {self.high})"
+
+    def __eq__(self, other) -> bool:
+        return (
+            isinstance(other, Discrete)
+            and self.low == other.low
+            and self.high == other.high
+        )
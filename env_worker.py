@@ -0,0 +1,231 @@
+"""
+The env side of `vec_env.SharedMemoryVecEnv`. This module and the env modules it
+loads (env, data_types, env_utils, profiler) import only NumPy and gym, so workers
+started with "spawn" or "forkserver" stay small and start quickly.
+"""
+import importlib
+import os
+import time
+from collections import namedtuple
+from multiprocessing.connection import Connection
+from multiprocessing.shared_memory import SharedMemory
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+import gym
+import numpy as np
+from gym import spaces
+
+from profiler import PROFILER
+
+InfoBatch = namedtuple("InfoBatch", "keys values")
+
+
+class EnvSpec(namedtuple("EnvSpec", "entry_point kwargs")):
+    """
+    A picklable env constructor: `entry_point` is "module:attribute", so that a
+    spawned worker imports only that module.
+    """
+
+    def __call__(self) -> gym.Env:
+        module, name = self.entry_point.split(":")
+        return getattr(importlib.import_module(module), name)(**self.kwargs)
+
+
+def flatten_obs(obs) -> np.ndarray:
+    if isinstance(obs, dict):
+        return np.concatenate(
+            [np.asarray(x, dtype=np.float32).reshape(-1) for x in obs.values()]
+        )
+    return np.asarray(obs, dtype=np.float32)
+
+
+def obs_size(space: gym.Space) -> int:
+    if isinstance(space, spaces.Dict):
+        return sum(obs_size(s) for s in space.spaces.values())
+    return int(np.prod(space.shape))
+
+
+class InfoSchema:
+    """
+    Assigns each info key a fixed slot in a float vector. Slots that an info dict does
+    not fill are NaN.
+    """
+
+    def __init__(self, keys: Sequence[str]):
+        self.keys = list(keys)
+        self.slots = {k: i for i, k in enumerate(self.keys)}
+
+    def decode(self, values: np.ndarray) -> List[Dict[str, float]]:
+        return [
+            {k: v for k, v in zip(self.keys, row) if not np.isnan(v)}
+            for row in values
+        ]
+
+    def encode(self, info: dict, out: np.ndarray):
+        out[:] = np.nan
+        for k, v in info.items():
+            slot = self.slots.get(k)
+            if slot is not None:
+                out[slot] = v
+
+
+def memory_usage() -> Tuple[float, float]:
+    """
+    Resident and private (not shared with the parent) memory of this process in MB,
+    or NaN where /proc is not available.
+    """
+    rss = private = np.nan
+    try:
+        with open("/proc/self/statm") as f:
+            rss = int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2 ** 20
+        with Path("/proc/self/smaps_rollup").open() as f:
+            private = sum(
+                int(line.split()[1]) / 2 ** 10
+                for line in f
+                if line.startswith(("Private_Clean:", "Private_Dirty:"))
+            )
+    except (OSError, ValueError):
+        pass
+    return rss, private
+
+
+def views(buffers: dict, num_envs: int) -> Dict[str, np.ndarray]:
+    return dict(
+        obs=np.frombuffer(buffers["obs"], dtype=np.float32).reshape(num_envs, -1),
+        rewards=np.frombuffer(buffers["rewards"], dtype=np.float32),
+        dones=np.frombuffer(buffers["dones"], dtype=np.int8),
+        infos=np.frombuffer(buffers["infos"], dtype=np.float32).reshape(num_envs, -1),
+        # time at which the env was ready, resident and private memory in MB
+        stats=np.frombuffer(buffers["stats"], dtype=np.float64).reshape(num_envs, 3),
+        # seconds spent in the last step (and reset) of each env
+        step_times=np.frombuffer(buffers["step_times"], dtype=np.float64),
+    )
+
+
+def attach(
+    layout: Dict[str, Tuple[str, int]]
+) -> Tuple[List[SharedMemory], Dict[str, memoryview]]:
+    """
+    Opens the shared memory segments in `layout` (array name -> segment name and
+    size in bytes).
+    """
+    segments, buffers = [], {}
+    for k, (name, size) in layout.items():
+        segment = SharedMemory(name=name)
+        segments.append(segment)
+        buffers[k] = segment.buf[:size]
+    return segments, buffers
+
+
+class Inherited:
+    """
+    Stands in for an `EnvSpec` kwarg that is unchanged by a reconfiguration, such as
+    a queue that can only be passed to a worker when it starts.
+    """
+
+
+def resolve(spec: EnvSpec, previous: EnvSpec) -> EnvSpec:
+    kwargs = {
+        k: previous.kwargs[k] if isinstance(v, Inherited) else v
+        for k, v in spec.kwargs.items()
+    }
+    return spec._replace(kwargs=kwargs)
+
+
+def work(remote: Connection, parent_remote: Connection, **config):
+    """
+    Serves `config` until the parent closes the worker or sends a "configure"
+    command, in which case the envs and buffers are replaced without restarting
+    the process. The worker pins itself to `config["cores"]` unless that is None.
+    """
+    parent_remote.close()
+    while config is not None:
+        # a spawned worker starts with a disabled profiler
+        PROFILER.configure(**config.pop("profiler"))
+        cores = config.pop("cores", None)
+        if cores is not None and hasattr(os, "sched_setaffinity"):
+            os.sched_setaffinity(0, cores)
+        segments, buffers = attach(config.pop("layout"))
+        previous = config["env_fns"]
+        config = serve(remote, buffers=buffers, **config)
+        del buffers
+        for segment in segments:
+            segment.close()
+        if config is not None:
+            config["env_fns"] = [
+                resolve(spec, prev) for spec, prev in zip(config["env_fns"], previous)
+            ]
+    remote.close()
+
+
+def serve(
+    remote: Connection,
+    env_fns: List[Callable[[], gym.Env]],
+    start: int,
+    num_envs: int,
+    buffers: Dict[str, memoryview],
+    schema: Optional[InfoSchema],
+) -> Optional[dict]:
+    """
+    Hosts the envs with ranks `start` to `start + len(env_fns)`, steps them in a
+    loop and answers each command with one message. Returns the new configuration
+    after "configure", or None after "close".
+    """
+    envs = [env_fn() for env_fn in env_fns]
+    stop = start + len(envs)
+    arrays = views(buffers, num_envs)
+    arrays["stats"][start:stop] = (time.time(), *memory_usage())
+    obs, rewards, dones, infos, step_times = (
+        arrays[k][start:stop]
+        for k in ("obs", "rewards", "dones", "infos", "step_times")
+    )
+    filled = np.zeros(len(envs), dtype=bool)
+    while True:
+        cmd, data = remote.recv()
+        if cmd == "step":
+            info_dicts = []
+            for i, (env, action) in enumerate(zip(envs, data)):
+                tick = time.perf_counter()
+                o, reward, done, info = env.step(action)
+                if done:
+                    o = env.reset()
+                step_times[i] = time.perf_counter() - tick
+                obs[i] = flatten_obs(o)
+                rewards[i] = reward
+                dones[i] = done
+                if schema is None:
+                    info_dicts.append(info)
+                # infos are only non-empty at the end of an episode
+                elif info:
+                    schema.encode(info, infos[i])
+                    filled[i] = True
+                elif filled[i]:
+                    infos[i] = np.nan
+                    filled[i] = False
+            remote.send(info_dicts if schema is None else None)
+        elif cmd == "reset":
+            for i, env in enumerate(envs):
+                obs[i] = flatten_obs(env.reset())
+            remote.send(None)
+        elif cmd in ("close", "configure"):
+            for env in envs:
+                env.close()
+            PROFILER.flush()
+            return data
+        elif cmd == "profile":
+            remote.send(PROFILER.take())
+        elif cmd == "env_method":
+            name, args, kwargs, indices = data
+            remote.send([getattr(envs[i], name)(*args, **kwargs) for i in indices])
+        elif cmd == "get_attr":
+            name, indices = data
+            remote.send([getattr(envs[i], name) for i in indices])
+        elif cmd == "set_attr":
+            name, value, indices = data
+            remote.send([setattr(envs[i], name, value) for i in indices])
+        elif cmd == "seed":
+            seeds = [None if data is None else data + i for i in range(len(envs))]
+            remote.send([env.seed(seed) for env, seed in zip(envs, seeds)])
+        else:
+            raise NotImplementedError(cmd)
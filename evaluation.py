@@ -0,0 +1,113 @@
+from collections import namedtuple
+from multiprocessing import get_context
+from queue import Empty, Full
+from typing import Callable, Dict, Generator, Tuple
+
+import torch
+import torch.nn as nn
+
+from aggregator import EvalEpisodeAggregator, EvalInfosAggregator, per_seed
+from wrappers import VecPyTorch
+
+EvalSnapshot = namedtuple("EvalSnapshot", "frames state_dict")
+
+
+def evaluate(
+    make_eval_envs: Callable[[], VecPyTorch],
+    agent: nn.Module,
+    run_epoch: Callable,
+    num_steps: int,
+    num_seeds: int,
+    snapshots,
+    results,
+):
+    torch.set_num_threads(1)
+    envs = make_eval_envs()
+    while True:
+        snapshot = snapshots.get()
+        if snapshot is None:
+            break
+        agent.load_state_dict(snapshot.state_dict)
+        eval_report = per_seed(EvalEpisodeAggregator, num_seeds)
+        eval_infos = per_seed(EvalInfosAggregator, num_seeds)
+        with agent.evaluating(envs.observation_space):
+            for output in run_epoch(
+                obs=envs.reset(),
+                rnn_hxs=torch.zeros(envs.num_envs, agent.recurrent_hidden_state_size),
+                masks=torch.zeros(envs.num_envs, 1),
+                envs=envs,
+                num_steps=num_steps,
+                agent=agent,
+            ):
+                eval_report.update(
+                    reward=output.reward.cpu().numpy(), dones=output.done
+                )
+                eval_infos.update(output.infos, dones=output.done)
+        results.put(
+            (snapshot.frames, dict(eval_report.items(), **dict(eval_infos.items())))
+        )
+    envs.close()
+
+
+class EvalWorker:
+    """
+    Evaluates snapshots of the agent's weights in a separate, persistent process
+    (with its own eval envs) while training continues.
+    """
+
+    def __init__(
+        self,
+        make_eval_envs: Callable[[], VecPyTorch],
+        agent: nn.Module,
+        run_epoch: Callable,
+        num_steps: int,
+        num_seeds: int = 1,
+    ):
+        context = get_context("fork")
+        self.snapshots = context.Queue(maxsize=1)
+        self.results = context.Queue()
+        self.pending = 0
+        # not a daemon because the eval envs may need worker processes of their own
+        self.process = context.Process(
+            target=evaluate,
+            kwargs=dict(
+                make_eval_envs=make_eval_envs,
+                agent=agent,
+                run_epoch=run_epoch,
+                num_steps=num_steps,
+                num_seeds=num_seeds,
+                snapshots=self.snapshots,
+                results=self.results,
+            ),
+        )
+        self.process.start()
+
+    def close(self):
+        self.snapshots.put(None)
+        self.process.join()
+
+    def poll(self, block: bool = False) -> Generator[Tuple[int, Dict], None, None]:
+        while self.pending:
+            try:
+                frames, results = self.results.get(block=block)
+            except Empty:
+                return
+            self.pending -= 1
+            yield frames, results
+
+    def submit(self, frames: int, agent: nn.Module, block: bool = False) -> bool:
+        """
+        Queues a snapshot of `agent` for evaluation. Unless `block`, returns False
+        instead of waiting if the previous snapshot has not been picked up yet.
+        """
+        state_dict = {
+            k: v.detach().cpu().clone() for k, v in agent.state_dict().items()
+        }
+        try:
+            self.snapshots.put(
+                EvalSnapshot(frames=frames, state_dict=state_dict), block=block
+            )
+        except Full:
+            return False  # the previous snapshot has not been picked up yet
+        self.pending += 1
+        return True
@@ -0,0 +1,267 @@
+import copy
+import multiprocessing
+import time
+from collections import namedtuple
+from multiprocessing.connection import Connection
+from queue import Empty, Full
+from typing import Callable, List
+
+import gym
+import numpy as np
+import torch
+from gym import spaces
+
+from aggregator import EpisodeAggregator, InfosAggregator
+from rollouts import RolloutStorage
+from env_worker import flatten_obs
+
+Request = namedtuple("Request", "rank obs rnn_hxs masks")
+Reply = namedtuple("Reply", "action action_log_probs value rnn_hxs")
+Fragment = namedtuple(
+    "Fragment",
+    "obs recurrent_hidden_states actions action_log_probs value_preds rewards masks "
+    "episodes infos version",
+)
+
+
+def serve(
+    actor: torch.nn.Module,
+    lock: multiprocessing.Lock,
+    requests: multiprocessing.Queue,
+    replies: List[Connection],
+    max_batch_size: int,
+    timeout: float,
+):
+    torch.set_num_threads(1)
+    while True:
+        request = requests.get()
+        if request is None:
+            return
+        batch = [request]
+        deadline = time.time() + timeout
+        while len(batch) < max_batch_size:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            try:
+                request = requests.get(timeout=remaining)
+            except Empty:
+                break
+            if request is None:
+                requests.put(None)  # finish this batch, then exit
+                break
+            batch.append(request)
+
+        ranks, obs, rnn_hxs, masks = zip(*batch)
+        with torch.no_grad(), lock:
+            act = actor(
+                inputs=torch.from_numpy(np.stack(obs)),
+                rnn_hxs=torch.from_numpy(np.stack(rnn_hxs)),
+                masks=torch.from_numpy(np.stack(masks)),
+            )
+        for i, rank in enumerate(ranks):
+            replies[rank].send(
+                Reply(
+                    action=act.action[i].numpy(),
+                    action_log_probs=act.action_log_probs[i].numpy(),
+                    value=act.value[i].numpy(),
+                    rnn_hxs=act.rnn_hxs[i].numpy(),
+                )
+            )
+
+
+def act(
+    rank: int,
+    env_fn: Callable[[], gym.Env],
+    requests: multiprocessing.Queue,
+    reply: Connection,
+    fragments: multiprocessing.Queue,
+    stop: multiprocessing.Event,
+    version: multiprocessing.Value,
+    num_steps: int,
+    recurrent_hidden_state_size: int,
+    build_infos_aggregator: Callable[[], InfosAggregator],
+):
+    torch.set_num_threads(1)
+    env = env_fn()
+    episodes = EpisodeAggregator()
+    infos = build_infos_aggregator()
+    obs = flatten_obs(env.reset())
+    rnn_hxs = np.zeros(recurrent_hidden_state_size, dtype=np.float32)
+    masks = np.ones(1, dtype=np.float32)
+
+    def preprocess(action):
+        if isinstance(env.action_space, spaces.Discrete):
+            return action.squeeze(-1)
+        if isinstance(env.action_space, spaces.Box):
+            return np.clip(action, env.action_space.low, env.action_space.high)
+        return action
+
+    while not stop.is_set():
+        fragment_version = version.value
+        fragment = dict(
+            obs=[obs],
+            recurrent_hidden_states=[rnn_hxs],
+            actions=[],
+            action_log_probs=[],
+            value_preds=[],
+            rewards=[],
+            masks=[masks],
+        )
+        for _ in range(num_steps):
+            requests.put(Request(rank=rank, obs=obs, rnn_hxs=rnn_hxs, masks=masks))
+            while not reply.poll(0.1):
+                if stop.is_set():
+                    return
+            action, action_log_probs, value, rnn_hxs = reply.recv()
+            obs, reward, done, info = env.step(preprocess(action))
+            if done:
+                obs = env.reset()
+            obs = flatten_obs(obs)
+            masks = np.array([0.0 if done else 1.0], dtype=np.float32)
+            episodes.update(reward=[reward], dones=[done])
+            infos.update([info], dones=[done])
+            fragment["obs"].append(obs)
+            fragment["recurrent_hidden_states"].append(rnn_hxs)
+            fragment["actions"].append(action)
+            fragment["action_log_probs"].append(action_log_probs)
+            fragment["value_preds"].append(value)
+            fragment["rewards"].append(np.array([reward], dtype=np.float32))
+            fragment["masks"].append(masks)
+
+        fragment = Fragment(
+            **{k: np.stack(v) for k, v in fragment.items()},
+            episodes=episodes.summary(),
+            infos=infos.summary(),
+            version=fragment_version,
+        )
+        episodes.reset()
+        infos.reset()
+        while True:
+            try:
+                fragments.put(fragment, timeout=0.1)
+                break
+            except Full:
+                if stop.is_set():
+                    return
+
+
+class ActorPool:
+    """
+    Env workers step independently and submit observations to a central inference
+    process, which batches whichever requests are ready (up to `max_batch_size` or
+    `timeout` seconds). Each worker ships fixed-length rollout fragments to the
+    learner, so slow episodes no longer hold up fast ones.
+    """
+
+    def __init__(
+        self,
+        env_fns: List[Callable[[], gym.Env]],
+        num_steps: int,
+        max_batch_size: int,
+        timeout: float,
+        build_infos_aggregator: Callable[[], InfosAggregator],
+        start_method: str = "fork",
+    ):
+        self.env_fns = env_fns
+        self.num_envs = len(env_fns)
+        self.num_steps = num_steps
+        self.max_batch_size = max_batch_size
+        self.timeout = timeout
+        self.build_infos_aggregator = build_infos_aggregator
+        self.context = multiprocessing.get_context(start_method)
+        env = env_fns[0]()
+        self.observation_space = env.observation_space
+        self.action_space = env.action_space
+        env.close()
+        self.actor = None
+        self.processes = []
+        self.lock = self.context.Lock()
+        self.stop = self.context.Event()
+        self.version = self.context.Value("i", 0)
+        self.requests = self.context.Queue()
+        self.fragments = self.context.Queue(maxsize=2 * self.num_envs)
+
+    def close(self):
+        self.stop.set()
+        self.requests.put(None)
+        for process in self.processes:
+            process.join(timeout=1)
+            if process.is_alive():
+                process.terminate()
+
+    def collect(
+        self,
+        rollouts: RolloutStorage,
+        episodes: EpisodeAggregator,
+        infos: InfosAggregator,
+    ) -> List[int]:
+        version = self.version.value
+        lags = []
+        for j in range(rollouts.obs.size(1)):
+            fragment = self.fragments.get()
+            rollouts.obs[:, j].copy_(torch.from_numpy(fragment.obs))
+            rollouts.recurrent_hidden_states[:, j].copy_(
+                torch.from_numpy(fragment.recurrent_hidden_states)
+            )
+            rollouts.actions[:, j].copy_(torch.from_numpy(fragment.actions))
+            rollouts.action_log_probs[:, j].copy_(
+                torch.from_numpy(fragment.action_log_probs)
+            )
+            rollouts.value_preds[:-1, j].copy_(torch.from_numpy(fragment.value_preds))
+            rollouts.rewards[:, j].copy_(torch.from_numpy(fragment.rewards))
+            rollouts.masks[:, j].copy_(torch.from_numpy(fragment.masks))
+            episodes.merge(fragment.episodes)
+            infos.merge(fragment.infos)
+            lags.append(version - fragment.version)
+        return lags
+
+    def start(self, agent: torch.nn.Module):
+        self.actor = copy.deepcopy(agent).cpu()
+        self.actor.share_memory()
+        receivers, senders = zip(
+            *[self.context.Pipe(duplex=False) for _ in range(self.num_envs)]
+        )
+        self.processes.append(
+            self.context.Process(
+                target=serve,
+                kwargs=dict(
+                    actor=self.actor,
+                    lock=self.lock,
+                    requests=self.requests,
+                    replies=senders,
+                    max_batch_size=self.max_batch_size,
+                    timeout=self.timeout,
+                ),
+                daemon=True,
+            )
+        )
+        for rank, (env_fn, receiver) in enumerate(zip(self.env_fns, receivers)):
+            self.processes.append(
+                self.context.Process(
+                    target=act,
+                    kwargs=dict(
+                        rank=rank,
+                        env_fn=env_fn,
+                        requests=self.requests,
+                        reply=receiver,
+                        fragments=self.fragments,
+                        stop=self.stop,
+                        version=self.version,
+                        num_steps=self.num_steps,
+                        recurrent_hidden_state_size=agent.recurrent_hidden_state_size,
+                        build_infos_aggregator=self.build_infos_aggregator,
+                    ),
+                    daemon=True,
+                )
+            )
+        for process in self.processes:
+            process.start()
+
+    def sync(self, agent: torch.nn.Module):
+        with self.lock:
+            self.actor.load_state_dict(agent.state_dict())
+            self.version.value += 1
+
+    def to(self, device):
+        pass
@@ -0,0 +1,196 @@
+#! /usr/bin/env python
+"""
+Runs a sweep on this machine, without wandb, tmux or GPUs. Runs come from Hydra-style
+grid overrides or from a wandb-style YAML sweep spec (`parameters` with `values` or
+`value`). Each run is given as many cores as it has processes (the learner plus one
+per env worker), pinned to them with CPU affinity, and started as soon as enough
+cores are free. Run from the repository root:
+
+    python local_sweep.py learning_rate=0.001,0.003 seed=0,1,2
+    python local_sweep.py --spec sweep.yaml --max-cores-per-run 16
+
+Each run logs to `<output>/<index>/`, and `<output>/sweep.jsonl` gets one line per
+finished run with its overrides, cores, exit code, duration and last metrics.
+
+Every run is a separate process with its own cores, so env workers are not shared
+between runs: `vec_env.POOL` only reuses them within a run (e.g. across its eval
+phases).
+"""
+import argparse
+import itertools
+import json
+import math
+import os
+import subprocess
+import sys
+import time
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import yaml
+
+from config import BaseConfig
+from metrics import METRICS_NAME
+from planner import available_cores
+
+RESULTS_NAME = "sweep.jsonl"
+
+
+def footprint(params: Dict[str, str], max_cores: int) -> Tuple[int, int]:
+    """
+    Cores that a run needs (a learner and its env workers per learner) and the envs
+    per worker that keep it within `max_cores`.
+    """
+    num_learners = int(params.get("num_learners", BaseConfig.num_learners))
+    num_processes = int(params.get("num_processes", BaseConfig.num_processes))
+    num_processes //= num_learners
+    synchronous = params.get("synchronous", str(BaseConfig.synchronous))
+    if synchronous.lower() == "true" or num_processes == 1:
+        return min(num_learners, max_cores), 1
+    envs_per_worker = params.get("envs_per_worker", "null")
+    envs_per_worker = 1 if envs_per_worker == "null" else int(envs_per_worker)
+    max_workers = max(max_cores // num_learners - 1, 1)
+    envs_per_worker = max(envs_per_worker, math.ceil(num_processes / max_workers))
+    num_workers = math.ceil(num_processes / envs_per_worker)
+    # with too few cores for a learner and a worker each, share them
+    return min(num_learners * (1 + num_workers), max_cores), envs_per_worker
+
+
+def grid(overrides: List[str]) -> List[Dict[str, str]]:
+    # "key=a,b" overrides, as in Hydra's multirun
+    keys, values = [], []
+    for override in overrides:
+        key, value = override.split("=", 1)
+        keys.append(key)
+        values.append(value.split(","))
+    return [dict(zip(keys, v)) for v in itertools.product(*values)]
+
+
+def launch(
+    program: str, params: Dict[str, str], run_dir: Path, cores: List[int]
+) -> subprocess.Popen:
+    run_dir.mkdir(parents=True, exist_ok=True)
+    overrides = [f"{k}={v}" for k, v in params.items()]
+    overrides += ["use_wandb=false", f"hydra.run.dir={run_dir.absolute()}"]
+    with Path(run_dir, "command.txt").open("w") as f:
+        f.write(" ".join([sys.executable, program, *overrides]) + "\n")
+    with Path(run_dir, "output.log").open("w") as log:
+        return subprocess.Popen(
+            [sys.executable, program, *overrides],
+            stdout=log,
+            stderr=subprocess.STDOUT,
+            env=dict(os.environ, OMP_NUM_THREADS="1"),
+            # inherited by the env workers that the run starts
+            preexec_fn=lambda: os.sched_setaffinity(0, cores),
+        )
+
+
+def last_metrics(run_dir: Path) -> Optional[dict]:
+    path = Path(run_dir, METRICS_NAME)
+    if not path.exists():
+        return None
+    metrics = None
+    with path.open() as f:
+        for line in f:
+            metrics = json.loads(line)
+    return metrics
+
+
+def load_spec(path: Path) -> Tuple[Optional[str], List[Dict[str, str]]]:
+    with path.open() as f:
+        spec = yaml.safe_load(f)
+    values = {}
+    for key, parameter in spec.get("parameters", {}).items():
+        options = parameter["values"] if "values" in parameter else [parameter["value"]]
+        values[key] = [override_value(v) for v in options]
+    runs = [dict(zip(values, v)) for v in itertools.product(*values.values())]
+    return spec.get("program"), runs
+
+
+def override_value(value) -> str:
+    if value is None:
+        return "null"
+    if isinstance(value, bool):
+        return str(value).lower()
+    return str(value)
+
+
+def main(
+    max_cores_per_run: Optional[int],
+    output: Path,
+    overrides: List[str],
+    poll_interval: float,
+    program: Optional[str],
+    spec: Optional[Path],
+):
+    runs = grid(overrides)
+    if spec is not None:
+        spec_program, spec_runs = load_spec(spec)
+        program = program or spec_program
+        runs = [dict(s, **r) for s in spec_runs for r in runs]
+    program = program or "ours.py"
+    free = available_cores()
+    max_cores = min(max_cores_per_run or len(free), len(free))
+    output.mkdir(parents=True, exist_ok=True)
+    print(f"{len(runs)} runs on {len(free)} cores, logging to {output}")
+
+    queue = list(enumerate(runs))
+    running = {}  # type: Dict[subprocess.Popen, tuple]
+    try:
+        with Path(output, RESULTS_NAME).open("a") as results:
+            while queue or running:
+                # first fit: start every queued run that the free cores can hold
+                for item in list(queue):
+                    index, params = item
+                    cores, envs_per_worker = footprint(params, max_cores)
+                    if cores > len(free):
+                        continue
+                    queue.remove(item)
+                    params = dict(params, envs_per_worker=envs_per_worker)
+                    assigned, free = free[:cores], free[cores:]
+                    run_dir = Path(output, str(index))
+                    process = launch(program, params, run_dir, assigned)
+                    running[process] = (index, params, assigned, time.time())
+                    print(f"Started run {index} on cores {assigned}: {params}")
+                time.sleep(poll_interval)
+                for process, (index, params, assigned, start) in list(running.items()):
+                    if process.poll() is None:
+                        continue
+                    del running[process]
+                    free = sorted(free + assigned)
+                    record = dict(
+                        run=index,
+                        overrides=params,
+                        cores=assigned,
+                        returncode=process.returncode,
+                        seconds=time.time() - start,
+                        metrics=last_metrics(Path(output, str(index))),
+                    )
+                    results.write(json.dumps(record) + "\n")
+                    results.flush()
+                    print(
+                        f"Finished run {index} with code {process.returncode} "
+                        f"({len(queue)} queued, {len(running)} running)"
+                    )
+    finally:
+        for process in running:
+            process.terminate()
+
+
+if __name__ == "__main__":
+    PARSER = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    PARSER.add_argument(
+        "overrides", nargs="*", help="Hydra overrides, with comma-separated values"
+    )
+    PARSER.add_argument("--max-cores-per-run", type=int)
+    PARSER.add_argument(
+        "--output",
+        type=Path,
+        default=Path(".runs", "sweeps", time.strftime("%Y-%m-%d-%H-%M-%S")),
+    )
+    PARSER.add_argument("--poll-interval", type=float, default=1.0)
+    PARSER.add_argument("--program", help="defaults to the spec's, or ours.py")
+    PARSER.add_argument("--spec", type=Path, help="wandb-style YAML sweep spec")
+    main(**vars(PARSER.parse_args()))
@@ -0,0 +1,104 @@
+import json
+import threading
+from pathlib import Path
+from pprint import pprint
+from queue import Empty, SimpleQueue
+from typing import Dict, List, Tuple
+
+METRICS_NAME = "metrics.jsonl"
+
+
+class Sink:
+    def close(self):
+        pass
+
+    def write(self, batch: List[Tuple[int, Dict[str, any]]]):
+        raise NotImplementedError
+
+
+class JSONLSink(Sink):
+    """
+    Appends one JSON object per report to `metrics.jsonl` in the run directory.
+    """
+
+    def __init__(self, log_dir: Path):
+        self.file = Path(log_dir, METRICS_NAME).open("a")
+
+    @staticmethod
+    def default(x):
+        try:
+            return x.item()  # numpy and torch scalars
+        except (AttributeError, ValueError):
+            return str(x)
+
+    def close(self):
+        self.file.close()
+
+    def write(self, batch: List[Tuple[int, Dict[str, any]]]):
+        for frames, metrics in batch:
+            line = json.dumps(dict(metrics, frames=frames), default=self.default)
+            self.file.write(line + "\n")
+        self.file.flush()
+
+
+class StdoutSink(Sink):
+    def write(self, batch: List[Tuple[int, Dict[str, any]]]):
+        for frames, metrics in batch:
+            print("Frames:", frames)
+            pprint(metrics)
+
+
+class WandbSink(Sink):
+    def __init__(self):
+        import wandb
+
+        self.wandb = wandb
+
+    def write(self, batch: List[Tuple[int, Dict[str, any]]]):
+        for frames, metrics in batch:
+            try:
+                self.wandb.log(metrics, step=frames)
+            except self.wandb.Error:
+                pass
+
+
+class MetricsLogger:
+    """
+    `log` only enqueues, so reporting costs the training loop next to nothing. A
+    background thread drains whatever has accumulated and hands it to each sink in
+    one batch. A sink that raises is reported and skipped for that batch only.
+    """
+
+    def __init__(self, sinks: List[Sink]):
+        self.sinks = sinks
+        self.queue = SimpleQueue()
+        self.thread = threading.Thread(target=self.work, daemon=True)
+        self.thread.start()
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        for sink in self.sinks:
+            sink.close()
+
+    def log(self, frames: int, **metrics):
+        self.queue.put((frames, metrics))
+
+    def work(self):
+        while True:
+            batch = [self.queue.get()]
+            while batch[-1] is not None:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except Empty:
+                    break
+            closed = batch[-1] is None
+            batch = [item for item in batch if item is not None]
+            for sink in self.sinks:
+                try:
+                    sink.write(batch)
+                except Exception as e:
+                    # one failing sink must not stop the others (or later batches)
+                    print(f"{type(sink).__name__} failed to write metrics: {e!r}")
+            if closed:
+                return
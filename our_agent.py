@@ -1,3 +1,4 @@
+import contextlib
 from collections import Hashable
 from contextlib import contextmanager
 from dataclasses import dataclass, replace
@@ -31,6 +32,20 @@ class Categorical(torch.distributions.Categorical):
         return log_prob.view(shape)
 
 
+def bf16_available() -> bool:
+    # CPU autocast arrived in torch 1.10
+    return getattr(getattr(torch, "cpu", None), "amp", None) is not None
+
+
+def autocast(enabled: bool):
+    """
+    CPU autocast to bfloat16, or a no-op where torch has none (see `bf16_available`).
+    """
+    if not bf16_available():
+        return contextlib.nullcontext()
+    return torch.cpu.amp.autocast(enabled=enabled, dtype=torch.bfloat16)
+
+
 def optimal_padding(h, kernel, stride):
     n = np.ceil((h - kernel) / stride + 1)
     return int(np.ceil((stride * (n - 1) + kernel - h) / 2))
@@ -53,6 +68,7 @@ def gate(g, new, old):
 class AgentConfig:
     action_embed_size: int = 75
     add_layer: bool = True
+    bf16: bool = False
     conv_hidden_size: int = 100
     debug: bool = False
     feed_m_to_gru: bool = True
@@ -75,6 +91,7 @@ class AgentConfig:
 class Agent(NNBase):
     activation_name: str
     add_layer: bool
+    bf16: bool
     entropy_coef: float
     action_space: spaces.MultiDiscrete
     conv_hidden_size: int
@@ -105,6 +122,8 @@ class Agent(NNBase):
 
     def __post_init__(self):
         nn.Module.__init__(self)
+        if self.bf16 and not bf16_available():
+            raise ValueError("bf16 needs CPU autocast (torch >= 1.10).")
         self.activation = eval(f"nn.{self.activation_name}()")
         self.obs_spaces = Obs(**self.observation_space.spaces)
         self.action_nvec = RawAction.parse(*self.action_space.nvec)
@@ -269,7 +288,14 @@ class Agent(NNBase):
         self.state_sizes = state_sizes
         self.train_lines = train_lines
 
-    def forward(
+    def forward(self, inputs, rnn_hxs, masks, action=None, **kwargs):
+        # with bf16, the conv, Linear and GRU layers run in bfloat16 while the
+        # parameters (and so the optimizer) stay in fp32
+        with autocast(self.bf16):
+            act = self._forward(inputs, rnn_hxs, masks, action=action, **kwargs)
+        return act._replace(value=act.value.float(), rnn_hxs=act.rnn_hxs.float())
+
+    def _forward(
         self, inputs, rnn_hxs, masks, deterministic=False, action=None, **kwargs
     ):
         N, dim = inputs.shape
@@ -329,7 +355,7 @@ class Agent(NNBase):
 
         self.print("p", p)
 
-        a_logits = self.actor(z).view(-1, *self.actor_logits_shape)
+        a_logits = self.actor(z).float().view(-1, *self.actor_logits_shape)
         mask = state.action_mask.view(-1, *self.actor_logits_shape)
         mask = mask * -self.inf
         dists = replace(dists, a=Categorical(logits=a_logits + mask))
@@ -404,15 +430,16 @@ class Agent(NNBase):
             raw = astuple(replace(raw, a=raw.a.sum(1)))
             return sum([x for x in raw if x is not None])
 
-        action_log_probs = RawAction(
-            *[
-                None if dist is None else dist.log_prob(x)
-                for dist, x in zip(astuple(dists), astuple(action))
-            ],
-        )
-        entropy = RawAction(
-            *[None if dist is None else dist.entropy() for dist in astuple(dists)]
-        )
+        with autocast(False):
+            action_log_probs = RawAction(
+                *[
+                    None if dist is None else dist.log_prob(x)
+                    for dist, x in zip(astuple(dists), astuple(action))
+                ],
+            )
+            entropy = RawAction(
+                *[None if dist is None else dist.entropy() for dist in astuple(dists)]
+            )
         aux_loss = -self.entropy_coef * compute_metric(entropy).mean()
         value = self.critic(zc)
         action = torch.cat(
@@ -435,20 +462,22 @@ class Agent(NNBase):
             aux_loss=aux_loss,
             dist=None,
             rnn_hxs=rnn_hxs,
-            log=dict(entropy=entropy),
+            log=dict(entropy=entropy, P=P),
         )
 
     def get_delta(self, P, dg, line_mask, ones, z):
-        u = self.upsilon(z).softmax(dim=-1)
-        self.print("u", u)
-        d_probs = (P @ u.unsqueeze(-1)).squeeze(-1)
-        self.print("d_probs", d_probs.view(d_probs.size(0), 2, -1))
-        unmask = 1 - line_mask
-        masked = unmask * d_probs
-        sum_zero = masked.sum(-1, keepdim=True) < 1 / self.inf
-        masked = ~sum_zero * masked + sum_zero * torch.ones_like(masked) / self.inf
-        normalizer = (masked + 1 - dg.unsqueeze(-1)).sum(-1, keepdim=True)
-        normalized = masked / normalizer
+        u = self.upsilon(z).float()
+        with autocast(False):  # 1 / self.inf underflows in bfloat16
+            u = u.softmax(dim=-1)
+            self.print("u", u)
+            d_probs = (P @ u.unsqueeze(-1)).squeeze(-1)
+            self.print("d_probs", d_probs.view(d_probs.size(0), 2, -1))
+            unmask = 1 - line_mask
+            masked = unmask * d_probs
+            sum_zero = masked.sum(-1, keepdim=True) < 1 / self.inf
+            masked = ~sum_zero * masked + sum_zero * torch.ones_like(masked) / self.inf
+            normalizer = (masked + 1 - dg.unsqueeze(-1)).sum(-1, keepdim=True)
+            normalized = masked / normalizer
         self.print("normalized", normalized.view(normalized.size(0), 2, -1))
         delta_dist = gate(dg.unsqueeze(-1), normalized, ones * self.nl)
         # self.print("masked", Categorical(probs=masked).probs)
@@ -459,7 +488,7 @@ class Agent(NNBase):
         return delta, delta_dist
 
     def get_dg(self, can_open_gate, ones, z):
-        d_logits = self.d_gate(z)
+        d_logits = self.d_gate(z).float()
         dg_probs = F.softmax(d_logits, dim=-1)
         can_open_gate = can_open_gate.long().unsqueeze(-1)
         dg_dist = gate(can_open_gate, dg_probs, ones * 0)
@@ -484,7 +513,7 @@ class Agent(NNBase):
     def get_P(self, p, G, R):
         N = p.size(0)
         G = G.view(N, self.nl, 2, -1)
-        B = self.beta(G).sigmoid()
+        B = self.beta(G).float().sigmoid()
         # B = B * mask[p, R]
         f, b = torch.unbind(B, dim=-2)
         B = torch.stack([f, b.flip(-2)], dim=-2)
@@ -497,7 +526,8 @@ class Agent(NNBase):
         B = (1 - last).flip(-2) * B  # this ensures the first B is 0
         zero_last = (1 - last) * B
         B = zero_last + last  # this ensures that the last B is 1
-        C = torch.cumprod(1 - torch.roll(zero_last, shifts=1, dims=-2), dim=-2)
+        with autocast(False):  # a long product of probabilities underflows in bf16
+            C = torch.cumprod(1 - torch.roll(zero_last, shifts=1, dims=-2), dim=-2)
         P = B * C
         P = P.view(N, self.nl, 2, self.num_edges)
         f, b = torch.unbind(P, dim=-2)
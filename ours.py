@@ -17,9 +17,13 @@ import osx_queue
 import our_agent
 import trainer
 from config import BaseConfig
+from env_worker import EnvSpec
 from wrappers import VecPyTorch
 
 
+FAILURE_BUFFERS = {}  # type: Dict[int, Queue]
+
+
 @dataclass
 class OurConfig(BaseConfig, env.EnvConfig, our_agent.AgentConfig):
     failure_buffer_load_path: Optional[str] = None
@@ -50,11 +54,21 @@ class Trainer(trainer.Trainer):
 
     @staticmethod
     def build_failure_buffer(failure_buffer_load_path: Path, failure_buffer_size: int):
-        failure_buffer = Queue(maxsize=failure_buffer_size)
-        try:
-            failure_buffer.qsize()
-        except NotImplementedError:
-            failure_buffer = osx_queue.Queue()
+        # one queue per process and size, emptied for each run, so that pooled env
+        # workers (see `vec_env.WorkerPool`) keep the queue they started with
+        failure_buffer = FAILURE_BUFFERS.get(failure_buffer_size)
+        if failure_buffer is None:
+            failure_buffer = Queue(maxsize=failure_buffer_size)
+            try:
+                failure_buffer.qsize()
+            except NotImplementedError:
+                failure_buffer = osx_queue.Queue()
+            FAILURE_BUFFERS[failure_buffer_size] = failure_buffer
+        while True:
+            try:
+                failure_buffer.get_nowait()
+            except Empty:
+                break
         if failure_buffer_load_path:
             with open(failure_buffer_load_path, "rb") as f:
                 for x in pickle.load(f):
@@ -68,6 +82,16 @@ class Trainer(trainer.Trainer):
 
     @classmethod
     def dump_failure_buffer(cls, failure_buffer: Queue, log_dir: Path):
+        with Path(log_dir, "failure_buffer.pkl").open("wb") as f:
+            pickle.dump(cls.failure_buffer_items(failure_buffer), f)
+
+    @staticmethod
+    def env_spec(rank: int, seed: int, env_id=None, **kwargs) -> EnvSpec:
+        kwargs.update(rank=rank, random_seed=seed + rank)
+        return EnvSpec("env:Env", kwargs)
+
+    @staticmethod
+    def failure_buffer_items(failure_buffer: Queue) -> list:
         def gen():
             while True:
                 try:
@@ -80,19 +104,17 @@ class Trainer(trainer.Trainer):
                 except Full:
                     pass
 
-        with Path(log_dir, "failure_buffer.pkl").open("wb") as f:
-            buffer_list = [*gen()]
-            pickle.dump(buffer_list, f)
+        return [*gen()]
 
-    @staticmethod
+    @classmethod
     def make_env(
+        cls,
         rank: int,
         seed: int,
         env_id=None,
         **kwargs,
     ):
-        kwargs.update(rank=rank, random_seed=seed + rank)
-        return env.Env(**kwargs)
+        return cls.env_spec(rank=rank, seed=seed, env_id=env_id, **kwargs)()
 
     # noinspection PyMethodOverriding
     @classmethod
@@ -112,6 +134,7 @@ class Trainer(trainer.Trainer):
             min_lines = min_eval_lines
             max_lines = max_eval_lines
         data_types.WORLD_SIZE = world_size
+        data_types.precompute_tables()
         mp_kwargs = dict()
         return super().make_vec_envs(
             mp_kwargs=mp_kwargs,
@@ -123,8 +146,19 @@ class Trainer(trainer.Trainer):
             **kwargs,
         )
 
+    @staticmethod
+    def restore_failure_buffer(failure_buffer: Queue, items: list):
+        for x in items:
+            try:
+                failure_buffer.put_nowait(x)
+            except Full:
+                break
+        print(f"Restored failure buffer of length {failure_buffer.qsize()}")
+
     @classmethod
     def structure_config(cls, cfg: DictConfig) -> Dict[str, any]:
+        if cfg.bf16 and not our_agent.bf16_available():
+            raise ValueError("bf16=true needs CPU autocast (torch >= 1.10).")
         if cfg.eval.interval:
             cfg.eval.steps = 5 * cfg.max_eval_lines
         return super().structure_config(cfg)
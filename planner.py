@@ -0,0 +1,123 @@
+"""
+Splits this process's cores between a learner and its env workers. The learner gets
+whole physical cores (one intra-op thread each, so that hyperthreads do not contend
+for the same ALUs) and each env worker, a single-threaded Python loop, gets a logical
+core of its own. `Trainer.run` applies the plan at startup instead of running every
+process single-threaded on every core.
+"""
+import math
+import os
+from collections import defaultdict, namedtuple
+from pathlib import Path
+from typing import Dict, List, Optional
+
+
+class Plan(
+    namedtuple("Plan", "learner_cores learner_threads envs_per_worker worker_cores")
+):
+    """
+    `worker_cores` has the affinity mask of each env worker; it is empty when the envs
+    step in the learner's process. `envs_per_worker` is None in that case too.
+    """
+
+    def items(self) -> Dict[str, float]:
+        return {
+            "learner threads": self.learner_threads,
+            "learner cores": len(self.learner_cores),
+            "env workers": len(self.worker_cores),
+            "envs per worker": self.envs_per_worker or 0,
+        }
+
+    def pin(self):
+        """
+        Restricts this process to the learner's cores. Processes that it starts
+        inherit the mask until they set their own (see `env_worker.work`).
+        """
+        try:
+            os.sched_setaffinity(0, self.learner_cores)
+        except AttributeError:  # not Linux
+            pass
+
+
+def available_cores() -> List[int]:
+    try:
+        return sorted(os.sched_getaffinity(0))
+    except AttributeError:  # not Linux
+        return list(range(os.cpu_count() or 1))
+
+
+# before any plan pins this process, so that later runs in it can plan all its cores
+CORES = available_cores()
+
+
+def physical_cores(cores: List[int]) -> List[List[int]]:
+    """
+    Groups logical `cores` that are hyperthreads of the same physical core, as listed
+    in sysfs. Without sysfs, every logical core counts as a physical one.
+    """
+    siblings = defaultdict(list)
+    for core in cores:
+        topology = Path(f"/sys/devices/system/cpu/cpu{core}/topology")
+        try:
+            package = Path(topology, "physical_package_id").read_text().strip()
+            core_id = Path(topology, "core_id").read_text().strip()
+        except OSError:
+            package, core_id = None, core
+        siblings[package, core_id].append(core)
+    return list(siblings.values())
+
+
+def plan(
+    num_envs: int,
+    synchronous: bool,
+    envs_per_worker: Optional[int] = None,
+    num_learners: int = 1,
+    learner_rank: int = 0,
+    cores: Optional[List[int]] = None,
+    learner_share: float = 0.25,
+) -> Plan:
+    """
+    Plans the cores (by default, `CORES`) of learner `learner_rank`, which steps
+    `num_envs` envs. Data-parallel learners split the cores evenly. Unless
+    `envs_per_worker` is given, the learner takes `learner_share` of the physical
+    cores and the env workers one logical core each of the rest.
+    """
+    cores = CORES if cores is None else sorted(cores)
+    per_learner = max(len(cores) // num_learners, 1)
+    first = learner_rank * per_learner
+    cores = cores[first : first + per_learner] or cores
+    physical = physical_cores(cores)
+    if synchronous or num_envs == 1:
+        return Plan(cores, len(physical), None, [])
+
+    if envs_per_worker is None:
+        num_learner_cores = max(int(len(physical) * learner_share), 1)
+    else:
+        # give each worker a logical core, taking physical cores from the end
+        num_workers = math.ceil(num_envs / envs_per_worker)
+        num_worker_cores = num_logical = 0
+        for core in reversed(physical):
+            if num_logical >= num_workers:
+                break
+            num_worker_cores += 1
+            num_logical += len(core)
+        num_learner_cores = max(len(physical) - num_worker_cores, 1)
+    learner = physical[:num_learner_cores]
+    # with a single physical core, the learner and the workers share it
+    workers = physical[num_learner_cores:] or learner
+    worker_logical = [c for core in workers for c in core]
+
+    if envs_per_worker is None:
+        envs_per_worker = math.ceil(num_envs / min(num_envs, len(worker_logical)))
+    num_workers = math.ceil(num_envs / envs_per_worker)
+    if num_workers > len(worker_logical):
+        # oversubscribed: let the scheduler balance the workers over all their cores
+        worker_cores = [worker_logical] * num_workers
+    else:
+        worker_cores = [[c] for c in worker_logical[:num_workers]]
+    return Plan(
+        learner_cores=[c for core in learner for c in core],
+        learner_threads=len(learner),
+        envs_per_worker=envs_per_worker,
+        worker_cores=worker_cores,
+    )
@@ -1,15 +1,24 @@
 # third party
 import collections
+from typing import Optional
 
 import torch
+import torch.distributed as dist
 import torch.nn as nn
-import torch.nn.functional as F
 import torch.optim as optim
 
-from agents import Agent
+from agents import Agent, AgentStack
+from profiler import PROFILER
 from rollouts import Batch, RolloutStorage
 
 
+def masked_mean(x: torch.Tensor, valid: Optional[torch.Tensor]) -> torch.Tensor:
+    # the mean over the rows that were collected (see `RolloutStorage.valid`)
+    if valid is None:
+        return x.mean()
+    return (x * valid).sum() / valid.sum().clamp(min=1)
+
+
 class PPO:
     def __init__(
         self,
@@ -23,9 +32,11 @@ class PPO:
         max_grad_norm: float,
         use_clipped_value_loss: bool = True,
         aux_loss_only: bool = False,
+        allreduce_advantages: bool = False,
     ):
 
         self.aux_loss_only = aux_loss_only
+        self.allreduce_advantages = allreduce_advantages
         self.agent = agent
 
         self.clip_param = clip_param
@@ -41,32 +52,115 @@ class PPO:
         self.optimizer = optimizer(agent.parameters(), lr=learning_rate)
         self.reward_function = None
 
-    def update(self, rollouts: RolloutStorage):
-        advantages = rollouts.returns[:-1] - rollouts.value_preds[:-1]
+    def allreduce_gradients(self):
+        # average gradients across data-parallel learners with one flat allreduce
+        params = [p for p in self.agent.parameters() if p.requires_grad]
+        for p in params:
+            if p.grad is None:
+                p.grad = torch.zeros_like(p)
+        flat = torch.cat([p.grad.view(-1) for p in params]).cpu()
+        dist.all_reduce(flat)
+        flat /= dist.get_world_size()
+        offset = 0
+        for p in params:
+            numel = p.grad.numel()
+            p.grad.copy_(flat[offset : offset + numel].view_as(p.grad))
+            offset += numel
+
+    def broadcast_parameters(self):
+        for tensor in self.agent.state_dict().values():
+            synced = tensor.cpu()
+            dist.broadcast(synced, src=0)
+            tensor.copy_(synced)
+
+    def normalize_advantages(self, advantages, valid: Optional[torch.Tensor] = None):
+        # statistics over the rows that were collected, if `valid` is given
+        if self.allreduce_advantages and dist.is_initialized():
+            weights = torch.ones_like(advantages) if valid is None else valid
+            stats = torch.stack(
+                [
+                    (advantages * weights).sum(),
+                    (advantages.pow(2) * weights).sum(),
+                    weights.sum(),
+                ]
+            ).cpu()
+            dist.all_reduce(stats)
+            total, squares, n = stats.tolist()
+            mean = total / n
+            std = max(squares / n - mean ** 2, 0) ** 0.5
+            return (advantages - mean) / (std + 1e-5)
+        if valid is not None:
+            n = valid.sum()
+            if n > 1:
+                mean = (advantages * valid).sum() / n
+                std = ((advantages - mean).pow(2) * valid).sum().div(n - 1).sqrt()
+                advantages = (advantages - mean) / (std + 1e-5)
+            return advantages
         if advantages.numel() > 1:
             advantages = (advantages - advantages.mean()) / (advantages.std() + 1e-5)
+        return advantages
+
+    def proximal_importance_weighting(self, rollouts: RolloutStorage):
+        # The rollouts were collected by a stale copy of the agent. Re-anchor the
+        # PPO ratio at the current (proximal) policy and correct for the behavior
+        # policy with an importance weight clipped to PPO's trust region.
+        num_steps, num_processes = rollouts.rewards.size()[0:2]
+        if self.agent.is_recurrent:
+            rnn_hxs = rollouts.recurrent_hidden_states[0]
+        else:
+            rnn_hxs = rollouts.recurrent_hidden_states[:-1].view(
+                num_steps * num_processes, -1
+            )
+        with torch.no_grad():
+            act = self.agent(
+                inputs=rollouts.obs[:-1].view(-1, *rollouts.obs.size()[2:]),
+                rnn_hxs=rnn_hxs,
+                masks=rollouts.masks[:-1].view(-1, 1),
+                action=rollouts.actions.view(-1, rollouts.actions.size(-1)),
+            )
+        proximal_log_probs = act.action_log_probs.view(num_steps, num_processes, 1)
+        importance_weighting = torch.exp(
+            proximal_log_probs - rollouts.action_log_probs
+        ).clamp(1.0 - self.clip_param, 1.0 + self.clip_param)
+        rollouts.action_log_probs.copy_(proximal_log_probs)
+        return importance_weighting
+
+    def update(
+        self, rollouts: RolloutStorage, policy_lag: int = 0, proximal: bool = False
+    ):
+        # proximal: the rollouts were collected by a different (e.g. quantized)
+        # copy of the agent, even with no policy lag
+        valid = None if rollouts.valid.all() else rollouts.valid
+        advantages = self.normalize_advantages(
+            rollouts.returns[:-1] - rollouts.value_preds[:-1], valid
+        )
 
         logger = collections.Counter()
+        importance_weighting = None
+        if policy_lag or proximal:
+            with PROFILER.span("proximal"):
+                importance_weighting = self.proximal_importance_weighting(rollouts)
 
         for e in range(self.ppo_epoch):
             if self.agent.is_recurrent:
                 data_generator = rollouts.recurrent_generator(
-                    advantages, self.num_mini_batch
+                    advantages, self.num_mini_batch, importance_weighting
                 )
             else:
                 data_generator = rollouts.feed_forward_generator(
-                    advantages, self.num_mini_batch
+                    advantages, self.num_mini_batch, importance_weighting
                 )
 
             sample: Batch
-            for sample in data_generator:
+            for sample in PROFILER.iterate("batch", data_generator):
                 # Reshape to do in a single forward pass for all steps
-                act = self.agent(
-                    inputs=sample.obs,
-                    rnn_hxs=sample.recurrent_hidden_states,
-                    masks=sample.masks,
-                    action=sample.actions,
-                )
+                with PROFILER.span("forward"):
+                    act = self.agent(
+                        inputs=sample.obs,
+                        rnn_hxs=sample.recurrent_hidden_states,
+                        masks=sample.masks,
+                        action=sample.actions,
+                    )
                 values = act.value
                 action_log_probs = act.action_log_probs
                 loss = act.aux_loss
@@ -74,13 +168,16 @@ class PPO:
                 # logger.update(**log_values)
 
                 if not self.aux_loss_only:
+                    adv = sample.adv
+                    if sample.importance_weighting is not None:
+                        adv = sample.importance_weighting * adv
                     ratio = torch.exp(action_log_probs - sample.old_action_log_probs)
-                    surr1 = ratio * sample.adv
+                    surr1 = ratio * adv
                     surr2 = (
                         torch.clamp(ratio, 1.0 - self.clip_param, 1.0 + self.clip_param)
-                        * sample.adv
+                        * adv
                     )
-                    action_loss = -torch.min(surr1, surr2).mean()
+                    action_loss = -masked_mean(torch.min(surr1, surr2), sample.valid)
                     logger.update(action_loss=action_loss)
                     loss += action_loss
 
@@ -91,22 +188,68 @@ class PPO:
                     ).clamp(-self.clip_param, self.clip_param)
                     value_losses = (values - sample.ret).pow(2)
                     value_losses_clipped = (value_pred_clipped - sample.ret).pow(2)
-                    value_loss = (
-                        0.5 * torch.max(value_losses, value_losses_clipped).mean()
+                    value_loss = 0.5 * masked_mean(
+                        torch.max(value_losses, value_losses_clipped), sample.valid
                     )
                 else:
-                    value_loss = 0.5 * F.mse_loss(sample.ret, values)
+                    value_loss = 0.5 * masked_mean(
+                        (values - sample.ret).pow(2), sample.valid
+                    )
                 logger.update(value_loss=value_loss)
                 loss += self.value_loss_coef * value_loss
 
-                self.optimizer.zero_grad()
-                loss.backward()
+                with PROFILER.span("backward"):
+                    self.optimizer.zero_grad()
+                    loss.backward()
+                if dist.is_initialized():
+                    with PROFILER.span("allreduce"):
+                        self.allreduce_gradients()
 
-                nn.utils.clip_grad_norm_(self.agent.parameters(), self.max_grad_norm)
-                self.optimizer.step()
+                with PROFILER.span("optimizer step"):
+                    nn.utils.clip_grad_norm_(
+                        self.agent.parameters(), self.max_grad_norm
+                    )
+                    self.optimizer.step()
 
                 # noinspection PyTypeChecker
                 logger.update(n=1.0)
 
         n = logger.pop("n", 0)
-        return {k: v.mean().item() / n for k, v in logger.items()}
+        results = {k: v.mean().item() / n for k, v in logger.items()}
+        if importance_weighting is not None:
+            results.update(importance_weighting=importance_weighting.mean().item())
+        return results
+
+
+class Optimizers(list):
+    def load_state_dict(self, state_dicts: list):
+        for optimizer, state_dict in zip(self, state_dicts):
+            optimizer.load_state_dict(state_dict)
+
+    def state_dict(self) -> list:
+        return [optimizer.state_dict() for optimizer in self]
+
+
+class MultiSeedPPO:
+    """
+    A `PPO` (with its own optimizer) per agent of an `AgentStack`, each updating on
+    its agent's slice of the envs. Results are reported per seed.
+    """
+
+    def __init__(self, agent: AgentStack, **ppo_args):
+        self.agent = agent
+        self.ppos = [PPO(agent=a, **ppo_args) for a in agent.agents]
+        self.optimizer = Optimizers(ppo.optimizer for ppo in self.ppos)
+
+    def update(
+        self, rollouts: RolloutStorage, policy_lag: int = 0, proximal: bool = False
+    ):
+        results = {}
+        for s, (ppo, seed_rollouts) in enumerate(
+            zip(self.ppos, rollouts.split(len(self.ppos)))
+        ):
+            for k, v in ppo.update(
+                seed_rollouts, policy_lag=policy_lag, proximal=proximal
+            ).items():
+                results[f"seed {s}/{k}"] = v
+        return results
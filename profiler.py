@@ -0,0 +1,145 @@
+import contextlib
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+from pathlib import Path
+from typing import Dict, Generator, Iterable, Iterator, Optional, Tuple, TypeVar
+
+T = TypeVar("T")
+
+TRACE_NAME = "trace.json"
+NULL_SPAN = contextlib.nullcontext()
+
+
+class Profiler:
+    """
+    Nested timing spans. Disabled, `span` returns a shared no-op context manager, so
+    instrumentation can stay on the hot path. Enabled, span totals are kept per
+    process for `items`, and with a `trace_dir` every span is also recorded as a
+    Chrome trace event. Each process (including env workers) writes its own events,
+    and `export` merges them into one `trace.json`. Workers are enabled with
+    `settings` (forked ones inherit them anyway) and hand their totals over with
+    `take`, for the parent to `merge`.
+    """
+
+    flush_every = 10000
+
+    def __init__(self):
+        self.enabled = False
+        self.trace_dir = None  # type: Optional[Path]
+        self.clear()
+        os.register_at_fork(after_in_child=self.clear)
+
+    def clear(self):
+        self.totals = defaultdict(float)
+        self.events = []
+        self.local = threading.local()
+        # spans end on the acting thread and, with async updates, the update thread
+        self.lock = threading.Lock()
+
+    def configure(self, enabled: bool, trace_dir: Optional[Path]):
+        if enabled:
+            self.enable(trace_dir)
+
+    def enable(self, trace_dir: Optional[Path] = None):
+        self.enabled = True
+        if trace_dir is not None:
+            self.trace_dir = Path(trace_dir)
+            self.trace_dir.mkdir(parents=True, exist_ok=True)
+
+    def export(self) -> Optional[Path]:
+        if self.trace_dir is None:
+            return None
+        self.flush()
+        events = []
+        for path in self.trace_dir.glob("trace-*.jsonl"):
+            with path.open() as f:
+                events.extend(json.loads(line) for line in f)
+        path = Path(self.trace_dir, TRACE_NAME)
+        with path.open("w") as f:
+            json.dump(dict(traceEvents=events), f)
+        return path
+
+    def flush(self):
+        with self.lock:
+            events, self.events = self.events, []
+        if self.trace_dir is None or not events:
+            return
+        with Path(self.trace_dir, f"trace-{os.getpid()}.jsonl").open("a") as f:
+            for event in events:
+                f.write(json.dumps(event) + "\n")
+
+    def items(self) -> Generator[Tuple[str, float], None, None]:
+        with self.lock:
+            totals = sorted(self.totals.items())
+        for k, v in totals:
+            yield f"profile {k}", v
+
+    def iterate(self, name: str, iterable: Iterable[T]) -> Iterator[T]:
+        # times each `next` of `iterable`, e.g. batch assembly in a data generator
+        iterator = iter(iterable)
+        while True:
+            with self.span(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def merge(self, totals: Dict[str, float], prefix: str):
+        with self.lock:
+            for k, v in totals.items():
+                self.totals[prefix + k] += v
+
+    def reset(self):
+        self.take()
+
+    def settings(self) -> dict:
+        return dict(enabled=self.enabled, trace_dir=self.trace_dir)
+
+    def take(self) -> Dict[str, float]:
+        # the totals since the last `take` or `reset`
+        with self.lock:
+            totals, self.totals = self.totals, defaultdict(float)
+        return dict(totals)
+
+    def span(self, name: str):
+        if not self.enabled:
+            return NULL_SPAN
+        return self.record(name)
+
+    @contextlib.contextmanager
+    def record(self, name: str):
+        try:
+            stack = self.local.stack
+        except AttributeError:
+            stack = self.local.stack = []
+        stack.append(name)
+        key = "/".join(stack)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            end = time.perf_counter()
+            stack.pop()
+            with self.lock:
+                self.totals[key] += end - start
+                if self.trace_dir is not None:
+                    self.events.append(
+                        dict(
+                            name=name,
+                            ph="X",
+                            ts=start * 1e6,
+                            dur=(end - start) * 1e6,
+                            pid=os.getpid(),
+                            tid=threading.get_ident(),
+                        )
+                    )
+                full = len(self.events) >= self.flush_every
+            if full:
+                self.flush()
+
+
+PROFILER = Profiler()
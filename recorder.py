@@ -0,0 +1,395 @@
+"""
+Records a sample of episodes in the format that the scripts in `analysis/` read.
+
+Whether an episode is recorded is decided (with probability `rate`) when it starts.
+The acting thread only copies the recorded envs' rows off the device and puts them
+on a bounded queue; a writer thread appends them to fixed-size chunks of
+memory-mapped `.npy` columns in `{prefix}trajectories/`, one sequence of chunks per
+stream of `STREAMS`:
+
+- `steps`: every step of a recorded episode (its episode id, the pointer that the
+  agent acted on and the action);
+- `episodes`: every finished episode's id, success, number of instruction lines and
+  whether the agent logged a P for it;
+- `lines`: the (line type, value) rows of those instructions;
+- `P`: those Ps (at each episode's first step), raveled.
+
+`index.json` lists how many rows of each chunk had been written at the last `flush`.
+Rows after those (e.g. from a preempted run) are overwritten when recording resumes.
+`export` (called when a recorder is opened and closed) writes the listed episodes to
+`{prefix}instruction.npz`, `{prefix}successes.npy` and `{prefix}P.npz`, and their ids
+to `{prefix}trajectories/episodes.npy`.
+
+A full queue blocks the acting thread instead of dropping steps. If writing fails,
+the writer discards whatever is queued after that, and `step`, `flush` and `close`
+raise.
+"""
+import json
+import os
+import threading
+import zipfile
+from dataclasses import astuple
+from pathlib import Path
+from queue import Queue
+from typing import Dict, Generator, Iterable, List, Optional, Sequence, Union
+
+import numpy as np
+import torch
+from gym import spaces
+
+from agents import AgentOutputs
+from data_types import Obs
+from env_worker import InfoBatch
+
+INDEX_NAME = "index.json"
+STREAMS = dict(
+    steps=("episode", "ptr", "action"),
+    episodes=("id", "success", "lines", "P"),
+    lines=("line",),
+    P=("P",),
+)
+
+
+def obs_slices(observation_space: spaces.Dict) -> Obs:
+    # the flattened observation concatenates the fields of Obs in order
+    sizes = [int(np.prod(s.shape)) for s in astuple(Obs(**observation_space.spaces))]
+    ends = np.cumsum(sizes)
+    return Obs(*(slice(int(e - s), int(e)) for s, e in zip(sizes, ends)))
+
+
+def chunk_path(directory: Path, stream: str, i: int, column: str) -> Path:
+    return Path(directory, f"{stream}.{i:05d}.{column}.npy")
+
+
+def load_index(directory: Path) -> dict:
+    path = Path(directory, INDEX_NAME)
+    if not path.exists():
+        lengths = {stream: [] for stream in STREAMS}
+        return dict(lengths=lengths, started=0, P_shape=None)
+    with path.open() as f:
+        return json.load(f)
+
+
+def chunks(
+    directory: Path, stream: str, column: str, lengths: List[int]
+) -> Generator[np.ndarray, None, None]:
+    # the written rows of each chunk of a column, memory-mapped
+    for i, length in enumerate(lengths):
+        yield np.load(chunk_path(directory, stream, i, column), mmap_mode="r")[:length]
+
+
+def read(directory: Path, stream: str) -> Dict[str, np.ndarray]:
+    """
+    The rows of `stream` in `directory` (a `trajectories/` directory) as of its last
+    `flush`, as one array per column.
+    """
+    lengths = load_index(directory)["lengths"][stream]
+    return {
+        k: np.concatenate(list(chunks(directory, stream, k, lengths)))
+        for k in STREAMS[stream]
+    }
+
+
+def split(
+    chunks: Iterable[np.ndarray], sizes: Iterable[int], empty: np.ndarray
+) -> Generator[np.ndarray, None, None]:
+    # consecutive runs of `sizes` rows, which may span chunks
+    chunks = iter(chunks)
+    chunk = empty
+    for size in sizes:
+        parts = []
+        while size:
+            if not len(chunk):
+                chunk = next(chunks)
+                continue
+            parts.append(chunk[:size])
+            chunk = chunk[len(parts[-1]) :]
+            size -= len(parts[-1])
+        yield np.concatenate(parts) if parts else empty
+
+
+def write_atomically(path: Path, array: np.ndarray):
+    temporary = path.with_suffix(f".{os.getpid()}.tmp")
+    with temporary.open("wb") as f:
+        np.save(f, array)
+    os.replace(temporary, path)  # readers never see a partial file
+
+
+def write_archive(path: Path, arrays: Iterable[np.ndarray]):
+    # like np.savez, one array at a time
+    temporary = path.with_suffix(f".{os.getpid()}.tmp")
+    with zipfile.ZipFile(temporary, "w") as archive:
+        for i, array in enumerate(arrays):
+            with archive.open(f"arr_{i}.npy", "w", force_zip64=True) as f:
+                np.lib.format.write_array(f, np.asanyarray(array))
+    os.replace(temporary, path)  # readers never see a partial archive
+
+
+def export(log_dir: Path, prefix: str = ""):
+    """
+    Writes the episodes that `{prefix}trajectories/` lists to the files that
+    `analysis/store.py` reads, streaming the instructions and Ps from their chunks.
+    """
+    directory = Path(log_dir, prefix + "trajectories")
+    index = load_index(directory)
+    lengths = index["lengths"]
+    if not lengths["episodes"]:
+        return
+    episodes = read(directory, "episodes")
+    lines = split(
+        chunks(directory, "lines", "line", lengths["lines"]),
+        episodes["lines"],
+        empty=np.zeros((0, 2), dtype=np.int64),
+    )
+    write_archive(Path(log_dir, prefix + "instruction.npz"), lines)
+    if len(episodes["P"]) and episodes["P"].all():
+        shape = index["P_shape"]
+        Ps = split(
+            chunks(directory, "P", "P", lengths["P"]),
+            np.full(len(episodes["P"]), int(np.prod(shape))),
+            empty=np.zeros(0, dtype=np.float32),
+        )
+        # analyze_P squeezes the first axis
+        write_archive(
+            Path(log_dir, prefix + "P.npz"), (P.reshape(1, *shape) for P in Ps)
+        )
+    write_atomically(Path(directory, "episodes.npy"), episodes["id"])
+    # last: `analysis/store.py` finds runs by their instruction.npz and reads as many
+    # episodes as successes.npy lists
+    write_atomically(Path(log_dir, prefix + "successes.npy"), episodes["success"])
+
+
+class TrajectoryRecorder:
+    def __init__(
+        self,
+        log_dir: Path,
+        observation_space: spaces.Dict,
+        rate: float,
+        seed: int,
+        prefix: str = "",
+        chunk_rows: int = 2 ** 16,
+        queue_size: int = 1024,
+    ):
+        self.log_dir = Path(log_dir)
+        self.prefix = prefix
+        self.rate = rate
+        self.slices = obs_slices(observation_space)
+        self.lines_shape = observation_space.spaces["lines"].shape
+        self.random = np.random.RandomState(seed)
+        self.chunk_rows = chunk_rows
+        self.directory = Path(log_dir, prefix + "trajectories")
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+        # append to what an earlier (e.g. preempted) run flushed, and bring the
+        # exported files in line with it
+        index = load_index(self.directory)
+        self.lengths = index["lengths"]  # type: Dict[str, List[int]]
+        self.started = index["started"]  # ids given to episodes so far
+        self.P_shape = index["P_shape"]  # type: Optional[List[int]]
+        export(self.log_dir, self.prefix)
+
+        # per env, set by `start`
+        self.recording = np.zeros(0, dtype=np.int64)  # episode id, or -1
+        self.first = np.zeros(0, dtype=bool)  # no step recorded yet
+        self.ptr = np.zeros(0, dtype=np.int64)  # pointer the agent acts on
+        self.instructions = {}  # type: Dict[int, np.ndarray]
+        self.Ps = {}  # type: Dict[int, np.ndarray]
+
+        # per stream, used by the writer thread; open a new chunk on the first row
+        self.chunks = {}  # type: Dict[str, Dict[str, np.ndarray]]
+        self.positions = {stream: chunk_rows for stream in STREAMS}
+
+        self.error = None  # type: Optional[Exception]
+        self.queue = Queue(maxsize=queue_size)
+        self.thread = threading.Thread(target=self.work, daemon=True)
+        self.thread.start()
+
+    def check(self):
+        if self.error is not None:
+            raise RuntimeError("Recording trajectories failed.") from self.error
+
+    def start(self, obs: torch.Tensor):
+        """
+        Starts an episode in every env, e.g. after `envs.reset()`. Episodes that were
+        being recorded are abandoned.
+        """
+        num_envs = len(obs)
+        self.recording = np.full(num_envs, -1, dtype=np.int64)
+        self.first = np.zeros(num_envs, dtype=bool)
+        self.ptr = np.zeros(num_envs, dtype=np.int64)
+        self.instructions.clear()
+        self.Ps.clear()
+        self.begin(obs, np.ones(num_envs, dtype=bool))
+
+    def begin(self, obs: torch.Tensor, starting: np.ndarray):
+        # samples which of the episodes that start in the `starting` envs to record
+        sampled = starting & (self.random.random_sample(len(starting)) < self.rate)
+        self.recording[starting] = -1
+        index = np.flatnonzero(sampled)
+        if not len(index):
+            return
+        self.recording[index] = self.started + np.arange(len(index))
+        self.started += len(index)
+        self.first[index] = True
+        rows = obs[torch.from_numpy(index)].cpu().numpy()
+        lines = rows[:, self.slices.lines].reshape(-1, *self.lines_shape)
+        padding = rows[:, self.slices.line_mask].astype(bool)
+        for i, l, p in zip(index, lines, padding):
+            self.instructions[i] = l[~p].astype(np.int64)
+
+    @staticmethod
+    def successes(
+        infos: Union[Sequence[dict], InfoBatch], index: np.ndarray
+    ) -> np.ndarray:
+        # the "success" info of the envs in `index`, False where there is none
+        if isinstance(infos, InfoBatch):
+            if "success" not in infos.keys:
+                return np.zeros(len(index), dtype=bool)
+            values = infos.values[index, list(infos.keys).index("success")]
+            return np.nan_to_num(values).astype(bool)  # NaN where not reported
+        return np.array([bool(infos[i].get("success", False)) for i in index])
+
+    def step(
+        self,
+        act: AgentOutputs,
+        obs: torch.Tensor,
+        done: np.ndarray,
+        infos: Union[Sequence[dict], InfoBatch],
+    ):
+        """
+        Records the step that `act` took in each recorded env, given what the envs
+        returned for it. Where `done`, `obs` starts a new episode.
+        """
+        self.check()
+        done = done.astype(bool)
+        index = np.flatnonzero(self.recording >= 0)
+        if len(index):
+            rows = torch.from_numpy(index)
+            self.queue.put(
+                (
+                    "steps",
+                    dict(
+                        episode=self.recording[index],
+                        ptr=self.ptr[index],
+                        action=act.action[rows].cpu().numpy(),
+                    ),
+                )
+            )
+            P = act.log.get("P")
+            first = index[self.first[index]]
+            if P is not None and len(first):
+                P = P[torch.from_numpy(first)].float().cpu().numpy()
+                for i, P_i in zip(first, P):
+                    self.Ps[i] = P_i
+            self.first[index] = False
+            ended = index[done[index]]
+            for i, success in zip(ended, self.successes(infos, ended)):
+                self.queue.put(
+                    (
+                        "episode",
+                        self.recording[i],
+                        self.instructions.pop(i),
+                        success,
+                        self.Ps.pop(i, None),
+                    )
+                )
+        self.begin(obs, done)
+        index = np.flatnonzero(self.recording >= 0)
+        if len(index):
+            ptr = obs[torch.from_numpy(index), self.slices.ptr].cpu().numpy()
+            self.ptr[index] = ptr.ravel()
+
+    def flush(self):
+        # makes what was queued so far durable, on the writer thread
+        self.check()
+        self.queue.put(("flush", self.started))
+
+    def close(self):
+        self.queue.put(("flush", self.started))
+        self.queue.put(None)
+        self.thread.join()
+        self.check()
+        export(self.log_dir, self.prefix)
+
+    def work(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            if self.error is not None:
+                continue  # keep draining, so that `step` never blocks
+            kind, *args = item
+            try:
+                if kind == "steps":
+                    (columns,) = args
+                    self.append("steps", columns)
+                elif kind == "episode":
+                    self.write_episode(*args)
+                elif kind == "flush":
+                    (started,) = args
+                    for chunk in self.chunks.values():
+                        for column in chunk.values():
+                            column.flush()
+                    self.write_index(started)
+            except Exception as e:
+                print(f"Failed to record trajectories: {e!r}")
+                self.error = e
+
+    def write_episode(
+        self, i: int, instruction: np.ndarray, success: bool, P: Optional[np.ndarray]
+    ):
+        self.append("lines", dict(line=instruction))
+        if P is not None:
+            self.P_shape = list(P.shape)
+            self.append("P", dict(P=P.ravel()))
+        self.append(
+            "episodes",
+            dict(
+                id=np.array([i], dtype=np.int64),
+                success=np.array([success], dtype=bool),
+                lines=np.array([len(instruction)], dtype=np.int64),
+                P=np.array([P is not None]),
+            ),
+        )
+
+    def append(self, stream: str, columns: Dict[str, np.ndarray]):
+        num_rows = len(next(iter(columns.values())))
+        written = 0
+        while written < num_rows:
+            if self.positions[stream] == self.chunk_rows:
+                self.open_chunk(stream, columns)
+            position = self.positions[stream]
+            n = min(num_rows - written, self.chunk_rows - position)
+            for k, column in self.chunks[stream].items():
+                column[position : position + n] = columns[k][written : written + n]
+            self.positions[stream] = self.lengths[stream][-1] = position + n
+            written += n
+
+    def open_chunk(self, stream: str, columns: Dict[str, np.ndarray]):
+        for column in self.chunks.get(stream, {}).values():
+            column.flush()
+        i = len(self.lengths[stream])
+        self.lengths[stream].append(0)
+        self.positions[stream] = 0
+        self.chunks[stream] = {
+            k: np.lib.format.open_memmap(
+                chunk_path(self.directory, stream, i, k),
+                mode="w+",
+                dtype=column.dtype,
+                shape=(self.chunk_rows, *column.shape[1:]),
+            )
+            for k, column in columns.items()
+        }
+
+    def write_index(self, started: int):
+        path = Path(self.directory, INDEX_NAME)
+        temporary = path.with_suffix(f".{os.getpid()}.tmp")
+        with temporary.open("w") as f:
+            index = dict(
+                chunk_rows=self.chunk_rows,
+                lengths=self.lengths,
+                started=started,
+                P_shape=self.P_shape,
+            )
+            json.dump(index, f)
+        os.replace(temporary, path)
@@ -1,6 +1,7 @@
 # third party
+import copy
 from collections import namedtuple
-from typing import Generator
+from typing import Generator, List
 import gym
 from gym import spaces
 import numpy as np
@@ -16,7 +17,7 @@ def _flatten_helper(T, N, _tensor):
 Batch = namedtuple(
     "Batch",
     "obs recurrent_hidden_states actions value_preds ret "
-    "masks old_action_log_probs adv tasks importance_weighting",
+    "masks old_action_log_probs adv tasks importance_weighting valid",
 )
 
 
@@ -60,6 +61,8 @@ class RolloutStorage(object):
         if isinstance(action_space, (spaces.Discrete, spaces.MultiDiscrete)):
             self.actions = self.actions.long()
         self.masks = torch.ones(num_steps + 1, num_processes, 1)
+        # rows that were collected; see `Trainer.collect_async`
+        self.valid = torch.ones(num_steps, num_processes, 1)
 
         self.num_steps = num_steps
         self.step = 0
@@ -73,6 +76,7 @@ class RolloutStorage(object):
         self.action_log_probs = self.action_log_probs.to(device)
         self.actions = self.actions.to(device)
         self.masks = self.masks.to(device)
+        self.valid = self.valid.to(device)
 
     def insert(
         self,
@@ -93,33 +97,55 @@ class RolloutStorage(object):
         self.masks[self.step + 1].copy_(masks)
         self.step = (self.step + 1) % self.num_steps
 
+    def split(self, n: int) -> List["RolloutStorage"]:
+        """
+        `n` storages, each a contiguous copy of a consecutive slice of the envs.
+        """
+        splits = []
+        for i in range(n):
+            storage = copy.copy(self)
+            for name, tensor in vars(self).items():
+                if isinstance(tensor, torch.Tensor):
+                    setattr(storage, name, tensor.chunk(n, dim=1)[i].contiguous())
+            splits.append(storage)
+        return splits
+
     def after_update(self):
         self.obs[0].copy_(self.obs[-1])
         self.recurrent_hidden_states[0].copy_(self.recurrent_hidden_states[-1])
         self.masks[0].copy_(self.masks[-1])
 
     def compute_returns(self, next_value):
+        # An env whose rows stop early has its last observation in obs[-1], so
+        # `next_value` is passed back through the rows it did not fill.
+        valid = self.valid > 0
         if self.use_gae:
             self.value_preds[-1] = next_value
             gae = 0
             for step in reversed(range(self.rewards.size(0))):
+                self.value_preds[step] = torch.where(
+                    valid[step], self.value_preds[step], self.value_preds[step + 1]
+                )
                 delta = (
                     self.rewards[step]
                     + self.gamma * self.value_preds[step + 1] * self.masks[step + 1]
                     - self.value_preds[step]
                 )
                 gae = delta + self.gamma * self.tau * self.masks[step + 1] * gae
+                gae = gae * self.valid[step]
                 self.returns[step] = gae + self.value_preds[step]
         else:
             self.returns[-1] = next_value
             for step in reversed(range(self.rewards.size(0))):
-                self.returns[step] = (
+                self.returns[step] = torch.where(
+                    valid[step],
                     self.returns[step + 1] * self.gamma * self.masks[step + 1]
-                    + self.rewards[step]
+                    + self.rewards[step],
+                    self.returns[step + 1],
                 )
 
     def feed_forward_generator(
-        self, advantages, num_batch
+        self, advantages, num_batch, importance_weighting=None
     ) -> Generator[Batch, None, None]:
         num_steps, num_processes = self.rewards.size()[0:2]
         total_batch_size = num_processes * num_steps
@@ -138,9 +164,9 @@ class RolloutStorage(object):
         assert len(sampler) == num_batch
         for indices in sampler:
             assert len(indices) == mini_batch_size
-            yield self.make_batch(advantages, indices)
+            yield self.make_batch(advantages, indices, importance_weighting)
 
-    def make_batch(self, advantages, indices):
+    def make_batch(self, advantages, indices, importance_weighting=None):
         obs_batch = self.obs[:-1].view(-1, *self.obs.size()[2:])[indices]
         recurrent_hidden_states_batch = self.recurrent_hidden_states[:-1].view(
             -1, self.recurrent_hidden_states.size(-1)
@@ -151,6 +177,9 @@ class RolloutStorage(object):
         masks_batch = self.masks[:-1].view(-1, 1)[indices]
         old_action_log_probs_batch = self.action_log_probs.view(-1, 1)[indices]
         adv_targ = advantages.view(-1, 1)[indices]
+        if importance_weighting is not None:
+            importance_weighting = importance_weighting.view(-1, 1)[indices]
+        valid_batch = None if self.valid.all() else self.valid.view(-1, 1)[indices]
         batch = Batch(
             obs=obs_batch,
             recurrent_hidden_states=recurrent_hidden_states_batch,
@@ -161,12 +190,13 @@ class RolloutStorage(object):
             old_action_log_probs=old_action_log_probs_batch,
             adv=adv_targ,
             tasks=None,
-            importance_weighting=None,
+            importance_weighting=importance_weighting,
+            valid=valid_batch,
         )
         return batch
 
     def recurrent_generator(
-        self, advantages, num_mini_batch
+        self, advantages, num_mini_batch, importance_weighting=None
     ) -> Generator[Batch, None, None]:
         num_processes = self.rewards.size(1)
         assert num_processes >= num_mini_batch, (
@@ -175,6 +205,7 @@ class RolloutStorage(object):
             "PPO mini batches ({}).".format(num_processes, num_mini_batch)
         )
         num_envs_per_batch = num_processes // num_mini_batch
+        all_valid = bool(self.valid.all())
         perm = torch.randperm(num_processes)
         for start_ind in range(0, num_processes, num_envs_per_batch):
             obs_batch = []
@@ -185,6 +216,8 @@ class RolloutStorage(object):
             masks_batch = []
             old_action_log_probs_batch = []
             adv_targ = []
+            importance_weighting_batch = []
+            valid_batch = []
 
             for offset in range(num_envs_per_batch):
                 ind = perm[start_ind + offset]
@@ -198,6 +231,9 @@ class RolloutStorage(object):
                 masks_batch.append(self.masks[:-1, ind])
                 old_action_log_probs_batch.append(self.action_log_probs[:, ind])
                 adv_targ.append(advantages[:, ind])
+                if importance_weighting is not None:
+                    importance_weighting_batch.append(importance_weighting[:, ind])
+                valid_batch.append(self.valid[:, ind])
 
             T, N = self.num_steps, num_envs_per_batch
             # These are all tensors of size (T, N, -1)
@@ -224,6 +260,16 @@ class RolloutStorage(object):
                 T, N, old_action_log_probs_batch
             )
             adv_targ = _flatten_helper(T, N, adv_targ)
+            if importance_weighting is None:
+                importance_weighting_batch = None
+            else:
+                importance_weighting_batch = _flatten_helper(
+                    T, N, torch.stack(importance_weighting_batch, 1)
+                )
+            if all_valid:
+                valid_batch = None
+            else:
+                valid_batch = _flatten_helper(T, N, torch.stack(valid_batch, 1))
 
             yield Batch(
                 obs=obs_batch,
@@ -235,5 +281,6 @@ class RolloutStorage(object):
                 old_action_log_probs=old_action_log_probs_batch,
                 adv=adv_targ,
                 tasks=None,
-                importance_weighting=None,
+                importance_weighting=importance_weighting_batch,
+                valid=valid_batch,
             )
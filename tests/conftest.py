@@ -0,0 +1,6 @@
+import sys
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parents[1]
+# the trainer modules are top-level modules, and so are the analysis scripts
+sys.path[:0] = [str(ROOT), str(Path(ROOT, "analysis"))]
@@ -0,0 +1,111 @@
+import struct
+
+import numpy as np
+
+import events
+
+
+def encode_varint(n: int) -> bytes:
+    out = bytearray()
+    while True:
+        byte, n = n & 0x7F, n >> 7
+        out.append(byte | (0x80 if n else 0))
+        if not n:
+            return bytes(out)
+
+
+def field(number: int, wire_type: int, payload) -> bytes:
+    key = encode_varint(number << 3 | wire_type)
+    if wire_type == 0:
+        return key + encode_varint(payload)
+    if wire_type == 2:
+        return key + encode_varint(len(payload)) + payload
+    return key + payload
+
+
+def event(step: int, wall_time: float, **values) -> bytes:
+    # an Event whose Summary holds a simple_value per tag, and a tensor for "tensor"
+    summary = b""
+    for tag, value in values.items():
+        if tag == "tensor":
+            float_val = field(5, 2, struct.pack("<f", value))
+            content = field(8, 2, field(1, 0, events.DT_FLOAT) + float_val)
+        else:
+            content = field(2, 5, struct.pack("<f", value))
+        summary += field(1, 2, field(1, 2, tag.encode()) + content)
+    return (
+        field(1, 1, struct.pack("<d", wall_time))
+        + field(2, 0, step)
+        + field(5, 2, summary)
+    )
+
+
+def record(data: bytes) -> bytes:
+    length = struct.pack("<Q", len(data))
+    return (
+        length
+        + struct.pack("<I", events.masked_crc32c(memoryview(length)))
+        + data
+        + struct.pack("<I", events.masked_crc32c(memoryview(data)))
+    )
+
+
+def test_masked_crc32c():
+    crc = 0xE3069283  # CRC-32C of b"123456789"
+    masked = (((crc >> 15) | (crc << 17)) + 0xA282EAD8) & 0xFFFFFFFF
+    assert events.masked_crc32c(memoryview(b"123456789")) == masked
+
+
+def test_index(tmp_path):
+    path, cache = tmp_path / "events.out.tfevents", tmp_path / "cache"
+    with path.open("wb") as f:
+        f.write(record(b""))  # the file version event has no summary
+        for step in range(3):
+            f.write(record(event(step, 10.0 + step, rewards=step / 2, tensor=-step)))
+    tags = events.index(path, cache, verify=True)
+    assert set(tags) == {"rewards", "tensor"}
+    np.testing.assert_array_equal(tags["rewards"].step, [0, 1, 2])
+    np.testing.assert_array_equal(tags["rewards"].wall_time, [10.0, 11.0, 12.0])
+    np.testing.assert_array_equal(tags["rewards"].value, [0.0, 0.5, 1.0])
+    np.testing.assert_array_equal(tags["tensor"].value, [0.0, -1.0, -2.0])
+
+    # a run that is still writing: the truncated record is left for the next read
+    last = record(event(4, 14.0, rewards=2.0))
+    with path.open("ab") as f:
+        f.write(record(event(3, 13.0, rewards=1.5)))
+        f.write(last[:-3])
+    tags = events.index(path, cache, verify=True)
+    np.testing.assert_array_equal(tags["rewards"].step, [0, 1, 2, 3])
+    offset, _ = events.load_index(events.index_path(path, cache))
+    assert offset == path.stat().st_size - len(last) + 3
+
+    with path.open("ab") as f:
+        f.write(last[-3:])
+    tags = events.index(path, cache, verify=True)
+    np.testing.assert_array_equal(tags["rewards"].step, [0, 1, 2, 3, 4])
+    np.testing.assert_array_equal(tags["rewards"].value, [0.0, 0.5, 1.0, 1.5, 2.0])
+    np.testing.assert_array_equal(tags["tensor"].step, [0, 1, 2])
+
+
+def test_index_stops_at_corrupt_record(tmp_path):
+    path, cache = tmp_path / "events.out.tfevents", tmp_path / "cache"
+    corrupt = bytearray(record(event(1, 1.0, rewards=1.0)))
+    corrupt[-5] ^= 0xFF  # last byte of the data
+    with path.open("wb") as f:
+        f.write(record(event(0, 0.0, rewards=0.0)))
+        f.write(bytes(corrupt))
+        f.write(record(event(2, 2.0, rewards=2.0)))
+    tags = events.index(path, cache, verify=True)
+    np.testing.assert_array_equal(tags["rewards"].step, [0])
+
+
+def test_smoothed():
+    scalars = events.Scalars(
+        step=np.arange(5),
+        wall_time=np.arange(5) * 10.0 + 100,
+        value=np.array([1.0, 2.0, 3.0, 4.0, 5.0]),
+    )
+    assert events.smoothed(scalars, 2) == 4.5
+    assert events.smoothed(scalars, 2, until_step=2) == 2.5
+    assert events.smoothed(scalars, 10, until_time=15) == 1.5
+    assert events.smoothed(scalars, 2, until_step=-1) is None
@@ -0,0 +1,114 @@
+import numpy as np
+import pytest
+
+import store
+from analyze_P import analyze_P, generate_offsets
+from lengths import L, generate_lengths, match
+
+PAIRS = [(L.If, L.EndIf), (L.While, L.EndWhile), (L.Loop, L.EndLoop), (L.If, L.If)]
+
+
+def go_to(it, val):
+    for j, i in enumerate(it):
+        if val == i:
+            return j
+
+
+def measure_length(instruction, start, stop):
+    # the per-episode scan that `match` replaced
+    line_types = iter(instruction[:, 0])
+    while go_to(line_types, start) is not None:
+        yield go_to(line_types, stop)
+
+
+def old_analyze_P(instruction, P, start, stop):
+    # the per-episode scan that `analyze_P` replaced
+    line_types = iter(instruction[:, 0])
+    while True:
+        i = go_to(line_types, start)
+        if i is None:
+            break
+        half = len(P) - 1
+        ex = np.arange(len(P[i])) @ P[i] - half
+        delta = go_to(line_types, stop)
+        if delta is not None:
+            yield delta, ex
+
+
+def random_store(seed: int, num_episodes=200, max_lines=12, size=5, edges=3):
+    random = np.random.RandomState(seed)
+    lengths = random.randint(0, max_lines + 1, num_episodes)
+    # few line types, so that starts and stops are frequent
+    types = random.choice([0, 1, 3, 4, 5], size=lengths.sum())
+    instructions = np.stack([types, random.randint(0, 10, len(types))], axis=1)
+    Ps = random.random_sample((num_episodes, max_lines, size, edges)).astype(
+        np.float32
+    )
+    return store.Store(
+        instructions=instructions,
+        offsets=np.cumsum(np.append(0, lengths)),
+        successes=random.random_sample(num_episodes) < 0.5,
+        Ps=Ps.ravel(),
+        P_offsets=np.arange(num_episodes + 1) * Ps[0].size,
+        P_shapes=np.tile(Ps.shape[1:], (num_episodes, 1)),
+        run_offsets=np.array([0, num_episodes]),
+        run_dirs=["run"],
+    )
+
+
+@pytest.mark.parametrize("seed", range(5))
+@pytest.mark.parametrize("start, stop", PAIRS)
+def test_match(seed, start, stop):
+    episodes = random_store(seed)
+    i, start_position, stop_position = match(episodes.padded()[:, :, 0], start, stop)
+    for row in range(len(episodes)):
+        expected = list(measure_length(episodes.instruction(row), start, stop))
+        found = stop_position[i == row]
+        lengths = found - start_position[i == row] - 1
+        assert [None if s < 0 else l for s, l in zip(found, lengths)] == expected
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_generate_lengths(seed):
+    episodes = random_store(seed)
+    expected = [
+        (
+            episodes.successes[row],
+            len(episodes.instruction(row)),
+            start.name,
+            stop.name,
+            row,
+            length,
+        )
+        for start, stop in PAIRS
+        for row in range(len(episodes))
+        for length in measure_length(episodes.instruction(row), start, stop)
+        if length is not None
+    ]
+    rows = list(generate_lengths(episodes, line_types=list(L), pairs=PAIRS))
+    assert rows == expected
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_generate_offsets(seed):
+    episodes = random_store(seed)
+    expected = [
+        (episodes.successes[row], start.name, stop.name, row, delta, *x)
+        for start, stop in PAIRS
+        for row in range(len(episodes))
+        for delta, x in old_analyze_P(
+            episodes.instruction(row), episodes.P(row), start, stop
+        )
+    ]
+    rows = list(generate_offsets(episodes, pairs=PAIRS))
+    assert len(rows) == len(expected)
+    for row, e in zip(rows, expected):
+        assert row[:5] == e[:5]
+        np.testing.assert_allclose(row[5:], e[5:], rtol=1e-5)
+
+
+def test_analyze_P_checks_rows():
+    episodes = random_store(0, max_lines=12)
+    with pytest.raises(AssertionError):
+        # the old per-episode indexing raised an IndexError
+        analyze_P(episodes, np.array([0]), np.array([12]))
@@ -0,0 +1,159 @@
+from pathlib import Path
+from typing import Optional
+
+import numpy as np
+import pytest
+import torch
+from gym import spaces
+
+import recorder
+import store
+from agents import AgentOutputs
+from env_worker import InfoBatch
+from recorder import TrajectoryRecorder
+
+NUM_ENVS, MAX_LINES = 3, 4
+OBSERVATION_SPACE = spaces.Dict(
+    dict(
+        action_mask=spaces.MultiBinary(3),
+        line_mask=spaces.MultiBinary(MAX_LINES),
+        lines=spaces.MultiDiscrete(np.full((MAX_LINES, 2), 10)),
+        obs=spaces.Box(0, 1, shape=(2,)),
+        partial_action=spaces.MultiDiscrete([2, 2]),
+        ptr=spaces.Discrete(MAX_LINES),
+        resources=spaces.MultiDiscrete([9, 9]),
+    )
+)
+
+
+class Envs:
+    """
+    Env `e` ends its episodes after `e + 2` steps and succeeds in every other one.
+    Each episode has its own instruction, of `1 + episode % MAX_LINES` lines.
+    """
+
+    def __init__(self):
+        self.episode = np.zeros(NUM_ENVS, dtype=int)  # per env
+        self.t = np.zeros(NUM_ENVS, dtype=int)
+        self.slices = recorder.obs_slices(OBSERVATION_SPACE)
+        self.size = self.slices.resources.stop
+
+    def instruction(self, e: int) -> np.ndarray:
+        episode = self.episode[e]
+        lines = np.arange(2 * MAX_LINES).reshape(MAX_LINES, 2) + 10 * e + episode
+        return lines[: 1 + episode % MAX_LINES]
+
+    def obs(self) -> torch.Tensor:
+        obs = np.zeros((NUM_ENVS, self.size), dtype=np.float32)
+        for e in range(NUM_ENVS):
+            instruction = self.instruction(e)
+            lines = np.zeros((MAX_LINES, 2))
+            lines[: len(instruction)] = instruction
+            obs[e, self.slices.lines] = lines.ravel()
+            obs[e, self.slices.line_mask] = np.arange(MAX_LINES) >= len(instruction)
+            obs[e, self.slices.ptr] = self.t[e] % MAX_LINES
+        return torch.from_numpy(obs)
+
+    def act(self) -> AgentOutputs:
+        P = torch.tensor(self.episode * 100 + self.t, dtype=torch.float32)
+        return AgentOutputs(
+            value=None,
+            action=torch.from_numpy(self.t[:, None] * 2),
+            action_log_probs=None,
+            aux_loss=None,
+            rnn_hxs=None,
+            log=dict(P=P[:, None, None].expand(NUM_ENVS, 5, 2)),
+            dist=None,
+        )
+
+    def step(self):
+        self.t += 1
+        done = self.t == np.arange(NUM_ENVS) + 2
+        values = np.full((NUM_ENVS, 2), np.nan)
+        values[done, 0] = self.t[done]
+        values[done, 1] = self.episode[done] % 2
+        ended = [
+            (e, self.instruction(e), bool(self.episode[e] % 2), self.episode[e] * 100)
+            for e in np.flatnonzero(done)
+        ]
+        self.episode[done] += 1
+        self.t[done] = 0
+        return done, InfoBatch(keys=["steps", "success"], values=values), ended
+
+
+def run(log_dir: Path, num_steps: int, flush_after: Optional[int] = None):
+    """
+    Records every episode for `num_steps` steps, flushing after `flush_after` steps
+    (and closing at the end, unless `flush_after` is given). Returns the recorder
+    and the (env, instruction, success, P) of each episode that ended, in order, and
+    how many had ended at the flush.
+    """
+    envs = Envs()
+    trajectories = TrajectoryRecorder(
+        log_dir, OBSERVATION_SPACE, rate=1, seed=0, chunk_rows=8
+    )
+    trajectories.start(envs.obs())
+    ended, flushed = [], None
+    for t in range(num_steps):
+        act = envs.act()
+        done, infos, just_ended = envs.step()
+        ended.extend(just_ended)
+        trajectories.step(act, envs.obs(), done, infos)
+        if t + 1 == flush_after:
+            trajectories.flush()
+            flushed = len(ended)
+    if flush_after is None:
+        trajectories.close()
+    return trajectories, ended, flushed
+
+
+def load(root: Path) -> store.Store:
+    return store.load(root, Path("."), evaluation=False, processes=1)
+
+
+def assert_recorded(episodes: store.Store, ended: list):
+    assert len(episodes) == len(ended)
+    for i, (_, instruction, success, P) in enumerate(ended):
+        np.testing.assert_array_equal(episodes.instruction(i), instruction)
+        assert episodes.successes[i] == success
+        np.testing.assert_array_equal(episodes.P(i), np.full((5, 2), P))
+
+
+def test_record(tmp_path):
+    _, ended, _ = run(Path(tmp_path, "run"), num_steps=20)
+    assert_recorded(load(tmp_path), ended)
+
+    directory = Path(tmp_path, "run", "trajectories")
+    ids = np.load(Path(directory, "episodes.npy"))
+    steps = recorder.read(directory, "steps")
+    # every episode was recorded from its first step to its last
+    lengths = [np.sum(steps["episode"] == i) for i in ids]
+    assert lengths == [e + 2 for e, *_ in ended]
+    for i in ids:
+        np.testing.assert_array_equal(steps["ptr"][steps["episode"] == i][:2], [0, 1])
+
+
+def test_resume(tmp_path):
+    _, first, _ = run(Path(tmp_path, "run"), num_steps=10)
+    _, second, _ = run(Path(tmp_path, "run"), num_steps=10)
+    assert_recorded(load(tmp_path), first + second)
+    ids = np.load(Path(tmp_path, "run", "trajectories", "episodes.npy"))
+    assert len(np.unique(ids)) == len(ids)
+
+
+def test_resume_after_preemption(tmp_path):
+    trajectories, first, flushed = run(Path(tmp_path, "run"), 20, flush_after=10)
+    # preempted: what was written after the flush is never listed in the index
+    trajectories.queue.put(None)
+    trajectories.thread.join()
+    _, second, _ = run(Path(tmp_path, "run"), num_steps=10)
+    assert_recorded(load(tmp_path), first[:flushed] + second)
+
+
+def test_writer_error(tmp_path, monkeypatch):
+    def fail(*args):
+        raise OSError("disk full")
+
+    monkeypatch.setattr(TrajectoryRecorder, "append", fail)
+    with pytest.raises(RuntimeError):
+        run(Path(tmp_path, "run"), num_steps=100)
@@ -0,0 +1,92 @@
+from pathlib import Path
+from typing import Optional
+
+from checkpointer import CHECKPOINT_NAME, read_checkpoint
+from trainer import Trainer
+
+NUM_PROCESSES, TRAIN_STEPS, PPO_EPOCH = 2, 5, 2
+FRAMES_PER_UPDATE = NUM_PROCESSES * TRAIN_STEPS
+
+
+def train(
+    log_dir: Path, num_frames: int, monkeypatch, load_path: Optional[Path] = None
+):
+    # trains on CartPole in `log_dir` and returns the last checkpoint
+    log_dir.mkdir()
+    monkeypatch.chdir(log_dir)  # the run directory, as Hydra sets it
+    Trainer.run(
+        agent_args=dict(
+            recurrent=False, hidden_size=8, entropy_coef=0.01, num_layers=1
+        ),
+        async_update=False,
+        cuda=False,
+        cuda_deterministic=False,
+        curriculum_args={},
+        env_args=dict(
+            env="CartPole-v0",
+            num_processes=NUM_PROCESSES,
+            render=False,
+            seed=0,
+            synchronous=True,
+        ),
+        eval_concurrent=False,
+        eval_interval=None,
+        eval_steps=None,
+        failure_buffer_args={},
+        group=None,
+        inference_batch_size=1,
+        inference_server=False,
+        inference_timeout=0.0,
+        keep_checkpoints=1,
+        load_path=load_path,
+        log_interval=10 ** 9,
+        name=None,
+        use_wandb=False,
+        num_frames=num_frames,
+        num_learners=1,
+        num_processes=NUM_PROCESSES,
+        num_seeds=1,
+        plan_cores=False,
+        ppo_args=dict(
+            clip_param=0.2,
+            learning_rate=1e-3,
+            optimizer="Adam",
+            ppo_epoch=PPO_EPOCH,
+            num_batch=1,
+            value_loss_coef=0.5,
+            max_grad_norm=0.5,
+        ),
+        profile=False,
+        profile_trace=False,
+        quantize_actor=False,
+        record_rate=0.0,
+        render=False,
+        render_eval=False,
+        rollouts_args=dict(
+            num_processes=NUM_PROCESSES, use_gae=False, gamma=0.99, tau=0.95
+        ),
+        seed=0,
+        save_interval=0,  # only when done
+        step_deadline=None,
+        train_steps=TRAIN_STEPS,
+    )
+    return read_checkpoint(Path(log_dir, CHECKPOINT_NAME))
+
+
+def optimizer_steps(checkpoint: dict) -> int:
+    return max(s["step"] for s in checkpoint["optimizer"]["state"].values())
+
+
+def test_resume_matches_uninterrupted_run(tmp_path, monkeypatch):
+    num_frames = 6 * FRAMES_PER_UPDATE  # 5 updates: the last iteration only saves
+    uninterrupted = train(Path(tmp_path, "a"), num_frames, monkeypatch)
+    train(Path(tmp_path, "b"), 3 * FRAMES_PER_UPDATE, monkeypatch)
+    resumed = train(
+        Path(tmp_path, "c"),
+        num_frames,
+        monkeypatch,
+        load_path=Path(tmp_path, "b", CHECKPOINT_NAME),
+    )
+    assert resumed["step"] == uninterrupted["step"]
+    assert resumed["frames"]["so_far"] == uninterrupted["frames"]["so_far"]
+    assert optimizer_steps(resumed) == optimizer_steps(uninterrupted) == 5 * PPO_EPOCH
@@ -0,0 +1,61 @@
+import gym
+import numpy as np
+from gym import spaces
+
+from env_worker import InfoBatch
+from vec_env import SharedMemoryVecEnv
+
+
+class CountingEnv(gym.Env):
+    """
+    Ends after three steps, succeeding if the last action is 1. Reports the step
+    count at the end of each episode, like `env.Env`.
+    """
+
+    observation_space = spaces.Box(0, np.inf, shape=(1,))
+    action_space = spaces.Discrete(2)
+
+    def __init__(self):
+        self.t = 0
+
+    @staticmethod
+    def info_keys():
+        return ["steps", "success"]
+
+    def reset(self):
+        self.t = 0
+        return np.zeros(1)
+
+    def step(self, action):
+        self.t += 1
+        done = self.t == 3
+        info = dict(steps=self.t, success=float(action)) if done else {}
+        return np.array([self.t]), 1.0, done, info
+
+
+def test_info_batch_round_trip():
+    envs = SharedMemoryVecEnv([CountingEnv] * 4, envs_per_worker=2)
+    try:
+        envs.reset()
+        actions = np.array([0, 1, 0, 1])
+        for _ in range(2):
+            envs.step_async(actions)
+            obs, rewards, dones, infos = envs.step_wait()
+            assert isinstance(infos, InfoBatch)
+            assert np.isnan(infos.values).all()
+            assert not dones.any()
+        envs.step_async(actions)
+        obs, rewards, dones, infos = envs.step_wait()
+        assert dones.all()
+        assert infos.keys == ["steps", "success"]
+        np.testing.assert_array_equal(infos.values[:, 0], 3)
+        np.testing.assert_array_equal(infos.values[:, 1], actions)
+        assert envs.schema.decode(infos.values)[1] == dict(steps=3.0, success=1.0)
+        np.testing.assert_array_equal(obs, 0)  # reset after the episode ended
+
+        # the slots of finished episodes are cleared on the next step
+        envs.step_async(actions)
+        _, _, _, infos = envs.step_wait()
+        assert np.isnan(infos.values).all()
+    finally:
+        envs.close()
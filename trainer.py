@@ -1,24 +1,30 @@
+import copy
 import inspect
 import itertools
 import os
-from collections import namedtuple, Counter
-from multiprocessing import Queue
+import random
+import socket
+import time
+from collections import namedtuple, Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache, partial
+from multiprocessing import Queue, get_context
+from multiprocessing.connection import wait
 from pathlib import Path
-from pprint import pprint
-from typing import Dict, Optional
+from typing import Callable, Dict, List, Optional, Tuple
 
 import gym
 import hydra
 import numpy as np
 import torch
+import torch.distributed as dist
 import torch.nn as nn
 from hydra.core.config_store import ConfigStore
 from omegaconf import DictConfig
 
-import wandb
-from stable_baselines3.common.vec_env import DummyVecEnv, SubprocVecEnv
+from stable_baselines3.common.vec_env import DummyVecEnv
 
-from agents import Agent, AgentOutputs, MLPBase
+from agents import Agent, AgentOutputs, AgentStack, MLPBase, quantized
 from aggregator import (
     EpisodeAggregator,
     InfosAggregator,
@@ -26,17 +32,52 @@ from aggregator import (
     AverageTimeKeeper,
     EvalEpisodeAggregator,
     EvalInfosAggregator,
+    per_seed,
 )
+from checkpointer import CheckpointWriter, read_checkpoint
 from config import Config, flatten
-from ppo import PPO
+from env_worker import EnvSpec
+from evaluation import EvalWorker
+from inference import ActorPool
+from metrics import JSONLSink, MetricsLogger, Sink, StdoutSink, WandbSink
+import planner
+from ppo import PPO, MultiSeedPPO
+from profiler import PROFILER
+from recorder import TrajectoryRecorder
 from rollouts import RolloutStorage
+from vec_env import POOL, SharedMemoryVecEnv
 from wrappers import VecPyTorch
 
 EpochOutputs = namedtuple("EpochOutputs", "obs reward done infos act masks")
-CHECKPOINT_NAME = "checkpoint.pt"
+IMPORTED = time.time()
+
+
+def process_start_time() -> float:
+    try:
+        with open("/proc/self/stat") as f:
+            # fields after the executable name, starting from the third
+            stat = f.read().rsplit(")", 1)[1].split()
+        with open("/proc/uptime") as f:
+            uptime = float(f.read().split()[0])
+        return time.time() - uptime + int(stat[19]) / os.sysconf("SC_CLK_TCK")
+    except (OSError, ValueError, IndexError):
+        return IMPORTED  # not on Linux
 
 
 class Trainer:
+    @classmethod
+    @lru_cache()
+    def arg_groups(cls) -> Dict[str, Tuple[str, ...]]:
+        """
+        Maps each config key to the argument groups of `args_to_methods` that take it.
+        """
+        groups = defaultdict(dict)
+        for arg_name, methods in cls.args_to_methods().items():
+            for method in methods:
+                for k in inspect.signature(method).parameters:
+                    groups[k][arg_name] = None
+        return {k: tuple(v) for k, v in groups.items()}
+
     @classmethod
     def args_to_methods(cls):
         return dict(
@@ -62,6 +103,17 @@ class Trainer:
             **agent_args,
         )
 
+    @staticmethod
+    def broadcast_path(path: Path, max_length: int = 4096) -> Path:
+        # the chief's `path`, on every learner
+        data = torch.zeros(max_length, dtype=torch.uint8)
+        if dist.get_rank() == 0:
+            encoded = str(path).encode()
+            assert len(encoded) < max_length, path
+            data[: len(encoded)] = torch.tensor(list(encoded), dtype=torch.uint8)
+        dist.broadcast(data, src=0)
+        return Path(bytes(data.tolist()).rstrip(b"\0").decode())
+
     @classmethod
     def build_failure_buffer(cls, **kwargs) -> Optional[Queue]:
         pass
@@ -70,22 +122,73 @@ class Trainer:
     def build_infos_aggregator() -> InfosAggregator:
         return InfosAggregator()
 
+    @staticmethod
+    def build_metrics_sinks(log_dir: Path, use_wandb: bool) -> List[Sink]:
+        sinks = [StdoutSink(), JSONLSink(log_dir)]
+        if use_wandb:
+            sinks.append(WandbSink())
+        return sinks
+
     @classmethod
     def dump_failure_buffer(cls, failure_buffer, log_dir: Path):
         pass
 
+    @staticmethod
+    def env_spec(rank: int, evaluating: bool, **kwargs) -> EnvSpec:
+        raise NotImplementedError(
+            "Only envs with an env_spec can be started with spawn or forkserver."
+        )
+
+    @classmethod
+    def failure_buffer_items(cls, failure_buffer) -> Optional[list]:
+        pass
+
     @classmethod
     def initialize_curriculum(cls, **kwargs):
         while True:
             yield
 
+    @classmethod
+    def launch_learners(cls, num_learners: int, **kwargs):
+        os.environ.setdefault("MASTER_ADDR", "127.0.0.1")
+        if "MASTER_PORT" not in os.environ:
+            with socket.socket() as s:
+                s.bind(("", 0))
+                os.environ["MASTER_PORT"] = str(s.getsockname()[1])
+        context = get_context("fork")
+        learners = [
+            context.Process(
+                target=cls.run,
+                kwargs=dict(kwargs, num_learners=num_learners, learner_rank=rank),
+            )
+            for rank in range(num_learners)
+        ]
+        for learner in learners:
+            learner.start()
+        running = list(learners)
+        while running:
+            wait([learner.sentinel for learner in running])
+            for rank, learner in enumerate(learners):
+                if learner not in running or learner.exitcode is None:
+                    continue
+                running.remove(learner)
+                if learner.exitcode != 0:
+                    # the others would block forever in their next allreduce
+                    for other in running:
+                        other.terminate()
+                    for other in running:
+                        other.join()
+                    raise RuntimeError(
+                        f"Learner {rank} exited with code {learner.exitcode}"
+                    )
+
     @staticmethod
-    def load_checkpoint(checkpoint_path, ppo, agent, device):
-        state_dict = torch.load(str(checkpoint_path), map_location=device)
+    def load_checkpoint(checkpoint_path, ppo, agent, device) -> dict:
+        state_dict = read_checkpoint(checkpoint_path, map_location=device)
         agent.load_state_dict(state_dict["agent"])
         ppo.optimizer.load_state_dict(state_dict["optimizer"])
         print(f"Loaded parameters from {checkpoint_path}.")
-        return state_dict.get("step", -1) + 1
+        return state_dict
 
     @classmethod
     def make_vec_envs(
@@ -96,6 +199,11 @@ class Trainer:
         synchronous: bool,
         log_dir=None,
         mp_kwargs: dict = None,
+        build_vec_env: Callable = None,
+        worker_start_method: str = "fork",
+        envs_per_worker: Optional[int] = None,
+        persistent_workers: bool = False,
+        worker_cores: Optional[List[List[int]]] = None,
         **kwargs,
     ) -> VecPyTorch:
         if mp_kwargs is None:
@@ -104,6 +212,10 @@ class Trainer:
         if num_processes == 1:
             synchronous = True
 
+        if persistent_workers and worker_start_method == "fork":
+            # pooled workers are reconfigured with picklable env specs
+            worker_start_method = "forkserver"
+
         if synchronous:
             kwargs.update(mp_kwargs)
 
@@ -115,16 +227,42 @@ class Trainer:
 
             return thunk
 
-        env_fns = [env_thunk(i) for i in range(num_processes)]
+        if synchronous or worker_start_method == "fork":
+            env_fns = [env_thunk(i) for i in range(num_processes)]
+        else:
+            # spawned workers need picklable constructors
+            env_fns = [
+                cls.env_spec(rank=i, evaluating=evaluating, **kwargs)
+                for i in range(num_processes)
+            ]
+        if build_vec_env is not None:
+            return build_vec_env(env_fns)
+        if synchronous:
+            return VecPyTorch(DummyVecEnv(env_fns, render=render))
+        if persistent_workers:
+            return VecPyTorch(
+                POOL.acquire(
+                    env_fns,
+                    start_method=worker_start_method,
+                    envs_per_worker=envs_per_worker,
+                    worker_cores=worker_cores,
+                )
+            )
         return VecPyTorch(
-            DummyVecEnv(env_fns, render=render)
-            if synchronous or num_processes == 1
-            else SubprocVecEnv(env_fns, **mp_kwargs, start_method="fork", render=render)
+            SharedMemoryVecEnv(
+                env_fns,
+                start_method=worker_start_method,
+                envs_per_worker=envs_per_worker,
+                worker_cores=worker_cores,
+            )
         )
 
     @classmethod
     def main(cls, cfg: DictConfig):
-        return cls.run(**cls.structure_config(cfg))
+        kwargs = cls.structure_config(cfg)
+        if kwargs["num_learners"] > 1:
+            return cls.launch_learners(**kwargs)
+        return cls.run(**kwargs)
 
     @staticmethod
     def make_env(env, seed, rank, evaluating, **kwargs):
@@ -132,47 +270,70 @@ class Trainer:
         env.seed(seed + rank)
         return env
 
-    @staticmethod
-    def report(frames: int, log_dir: Path, **kwargs):
-        print("Frames:", frames)
-        pprint(kwargs)
-        try:
-            wandb.log(kwargs, step=frames)
-        except wandb.Error:
-            pass
+    @classmethod
+    def restore_failure_buffer(cls, failure_buffer, items: list):
+        pass
 
     @classmethod
     def run(
         cls,
         agent_args: dict,
+        async_update: bool,
         cuda: bool,
         cuda_deterministic: bool,
         curriculum_args: dict,
         env_args: dict,
+        eval_concurrent: bool,
         eval_interval: Optional[int],
         eval_steps: Optional[int],
         failure_buffer_args: dict,
         group: str,
+        inference_batch_size: int,
+        inference_server: bool,
+        inference_timeout: float,
+        keep_checkpoints: int,
         load_path: Path,
         log_interval: int,
         name: str,
         use_wandb: bool,
         num_frames: Optional[int],
+        num_learners: int,
         num_processes: int,
+        num_seeds: int,
+        plan_cores: bool,
         ppo_args: dict,
+        profile: bool,
+        profile_trace: bool,
+        quantize_actor: bool,
+        record_rate: float,
         render: bool,
         render_eval: bool,
         rollouts_args: dict,
         seed: int,
         save_interval: int,
+        step_deadline: Optional[float],
         train_steps: int,
+        learner_rank: int = 0,
     ):
         assert (eval_interval and eval_steps) or not (eval_interval or eval_steps), (
             eval_steps,
             eval_interval,
         )
+        assert not (async_update and inference_server), "Choose one or the other."
+        assert not (step_deadline and inference_server), "Choose one or the other."
+        assert not (plan_cores and inference_server), (
+            "plan_cores plans the env workers of this process; "
+            "set inference_server=false"
+        )
+        assert not (record_rate and (inference_server or step_deadline)), (
+            "record_rate records the lockstep collector; "
+            "set inference_server=false and step_deadline=null"
+        )
+
+        chief = learner_rank == 0
+        if use_wandb and chief:
+            import wandb
 
-        if use_wandb:
             wandb.init(group=group, name=name, project="ppo")
             os.symlink(
                 os.path.abspath(".hydra/config.yaml"),
@@ -181,34 +342,65 @@ class Trainer:
             wandb.save("hydra-config.yaml")
             log_dir = Path(wandb.run.dir)
         else:
-            log_dir = Path("/tmp")
-        # Properly restrict pytorch to not consume extra resources.
-        #  - https://github.com/pytorch/pytorch/issues/975
-        #  - https://github.com/ray-project/ray/issues/3609
-        torch.set_num_threads(1)
-        os.environ["OMP_NUM_THREADS"] = "1"
-        save_path = Path(log_dir, CHECKPOINT_NAME)
+            log_dir = Path.cwd()  # the hydra run directory
+        checkpoints = metrics = None
+        if chief:
+            checkpoints = CheckpointWriter(log_dir, keep=keep_checkpoints)
+            metrics = MetricsLogger(cls.build_metrics_sinks(log_dir, use_wandb))
 
-        def run_epoch(obs, rnn_hxs, masks, envs, num_steps):
-            for _ in range(num_steps):
-                with torch.no_grad():
-                    act = agent(
-                        inputs=obs, rnn_hxs=rnn_hxs, masks=masks
-                    )  # type: AgentOutputs
+        if num_learners > 1:
+            # data-parallel: each learner steps its own slice of the envs
+            assert num_processes % num_learners == 0, (num_processes, num_learners)
+            dist.init_process_group(
+                "gloo", rank=learner_rank, world_size=num_learners
+            )
+            num_processes //= num_learners
+            seed += learner_rank * num_processes
+            env_args.update(num_processes=num_processes, seed=seed)
+            rollouts_args.update(num_processes=num_processes)
 
-                action = envs.preprocess(act.action)
-                # Observe reward and next obs
-                obs, reward, done, infos = envs.step(action)
+        if profile:
+            trace_dir = Path(log_dir, "trace") if profile_trace else None
+            if trace_dir is not None and num_learners > 1:
+                # every learner writes its events where the chief merges them
+                trace_dir = cls.broadcast_path(trace_dir)
+            # enable before any env workers are forked so that they inherit it
+            PROFILER.enable(trace_dir)
 
-                # If done then clean the history of observations.
-                masks = torch.tensor(
-                    1 - done, dtype=torch.float32, device=obs.device
-                ).unsqueeze(1)
-                yield EpochOutputs(
-                    obs=obs, reward=reward, done=done, infos=infos, act=act, masks=masks
-                )
+        seed_processes = num_processes
+        if num_seeds > 1:
+            # seed s trains on envs [s * seed_processes, (s + 1) * seed_processes),
+            # like a separate run with seed + s * seed_processes
+            assert num_learners == 1, "Choose one or the other."
+            assert not (async_update or inference_server or step_deadline), (
+                "Multiple seeds only support synchronous collection and updates."
+            )
+            num_processes *= num_seeds
+            env_args.update(num_processes=num_processes)
+            rollouts_args.update(num_processes=num_processes)
 
-                rnn_hxs = act.rnn_hxs
+        # Properly restrict pytorch to not consume extra resources.
+        #  - https://github.com/pytorch/pytorch/issues/975
+        #  - https://github.com/ray-project/ray/issues/3609
+        # Env workers stay single-threaded; the learner gets a thread per physical
+        # core that the plan leaves it.
+        os.environ["OMP_NUM_THREADS"] = "1"
+        core_plan = None
+        if plan_cores:
+            core_plan = planner.plan(
+                num_envs=num_processes,
+                synchronous=env_args["synchronous"],
+                envs_per_worker=env_args.get("envs_per_worker"),
+                num_learners=num_learners,
+                learner_rank=learner_rank,
+            )
+            print(core_plan)
+            core_plan.pin()
+            env_args.update(
+                envs_per_worker=core_plan.envs_per_worker,
+                worker_cores=core_plan.worker_cores or None,
+            )
+        torch.set_num_threads(1 if core_plan is None else core_plan.learner_threads)
 
         if render_eval and not render:
             eval_interval = 1
@@ -216,6 +408,10 @@ class Trainer:
             ppo_args.update(ppo_epoch=0)
             cuda = False
         cuda &= torch.cuda.is_available()
+        assert not (quantize_actor and (cuda or inference_server)), (
+            "quantize_actor acts with a CPU copy of the agent in this process; "
+            "set cuda=false and inference_server=false"
+        )
 
         # reproducibility
         # if cuda_deterministic:
@@ -233,16 +429,38 @@ class Trainer:
         failure_buffer = cls.build_failure_buffer(**failure_buffer_args)
         curriculum = cls.initialize_curriculum(log_dir=log_dir, **curriculum_args)
         curriculum_setting = next(curriculum)
+        build_vec_env = None
+        if inference_server:
+            build_vec_env = partial(
+                ActorPool,
+                num_steps=train_steps,
+                max_batch_size=inference_batch_size,
+                timeout=inference_timeout,
+                build_infos_aggregator=cls.build_infos_aggregator,
+            )
         train_envs = cls.make_vec_envs(
             evaluating=False,
             log_dir=log_dir,
             failure_buffer=failure_buffer,
             curriculum_setting=curriculum_setting,
+            build_vec_env=build_vec_env,
             **env_args,
         )
         print("Created train_envs")
+        if step_deadline is not None:
+            assert isinstance(
+                train_envs.venv, SharedMemoryVecEnv
+            ), "step_deadline requires a SharedMemoryVecEnv (synchronous=False)"
         train_envs.to(device)
-        agent = cls.build_agent(envs=train_envs, **agent_args)
+        if num_seeds > 1:
+            agents = []
+            for s in range(num_seeds):
+                torch.manual_seed(seed + s * seed_processes)
+                agents.append(cls.build_agent(envs=train_envs, **agent_args))
+            torch.manual_seed(seed)
+            agent = AgentStack(agents)
+        else:
+            agent = cls.build_agent(envs=train_envs, **agent_args)
         rollouts = RolloutStorage(
             num_steps=train_steps,
             obs_space=train_envs.observation_space,
@@ -255,170 +473,570 @@ class Trainer:
         if cuda:
             agent.to(device)
             rollouts.to(device)
+        # envs that were still stepping when `collect_async` last closed
+        in_flight = torch.zeros(num_processes, dtype=torch.bool)
+        carried_hxs = torch.zeros_like(rollouts.recurrent_hidden_states[0])
+
+        # In asynchronous mode, a stale copy of the agent fills one buffer while PPO
+        # updates on the other in a background thread, bounding policy lag to 1.
+        actor = agent
+        prev_rollouts = None
+        actor_version = learner_version = 0
+        prev_version = None
+        executor = None
+        if async_update:
+            actor = copy.deepcopy(agent)
+            prev_rollouts = copy.deepcopy(rollouts)
+            executor = ThreadPoolExecutor(max_workers=1)
 
-        ppo = PPO(agent=agent, **ppo_args)
-        train_report = EpisodeAggregator()
-        train_infos = cls.build_infos_aggregator()
+        ppo = (
+            PPO(agent=agent, **ppo_args)
+            if num_seeds == 1
+            else MultiSeedPPO(agent=agent, **ppo_args)
+        )
+        train_report = per_seed(EpisodeAggregator, num_seeds)
+        train_infos = per_seed(cls.build_infos_aggregator, num_seeds)
         train_results = {}
+        checkpoint = {}
         if load_path:
-            cls.load_checkpoint(load_path, ppo, agent, device)
+            checkpoint = cls.load_checkpoint(load_path, ppo, agent, device)
+        if num_learners > 1:
+            ppo.broadcast_parameters()
+        if quantize_actor:
+            # only the learner needs fp32 weights; PPO recomputes log-probs in fp32
+            actor = quantized(agent)
+        elif async_update:
+            actor.load_state_dict(agent.state_dict())
+
+        eval_worker = None
+        if chief and eval_interval and eval_concurrent and not render_eval:
+            # evaluate weight snapshots in a persistent process, off the critical path
+            eval_worker = EvalWorker(
+                make_eval_envs=partial(
+                    cls.make_vec_envs,
+                    log_dir=log_dir,
+                    failure_buffer=failure_buffer,
+                    curriculum_setting=curriculum_setting,
+                    evaluating=True,
+                    **env_args,
+                ),
+                agent=copy.deepcopy(agent).cpu(),
+                run_epoch=cls.run_epoch,
+                num_steps=eval_steps,
+                num_seeds=num_seeds,
+            )
 
-        print("resetting environment...")
-        rollouts.obs[0].copy_(train_envs.reset())
-        print("Reset environment")
-        frames_per_update = train_steps * num_processes
+        if inference_server:
+            train_envs.start(agent)
+        else:
+            print("resetting environment...")
+            rollouts.obs[0].copy_(train_envs.reset())
+            print("Reset environment")
+        recorder = eval_recorder = None
+        if chief and record_rate:
+            recorder = TrajectoryRecorder(
+                log_dir, train_envs.observation_space, rate=record_rate, seed=seed
+            )
+            recorder.start(rollouts.obs[0])
+        startup = {"time to first frame": time.time() - process_start_time()}
+        if core_plan is not None:
+            startup.update(core_plan.items())
+        try:
+            startup.update(train_envs.worker_stats())
+        except AttributeError:
+            pass  # not a SharedMemoryVecEnv
+        frames_per_step = seed_processes * num_learners  # frames per seed
+        frames_per_update = train_steps * frames_per_step
         frames = Counter()
         time_spent = TotalTimeKeeper()
         time_per = AverageTimeKeeper()
+        start = 0
+        if checkpoint:
+            # Resume exactly where the checkpoint left off (trainer-side state only).
+            # It was saved before its iteration collected and updated, but after
+            # that iteration was counted, so the iteration runs again.
+            start = checkpoint.get("step", 0)
+            if "frames" in checkpoint:
+                frames.update(checkpoint["frames"])
+                frames["so_far"] -= frames_per_update
+            train_report = checkpoint.get("train_report", train_report)
+            train_infos = checkpoint.get("train_infos", train_infos)
+            train_results = checkpoint.get("train_results", train_results)
+            rng = checkpoint.get("rng")
+            if num_learners > 1:
+                # Only the chief saves its RNG state, so every rank derives a stream
+                # of its own from its seed (offset by rank) and the step instead.
+                resumed_seed = np.random.RandomState([seed, start]).randint(2 ** 31)
+                torch.manual_seed(resumed_seed)
+                torch.cuda.manual_seed_all(resumed_seed)
+                np.random.seed(resumed_seed)
+                random.seed(resumed_seed)
+            elif rng is not None:
+                torch.set_rng_state(rng["torch"])
+                if cuda and rng["cuda"]:
+                    torch.cuda.set_rng_state_all(rng["cuda"])
+                np.random.set_state(rng["numpy"])
+                random.setstate(rng["random"])
+            if checkpoint.get("failure_buffer"):
+                cls.restore_failure_buffer(failure_buffer, checkpoint["failure_buffer"])
         time_per["iter"].tick()
 
-        for i in itertools.count():
+        for i in itertools.count(start):
             frames.update(so_far=frames_per_update)
             done = num_frames is not None and frames["so_far"] >= num_frames
             if done or i == 0 or frames["since_log"] > log_interval:
 
                 time_spent["logging"].tick()
                 frames["since_log"] = 0
+                try:
+                    PROFILER.merge(train_envs.profile_totals(), prefix="workers/")
+                except AttributeError:
+                    pass  # not a SharedMemoryVecEnv
                 report = dict(
                     **train_results,
                     **dict(train_report.items()),
                     **dict(train_infos.items()),
                     **dict(time_per.items()),
                     **dict(time_spent.items()),
+                    **dict(PROFILER.items()),
+                    **startup,
+                    **{"wall time": time.time()},
                     frames=frames["so_far"],
-                    log_dir=log_dir,
                 )
+                startup = {}
                 if failure_buffer is not None:
                     report.update({"failure buffer size": failure_buffer.qsize()})
-                cls.report(**report)
+                try:
+                    report.update(train_envs.step_time_items())
+                except AttributeError:
+                    pass  # not a SharedMemoryVecEnv
+                if chief:
+                    metrics.log(**report)
                 train_report.reset()
                 train_infos.reset()
+                PROFILER.reset()
+                if recorder is not None:
+                    recorder.flush()
                 time_spent["logging"].update()
                 time_per["iter"].update()
 
-                time_spent["dumping failure buffer"].tick()
-                cls.dump_failure_buffer(failure_buffer, log_dir)
-                time_spent["dumping failure buffer"].update()
+                if chief:
+                    time_spent["dumping failure buffer"].tick()
+                    cls.dump_failure_buffer(failure_buffer, log_dir)
+                    time_spent["dumping failure buffer"].update()
 
-                if eval_interval and (
-                    i == 0 or done or frames["since_eval"] > eval_interval
+                if (
+                    chief
+                    and eval_interval
+                    and (i == 0 or done or frames["since_eval"] > eval_interval)
                 ):
-                    print("Evaluating...")
-                    time_spent["evaluating"].tick()
-                    eval_report = EvalEpisodeAggregator()
-                    eval_infos = EvalInfosAggregator()
                     frames["since_eval"] = 0
+                    if eval_worker is not None:
+                        time_spent["evaluating"].tick()
+                        # the last evaluation waits for the worker instead of
+                        # being dropped
+                        if not eval_worker.submit(frames["so_far"], agent, block=done):
+                            print(
+                                f"Skipped evaluating at {frames['so_far']} frames: "
+                                "the previous evaluation is still running."
+                            )
+                        time_spent["evaluating"].update()
+                    else:
+                        print("Evaluating...")
+                        time_spent["evaluating"].tick()
+                        eval_report = per_seed(EvalEpisodeAggregator, num_seeds)
+                        eval_infos = per_seed(EvalInfosAggregator, num_seeds)
 
-                    # self.envs.evaluate()
-                    eval_masks = torch.zeros(num_processes, 1, device=device)
-                    eval_envs = cls.make_vec_envs(
-                        log_dir=log_dir,
-                        failure_buffer=failure_buffer,
-                        curriculum_setting=curriculum_setting,
-                        evaluating=True,
-                        **env_args,
-                    )
-                    eval_envs.to(device)
-                    with agent.evaluating(eval_envs.observation_space):
-                        eval_recurrent_hidden_states = torch.zeros(
-                            num_processes,
-                            agent.recurrent_hidden_state_size,
-                            device=device,
+                        # self.envs.evaluate()
+                        eval_masks = torch.zeros(num_processes, 1, device=device)
+                        eval_envs = cls.make_vec_envs(
+                            log_dir=log_dir,
+                            failure_buffer=failure_buffer,
+                            curriculum_setting=curriculum_setting,
+                            evaluating=True,
+                            **env_args,
                         )
+                        eval_envs.to(device)
+                        eval_obs = eval_envs.reset()
+                        if record_rate and eval_recorder is None:
+                            eval_recorder = TrajectoryRecorder(
+                                log_dir,
+                                eval_envs.observation_space,
+                                rate=record_rate,
+                                seed=seed,
+                                prefix="eval_",
+                            )
+                        if eval_recorder is not None:
+                            eval_recorder.start(eval_obs)
+                        with agent.evaluating(eval_envs.observation_space):
+                            eval_recurrent_hidden_states = torch.zeros(
+                                num_processes,
+                                agent.recurrent_hidden_state_size,
+                                device=device,
+                            )
 
-                        for output in run_epoch(
-                            obs=eval_envs.reset(),
-                            rnn_hxs=eval_recurrent_hidden_states,
-                            masks=eval_masks,
-                            envs=eval_envs,
-                            num_steps=eval_steps,
-                        ):
-                            eval_report.update(
-                                reward=output.reward.cpu().numpy(),
-                                dones=output.done,
+                            for output in cls.run_epoch(
+                                obs=eval_obs,
+                                rnn_hxs=eval_recurrent_hidden_states,
+                                masks=eval_masks,
+                                envs=eval_envs,
+                                num_steps=eval_steps,
+                                agent=agent,
+                            ):
+                                eval_report.update(
+                                    reward=output.reward.cpu().numpy(),
+                                    dones=output.done,
+                                )
+                                eval_infos.update(output.infos, dones=output.done)
+                                if eval_recorder is not None:
+                                    eval_recorder.step(
+                                        output.act,
+                                        output.obs,
+                                        output.done,
+                                        output.infos,
+                                    )
+                            metrics.log(
+                                **dict(eval_report.items()),
+                                **dict(eval_infos.items()),
+                                frames=frames["so_far"],
                             )
-                            eval_infos.update(*output.infos, dones=output.done)
-                        cls.report(
-                            **dict(eval_report.items()),
-                            **dict(eval_infos.items()),
-                            frames=frames["so_far"],
-                            log_dir=log_dir,
-                        )
-                        print("Done evaluating...")
-                    eval_envs.close()
-                    rollouts.obs[0].copy_(train_envs.reset())
-                    rollouts.masks[0] = 1
-                    rollouts.recurrent_hidden_states[0] = 0
-                    time_spent["evaluating"].update()
-                    train_report = EpisodeAggregator()
-                    train_infos = cls.build_infos_aggregator()
-
-            if done or (save_interval and frames["since_save"] > save_interval):
+                            print("Done evaluating...")
+                        if eval_recorder is not None:
+                            eval_recorder.flush()
+                        eval_envs.close()
+                        if not inference_server:
+                            rollouts.obs[0].copy_(train_envs.reset())
+                            rollouts.masks[0] = 1
+                            rollouts.recurrent_hidden_states[0] = 0
+                            in_flight[:] = False
+                            if recorder is not None:
+                                recorder.start(rollouts.obs[0])
+                        time_spent["evaluating"].update()
+                        train_report = per_seed(EpisodeAggregator, num_seeds)
+                        train_infos = per_seed(cls.build_infos_aggregator, num_seeds)
+
+            if eval_worker is not None:
+                for eval_frames, eval_results in eval_worker.poll(block=done):
+                    metrics.log(
+                        **eval_results,
+                        **{"eval frames": eval_frames},
+                        frames=frames["so_far"],
+                    )
+
+            if chief and (
+                done or (save_interval and frames["since_save"] > save_interval)
+            ):
                 time_spent["saving"].tick()
                 frames["since_save"] = 0
                 cls.save_checkpoint(
-                    save_path,
+                    checkpoints,
+                    step=i,
                     ppo=ppo,
                     agent=agent,
-                    step=i,
+                    failure_buffer=failure_buffer,
+                    frames=frames,
+                    train_report=train_report,
+                    train_infos=train_infos,
+                    train_results=train_results,
                 )
                 time_spent["saving"].update()
 
             if done:
+                if executor is not None:
+                    executor.shutdown()
+                train_envs.close()
+                PROFILER.flush()
+                if num_learners > 1:
+                    dist.barrier()  # until every learner's events are written
+                if chief:
+                    PROFILER.export()
+                if num_learners > 1:
+                    dist.destroy_process_group()
+                if eval_worker is not None:
+                    eval_worker.close()
+                if checkpoints is not None:
+                    checkpoints.close()
+                if metrics is not None:
+                    metrics.close()
+                for r in (recorder, eval_recorder):
+                    if r is not None:
+                        r.close()
                 break
 
             time_per["frame"].tick()
             time_per["update"].tick()
-            for output in run_epoch(
-                obs=rollouts.obs[0],
-                rnn_hxs=rollouts.recurrent_hidden_states[0],
-                masks=rollouts.masks[0],
-                envs=train_envs,
-                num_steps=train_steps,
-            ):
-                train_report.update(
-                    reward=output.reward.cpu().numpy(),
-                    dones=output.done,
+            update_future = None
+            if prev_version is not None:
+                policy_lag = learner_version - prev_version
+                update_future = executor.submit(
+                    ppo.update, prev_rollouts, policy_lag, quantize_actor
                 )
-                train_infos.update(*output.infos, dones=output.done)
-                rollouts.insert(
-                    obs=output.obs,
-                    recurrent_hidden_states=output.act.rnn_hxs,
-                    actions=output.act.action,
-                    action_log_probs=output.act.action_log_probs,
-                    values=output.act.value,
-                    rewards=output.reward,
-                    masks=output.masks,
+            if inference_server:
+                time_per["fragment"].tick()
+                lags = train_envs.collect(rollouts, train_report, train_infos)
+                frames.update(
+                    since_save=frames_per_update,
+                    since_log=frames_per_update,
+                    since_eval=frames_per_update,
                 )
+                time_per["fragment"].update()
+            elif step_deadline is not None:
+                time_per["fragment"].tick()
+                with PROFILER.span("collect"):
+                    collected = cls.collect_async(
+                        rollouts=rollouts,
+                        envs=train_envs,
+                        agent=actor,
+                        deadline=step_deadline,
+                        episodes=train_report,
+                        infos=train_infos,
+                        in_flight=in_flight,
+                        carried_hxs=carried_hxs,
+                    )
+                # Rows cut off at the deadline were not collected. Every rank counts
+                # the frames of all of them, so that they agree on when to log,
+                # save, evaluate and stop.
+                collected_frames = collected
+                if num_learners > 1:
+                    total = torch.tensor(collected)
+                    dist.all_reduce(total)
+                    collected_frames = int(total)
+                frames["so_far"] -= frames_per_update - collected_frames
                 frames.update(
-                    since_save=num_processes,
-                    since_log=num_processes,
-                    since_eval=num_processes,
+                    since_save=collected_frames,
+                    since_log=collected_frames,
+                    since_eval=collected_frames,
                 )
-                time_per["frame"].update()
+                time_per["frame"].update(n=collected / num_processes)
+                time_per["fragment"].update()
+            else:
+                for output in PROFILER.iterate(
+                    "collect",
+                    cls.run_epoch(
+                        obs=rollouts.obs[0],
+                        rnn_hxs=rollouts.recurrent_hidden_states[0],
+                        masks=rollouts.masks[0],
+                        envs=train_envs,
+                        num_steps=train_steps,
+                        agent=actor,
+                    ),
+                ):
+                    with PROFILER.span("aggregate"):
+                        train_report.update(
+                            reward=output.reward.cpu().numpy(),
+                            dones=output.done,
+                        )
+                        train_infos.update(output.infos, dones=output.done)
+                    with PROFILER.span("insert"):
+                        rollouts.insert(
+                            obs=output.obs,
+                            recurrent_hidden_states=output.act.rnn_hxs,
+                            actions=output.act.action,
+                            action_log_probs=output.act.action_log_probs,
+                            values=output.act.value,
+                            rewards=output.reward,
+                            masks=output.masks,
+                        )
+                    if recorder is not None:
+                        with PROFILER.span("record"):
+                            recorder.step(
+                                output.act, output.obs, output.done, output.infos
+                            )
+                    frames.update(
+                        since_save=frames_per_step,
+                        since_log=frames_per_step,
+                        since_eval=frames_per_step,
+                    )
+                    time_per["frame"].update()
 
             curriculum.send((train_envs, train_infos))
 
             with torch.no_grad():
-                next_value = agent.get_value(
+                next_value = actor.get_value(
                     rollouts.obs[-1],
                     rollouts.recurrent_hidden_states[-1],
                     rollouts.masks[-1],
                 )
 
             rollouts.compute_returns(next_value.detach())
-            train_results = ppo.update(rollouts)
-            rollouts.after_update()
+            if inference_server:
+                policy_lag = max(lags)
+                train_results = ppo.update(rollouts, policy_lag=policy_lag)
+                train_results.update({"policy lag": np.mean(lags)})
+                train_envs.sync(agent)
+            elif not async_update:
+                with PROFILER.span("update"):
+                    train_results = ppo.update(rollouts, proximal=quantize_actor)
+                if quantize_actor:
+                    with PROFILER.span("quantize"):
+                        actor = quantized(agent)
+                rollouts.after_update()
+            else:
+                if update_future is not None:
+                    train_results = dict(
+                        update_future.result(), **{"policy lag": policy_lag}
+                    )
+                    learner_version += 1
+                    if quantize_actor:
+                        actor = quantized(agent)
+                    else:
+                        actor.load_state_dict(agent.state_dict())
+                prev_version, actor_version = actor_version, learner_version
+
+                # hand off the last observation to the buffer that was just updated
+                prev_rollouts.obs[0].copy_(rollouts.obs[-1])
+                prev_rollouts.recurrent_hidden_states[0].copy_(
+                    rollouts.recurrent_hidden_states[-1]
+                )
+                prev_rollouts.masks[0].copy_(rollouts.masks[-1])
+                rollouts, prev_rollouts = prev_rollouts, rollouts
             time_per["update"].update()
 
     @staticmethod
-    def save_checkpoint(save_path: Path, ppo: PPO, agent: Agent, step: int):
+    def collect_async(
+        rollouts: RolloutStorage,
+        envs: VecPyTorch,
+        agent: Agent,
+        deadline: float,
+        episodes: EpisodeAggregator,
+        infos: InfosAggregator,
+        in_flight: torch.Tensor,
+        carried_hxs: torch.Tensor,
+    ) -> int:
+        """
+        Fills `rollouts` with a cursor per env instead of in lockstep. Workers that
+        return within `deadline` seconds of the first are acted on and stepped again
+        while the stragglers finish. The iteration closes `deadline` seconds after the
+        first env has `rollouts.num_steps` steps: the rows that slower envs have not
+        filled are marked invalid in `rollouts.valid`, and an env whose step is still
+        running (`in_flight`, with its hidden state after that step's action in
+        `carried_hxs`) continues into row 0 of the next call. Returns the number of
+        rows filled.
+        """
+        num_steps, num_envs = rollouts.rewards.shape[:2]
+        cursor = -in_flight.long()  # an env carried over lands in row 0
+        idle = ~in_flight
+        closes = None
+        while True:
+            filled = cursor >= num_steps
+            if closes is None and filled.any():
+                closes = time.time() + deadline
+            if filled.all() or (closes is not None and time.time() >= closes):
+                break
+            index = (idle & ~filled).nonzero().squeeze(1)
+            if len(index):
+                t = cursor[index]
+                with PROFILER.span("act"), torch.no_grad():
+                    act = agent(
+                        inputs=rollouts.obs[t, index],
+                        rnn_hxs=rollouts.recurrent_hidden_states[t, index],
+                        masks=rollouts.masks[t, index],
+                    )  # type: AgentOutputs
+                rollouts.actions[t, index] = act.action
+                rollouts.action_log_probs[t, index] = act.action_log_probs
+                rollouts.value_preds[t, index] = act.value
+                rollouts.recurrent_hidden_states[t + 1, index] = act.rnn_hxs
+                actions = act.action.new_zeros((num_envs, *act.action.shape[1:]))
+                actions[index] = act.action
+                workers = torch.unique(index // envs.envs_per_worker).tolist()
+                with PROFILER.span("step_async"):
+                    envs.step_async_workers(envs.preprocess(actions), workers)
+                idle[index] = False
+
+            limit = None if closes is None else max(closes - time.time(), 0)
+            timeout = deadline if limit is None else min(deadline, limit)
+            with PROFILER.span("step_wait"):
+                obs, reward, done, step_infos, stepped = envs.step_wait_any(
+                    timeout, limit
+                )
+            with PROFILER.span("aggregate"):
+                episodes.update(reward=reward.numpy(), dones=done, mask=stepped)
+                infos.update(step_infos, dones=done, mask=stepped)
+            with PROFILER.span("insert"):
+                index = torch.from_numpy(stepped).nonzero().squeeze(1)
+                t = cursor[index] + 1
+                rollouts.obs[t, index] = obs[index]
+                rollouts.masks[t, index] = torch.tensor(
+                    1 - done[stepped], dtype=torch.float32, device=obs.device
+                ).unsqueeze(1)
+                carried = index[t == 0]
+                rollouts.recurrent_hidden_states[0, carried] = carried_hxs[carried]
+                later = t > 0
+                reward = reward[index[later]].unsqueeze(1)
+                rollouts.rewards[t[later] - 1, index[later]] = reward.to(obs.device)
+                cursor[index] = t
+                idle[index] = True
+
+        with PROFILER.span("close"):
+            # The update bootstraps from, and the next call starts at, the last
+            # observation of each env that did not fill its rows.
+            unfilled = (cursor < num_steps).nonzero().squeeze(1)
+            last = cursor[unfilled].clamp(min=0)
+            stepping = unfilled[~idle[unfilled] & (cursor[unfilled] >= 0)]
+            carried_hxs[stepping] = rollouts.recurrent_hidden_states[
+                cursor[stepping] + 1, stepping
+            ]
+            for tensor in (rollouts.obs, rollouts.recurrent_hidden_states):
+                tensor[-1, unfilled] = tensor[last, unfilled]
+            rollouts.masks[-1, unfilled] = rollouts.masks[last, unfilled]
+            in_flight.copy_(~idle)
+            steps = torch.arange(num_steps).unsqueeze(1)
+            rollouts.valid.copy_((steps < cursor).float().unsqueeze(-1))
+        return int(cursor.clamp(min=0).sum())
+
+    @staticmethod
+    def run_epoch(obs, rnn_hxs, masks, envs, num_steps, agent):
+        for _ in range(num_steps):
+            with PROFILER.span("act"), torch.no_grad():
+                act = agent(
+                    inputs=obs, rnn_hxs=rnn_hxs, masks=masks
+                )  # type: AgentOutputs
+
+            action = envs.preprocess(act.action)
+            # Observe reward and next obs
+            with PROFILER.span("step_async"):
+                envs.step_async(action)
+            with PROFILER.span("step_wait"):
+                obs, reward, done, infos = envs.step_wait()
+
+            # If done then clean the history of observations.
+            masks = torch.tensor(
+                1 - done, dtype=torch.float32, device=obs.device
+            ).unsqueeze(1)
+            yield EpochOutputs(
+                obs=obs, reward=reward, done=done, infos=infos, act=act, masks=masks
+            )
+
+            rnn_hxs = act.rnn_hxs
+
+    @classmethod
+    def save_checkpoint(
+        cls,
+        checkpoints: CheckpointWriter,
+        step: int,
+        ppo: PPO,
+        agent: Agent,
+        failure_buffer: Optional[Queue],
+        **state,
+    ):
         modules = dict(
             optimizer=ppo.optimizer, agent=agent
         )  # type: Dict[str, torch.nn.Module]
-        state_dict = {name: module.state_dict() for name, module in modules.items()}
-        torch.save(dict(step=step, **state_dict), save_path)
-        print(f"Saved parameters to {save_path}")
+        state.update({name: module.state_dict() for name, module in modules.items()})
+        state.update(
+            rng=dict(
+                torch=torch.get_rng_state(),
+                cuda=torch.cuda.get_rng_state_all()
+                if torch.cuda.is_available()
+                else [],
+                numpy=np.random.get_state(),
+                random=random.getstate(),
+            )
+        )
+        # the env workers share the failure buffer, so it is drained and refilled on
+        # this thread rather than the writer's
+        state.update(failure_buffer=cls.failure_buffer_items(failure_buffer))
+        checkpoints.save(step, state)
 
     @classmethod
     def structure_config(cls, cfg: DictConfig) -> Dict[str, any]:
@@ -427,21 +1045,14 @@ class Trainer:
         if cfg.render:
             cfg.num_processes = 1
 
-        def parameters(*ms):
-            for method in ms:
-                yield from inspect.signature(method).parameters
-
-        args_to_methods = cls.args_to_methods()
-        args = {k: {} for k in args_to_methods}
+        arg_groups = cls.arg_groups()
+        args = {k: {} for k in cls.args_to_methods()}
         for k, v in cfg.items():
             if k in ("_wandb", "wandb_version", "eval_perform"):
                 continue
-            assigned = False
-            for arg_name, methods in args_to_methods.items():
-                if k in parameters(*methods):
-                    args[arg_name][k] = v
-                    assigned = True
-            assert assigned, k
+            assert k in arg_groups, k
+            for arg_name in arg_groups[k]:
+                args[arg_name][k] = v
         run_args = args.pop("run_args")
         args.update(**run_args)
         return args
@@ -16,6 +16,8 @@ import torch.nn as nn
 from gym import spaces
 import gym
 
+from env_utils import RESET, Discrete
+
 
 def round(x, dec):
     return torch.round(x * 10 ** dec) / 10 ** dec
@@ -132,9 +134,6 @@ def trace(module_fn, in_size):
     return torch.jit.trace(module_fn(in_size), example_inputs=torch.rand(1, in_size))
 
 
-RESET = "\033[0m"
-
-
 def k_scalar_pairs(*args, **kwargs):
     for k, v in dict(*args, **kwargs).items():
         mean = np.mean(v)
@@ -225,29 +224,6 @@ def asdict(obj):
     return obj
 
 
-class Discrete(spaces.Discrete):
-    def __init__(self, low: int, high: int):
-        self.low = low
-        self.high = high
-        super().__init__(1 + high - low)
-
-    def sample(self) -> int:
-        return self.low + super().sample()
-
-    def contains(self, x) -> bool:
-        return super().contains(x - self.low)
-
-    def __repr__(self) -> str:
-        return f"Discrete({self.low}, {self.high})"
-
-    def __eq__(self, other) -> bool:
-        return (
-            isinstance(other, Discrete)
-            and self.low == other.low
-            and self.high == other.high
-        )
-
-
 def get_max_shape(*xs) -> np.ndarray:
     def compare_shape(max_so_far: Optional[np.ndarray], opener: np.ndarray):
         new = np.array(opener.shape)
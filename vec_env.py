@@ -0,0 +1,450 @@
+import atexit
+import math
+import multiprocessing
+import os
+import time
+from collections import defaultdict
+from multiprocessing.connection import wait
+from multiprocessing.reduction import ForkingPickler
+from multiprocessing.shared_memory import SharedMemory
+from typing import Callable, Dict, Generator, List, Optional, Sequence, Tuple
+
+import gym
+import numpy as np
+
+from stable_baselines3.common.vec_env import VecEnv
+
+from env_worker import (
+    EnvSpec,
+    InfoBatch,
+    InfoSchema,
+    Inherited,
+    obs_size,
+    views,
+    work,
+)
+from profiler import PROFILER
+
+# upper edges of the step time histogram bins, from 10 µs to 10 s
+STEP_TIME_BINS = np.logspace(-5, 1, 31)
+
+
+class SharedMemoryVecEnv(VecEnv):
+    """
+    Like `SubprocVecEnv`, but workers write observations, rewards, dones and infos
+    into shared arrays, so only actions and a short acknowledgement cross the pipes.
+    Envs that declare `info_keys()` have their infos encoded with an `InfoSchema` and
+    `step_wait` returns an `InfoBatch` instead of a list of dicts.
+
+    Each worker hosts `envs_per_worker` envs (by default, enough to spread the envs
+    evenly over the cores) and steps them in one loop. Worker `w` is pinned to
+    `worker_cores[w]`, if given (see `planner.plan`).
+
+    `step_async_workers` and `step_wait_any` step workers independently: callers act
+    on whichever workers have returned instead of waiting for the slowest one. Each
+    worker's step times are binned into a histogram (see `step_time_items`).
+
+    With `start_method` "spawn" or "forkserver", `env_fns` must be picklable (see
+    `env_worker.EnvSpec`) and workers load only `env_worker` and the env modules
+    instead of inheriting the trainer's memory. Such workers can also be given new
+    envs with `reconfigure`, and a vec env acquired from a `WorkerPool` hands its
+    workers back to the pool when closed.
+    """
+
+    def __init__(
+        self,
+        env_fns: List[Callable[[], gym.Env]],
+        start_method: str = "fork",
+        envs_per_worker: Optional[int] = None,
+        pool: Optional["WorkerPool"] = None,
+        worker_cores: Optional[List[List[int]]] = None,
+    ):
+        # the first env is only built here to read its spaces; the rest are built
+        # concurrently in their workers
+        env = env_fns[0]()
+        if start_method == "fork":
+            env_fns = [lambda: env, *env_fns[1:]]  # the first worker inherits it
+        else:
+            env.close()
+
+        num_envs = len(env_fns)
+        context = multiprocessing.get_context(start_method)
+        if start_method == "forkserver":
+            modules = {
+                f.entry_point.split(":")[0] for f in env_fns if isinstance(f, EnvSpec)
+            }
+            context.set_forkserver_preload(["env_worker", *modules])
+        super().__init__(num_envs, env.observation_space, env.action_space)
+        layout = self.allocate(env)
+
+        self.closed = False
+        self.pool = pool
+        self.key = WorkerPool.key(num_envs, start_method, envs_per_worker, worker_cores)
+        self.worker_cores = worker_cores
+        if envs_per_worker is None:
+            try:
+                num_cores = len(os.sched_getaffinity(0))  # e.g. pinned by local_sweep
+            except AttributeError:
+                num_cores = os.cpu_count() or 1
+            envs_per_worker = math.ceil(num_envs / num_cores)
+        self.envs_per_worker = envs_per_worker
+        self.starts = range(0, num_envs, envs_per_worker)
+        self.pending = set()  # workers that have not answered their last step
+        self.step_time_counts = np.zeros(
+            (len(self.starts), len(STEP_TIME_BINS) + 1), dtype=np.int64
+        )
+        self.env_fns = env_fns
+        self.remotes, work_remotes = zip(*[context.Pipe() for _ in self.starts])
+        self.processes = []
+        self.started = time.time()
+        for start, work_remote, remote in zip(self.starts, work_remotes, self.remotes):
+            process = context.Process(
+                target=work,
+                kwargs=dict(
+                    remote=work_remote,
+                    parent_remote=remote,
+                    layout=layout,
+                    **self.worker_config(env_fns, start),
+                ),
+                daemon=True,
+            )
+            process.start()
+            self.processes.append(process)
+            work_remote.close()
+
+    def allocate(self, env: gym.Env) -> Dict[str, Tuple[str, int]]:
+        # shared memory for `env`'s observations and infos, by name so that running
+        # workers can attach to it
+        info_keys = env.info_keys() if hasattr(env, "info_keys") else None
+        self.schema = None if info_keys is None else InfoSchema(info_keys)
+        num_info_keys = 0 if info_keys is None else len(info_keys)
+        n = self.num_envs
+        sizes = dict(
+            obs=n * obs_size(env.observation_space) * 4,
+            rewards=n * 4,
+            dones=n,
+            infos=n * num_info_keys * 4,
+            stats=n * 3 * 8,
+            step_times=n * 8,
+        )
+        segments = {
+            k: SharedMemory(create=True, size=max(size, 1)) for k, size in sizes.items()
+        }
+        self.segments = list(segments.values())
+        self.buffers = views(
+            {k: segments[k].buf[:size] for k, size in sizes.items()}, n
+        )
+        self.buffers["infos"][:] = np.nan
+        return {k: (segments[k].name, size) for k, size in sizes.items()}
+
+    def close(self):
+        if self.closed:
+            return
+        self.receive(sorted(self.pending))
+        self.closed = True
+        if self.pool is None:
+            self.shutdown()
+        else:
+            self.pool.release(self)
+
+    @staticmethod
+    def free(segments: List[SharedMemory]):
+        for segment in segments:
+            try:
+                segment.close()
+            except BufferError:
+                pass  # still viewed; unmapped once the views are gone
+            segment.unlink()
+
+    def reconfigure(self, env_fns: List[EnvSpec]):
+        """
+        Replaces the envs with `env_fns`, the same number of `EnvSpec`s, without
+        restarting the workers. Kwargs that are the same objects as before are not
+        sent again, so that queues passed when the workers started carry over. Raises
+        `RuntimeError` (before touching the workers) if another kwarg cannot be sent
+        to a running process.
+        """
+        assert len(env_fns) == self.num_envs, (len(env_fns), self.num_envs)
+        assert all(isinstance(f, EnvSpec) for f in [*self.env_fns, *env_fns])
+
+        def diff(spec: EnvSpec, previous: EnvSpec) -> EnvSpec:
+            kwargs = {
+                k: Inherited()
+                if k in previous.kwargs and v is previous.kwargs[k]
+                else v
+                for k, v in spec.kwargs.items()
+            }
+            return spec._replace(kwargs=kwargs)
+
+        specs = [diff(spec, prev) for spec, prev in zip(env_fns, self.env_fns)]
+        ForkingPickler.dumps(specs)  # fail here rather than halfway through
+        env = env_fns[0]()
+        env.close()
+        self.receive(sorted(self.pending))
+        segments = self.segments
+        self.observation_space = env.observation_space
+        self.action_space = env.action_space
+        layout = self.allocate(env)
+        self.env_fns = env_fns
+        self.started = time.time()
+        for start, remote in zip(self.starts, self.remotes):
+            config = dict(layout=layout, **self.worker_config(specs, start))
+            remote.send(("configure", config))
+        # workers detach from the old segments before they build their new envs
+        self.free(segments)
+        self.step_time_counts[:] = 0
+        self.closed = False
+
+    def shutdown(self):
+        for remote in self.remotes:
+            remote.send(("close", None))
+        for process in self.processes:
+            process.join()
+        self.free(self.segments)
+        self.segments = []
+
+    def worker_config(self, env_fns: list, start: int) -> dict:
+        return dict(
+            env_fns=env_fns[start : start + self.envs_per_worker],
+            start=start,
+            num_envs=self.num_envs,
+            schema=self.schema,
+            cores=None
+            if self.worker_cores is None
+            else self.worker_cores[start // self.envs_per_worker],
+            profiler=PROFILER.settings(),
+        )
+
+    def env_is_wrapped(self, wrapper_class, indices=None) -> List[bool]:
+        return [False for _ in self.get_indices(indices)]
+
+    def dispatch(self, cmd: str, data: tuple, indices) -> list:
+        # send `cmd` to the workers hosting `indices`, each with its local indices
+        indices = self.get_indices(indices)
+        local = defaultdict(list)
+        for i in indices:
+            local[i // self.envs_per_worker].append(i % self.envs_per_worker)
+        for worker, js in local.items():
+            self.remotes[worker].send((cmd, (*data, js)))
+        results = {}
+        for worker, js in local.items():
+            for j, result in zip(js, self.remotes[worker].recv()):
+                results[worker * self.envs_per_worker + j] = result
+        return [results[i] for i in indices]
+
+    def env_method(self, method_name, *method_args, indices=None, **method_kwargs):
+        return self.dispatch(
+            "env_method", (method_name, method_args, method_kwargs), indices
+        )
+
+    def get_attr(self, attr_name, indices=None):
+        return self.dispatch("get_attr", (attr_name,), indices)
+
+    def get_indices(self, indices) -> List[int]:
+        if indices is None:
+            return list(range(self.num_envs))
+        if isinstance(indices, int):
+            return [indices]
+        return list(indices)
+
+    def receive(self, workers: Sequence[int]) -> List[dict]:
+        # collect step replies, in order, and bin the time each worker took
+        info_dicts = []
+        for worker in workers:
+            info_dicts.extend(self.remotes[worker].recv() or ())
+            self.pending.discard(worker)
+            start = self.starts[worker]
+            step_time = self.buffers["step_times"][
+                start : start + self.envs_per_worker
+            ].sum()
+            b = np.searchsorted(STEP_TIME_BINS, step_time)
+            self.step_time_counts[worker, b] += 1
+        return info_dicts
+
+    def profile_totals(self) -> Dict[str, float]:
+        """
+        Span totals (see `profiler.Profiler`) of every worker since the last call,
+        summed over the workers.
+        """
+        if not PROFILER.enabled:
+            return {}
+        # workers that are still stepping report next time
+        remotes = [r for w, r in enumerate(self.remotes) if w not in self.pending]
+        for remote in remotes:
+            remote.send(("profile", None))
+        totals = defaultdict(float)
+        for remote in remotes:
+            for k, v in remote.recv().items():
+                totals[k] += v
+        return dict(totals)
+
+    def reset(self):
+        self.receive(sorted(self.pending))  # discard steps that are still running
+        for remote in self.remotes:
+            remote.send(("reset", None))
+        for remote in self.remotes:
+            remote.recv()
+        return self.buffers["obs"].copy()
+
+    def seed(self, seed=None):
+        for start, remote in zip(self.starts, self.remotes):
+            remote.send(("seed", None if seed is None else seed + start))
+        return [x for remote in self.remotes for x in remote.recv()]
+
+    def set_attr(self, attr_name, value, indices=None):
+        self.dispatch("set_attr", (attr_name, value), indices)
+
+    def step_async(self, actions: np.ndarray):
+        self.step_async_workers(actions, range(len(self.remotes)))
+
+    def step_async_workers(self, actions: np.ndarray, workers: Sequence[int]):
+        """
+        Steps only `workers`, with their rows of `actions` (which has a row per env).
+        """
+        for worker in workers:
+            assert worker not in self.pending, worker
+            start = self.starts[worker]
+            action = actions[start : start + self.envs_per_worker]
+            self.remotes[worker].send(("step", action))
+            self.pending.add(worker)
+
+    def step_wait(self):
+        info_dicts = self.receive(sorted(self.pending))
+        return (
+            self.buffers["obs"].copy(),
+            self.buffers["rewards"].copy(),
+            self.buffers["dones"].astype(bool),
+            self.infos(info_dicts),
+        )
+
+    def step_wait_any(
+        self, timeout: float, limit: Optional[float] = None
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray, object, np.ndarray]:
+        """
+        Waits for at least one pending worker (or at most `limit` seconds, if given),
+        then at most `timeout` seconds more for the others. Returns obs, rewards, dones
+        and infos for every env, along with a mask of the envs that stepped; rows of
+        the other envs are not meaningful.
+        """
+        remotes = {self.remotes[w]: w for w in self.pending}
+        ready = wait(list(remotes), limit)
+        deadline = time.time() + timeout
+        while len(ready) < len(remotes):
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            more = wait([r for r in remotes if r not in ready], remaining)
+            if not more:
+                break
+            ready.extend(more)
+        workers = sorted(remotes[r] for r in ready)
+        info_dicts = iter(self.receive(workers))
+        stepped = np.zeros(self.num_envs, dtype=bool)
+        for worker in workers:
+            start = self.starts[worker]
+            stepped[start : start + self.envs_per_worker] = True
+        if self.schema is None:
+            info_dicts = [next(info_dicts) if s else {} for s in stepped]
+        return (
+            self.buffers["obs"].copy(),
+            np.where(stepped, self.buffers["rewards"], 0),
+            self.buffers["dones"].astype(bool) & stepped,
+            self.infos(info_dicts),
+            stepped,
+        )
+
+    def infos(self, info_dicts: List[dict]):
+        if self.schema is None:
+            return info_dicts
+        return InfoBatch(keys=self.schema.keys, values=self.buffers["infos"].copy())
+
+    def step_time_items(self) -> Generator[Tuple[str, float], None, None]:
+        """
+        Median, 90th and 99th percentile step time of each worker since the last
+        call, read off its histogram (the upper edge of the bin).
+        """
+        for worker, counts in enumerate(self.step_time_counts):
+            total = counts.sum()
+            if not total:
+                continue
+            cdf = np.cumsum(counts) / total
+            for q in (50, 90, 99):
+                b = min(np.searchsorted(cdf, q / 100), len(STEP_TIME_BINS) - 1)
+                yield f"worker {worker} step time p{q}", float(STEP_TIME_BINS[b])
+        self.step_time_counts[:] = 0
+
+    def worker_stats(self) -> Dict[str, float]:
+        """
+        Start time (until the env was built) and memory of the workers, averaged.
+        Valid once every worker has answered, e.g. after `reset`.
+        """
+        ready, rss, private = self.buffers["stats"].T
+        return {
+            "worker start time": float(np.mean(ready - self.started)),
+            "worker RSS (MB)": float(np.mean(rss)),
+            "worker private memory (MB)": float(np.mean(private)),
+        }
+
+
+class WorkerPool:
+    """
+    Keeps the workers of closed vec envs running. `acquire` reconfigures idle
+    workers with the same number of envs, start method and envs per worker instead
+    of starting new processes, so each eval phase reuses the last one's workers and
+    consecutive runs in one process reuse all of them. The pool lives as long as its
+    process: runs started as separate processes (as `local_sweep` starts them) do not
+    share workers.
+    """
+
+    def __init__(self):
+        self.idle = defaultdict(list)  # type: Dict[tuple, List[SharedMemoryVecEnv]]
+        atexit.register(self.close)
+
+    def acquire(
+        self,
+        env_fns: List[EnvSpec],
+        start_method: str,
+        envs_per_worker: Optional[int] = None,
+        worker_cores: Optional[List[List[int]]] = None,
+    ) -> SharedMemoryVecEnv:
+        assert start_method != "fork", "Pooled workers need picklable env specs."
+        idle = self.idle[
+            self.key(len(env_fns), start_method, envs_per_worker, worker_cores)
+        ]
+        while idle:
+            venv = idle.pop()
+            try:
+                venv.reconfigure(env_fns)
+                return venv
+            except RuntimeError as e:
+                print(f"Starting new workers because {e}")
+                venv.shutdown()
+        return SharedMemoryVecEnv(
+            env_fns,
+            start_method=start_method,
+            envs_per_worker=envs_per_worker,
+            pool=self,
+            worker_cores=worker_cores,
+        )
+
+    @staticmethod
+    def key(
+        num_envs: int,
+        start_method: str,
+        envs_per_worker: Optional[int],
+        worker_cores: Optional[List[List[int]]],
+    ) -> tuple:
+        cores = None if worker_cores is None else tuple(map(tuple, worker_cores))
+        return num_envs, start_method, envs_per_worker, cores
+
+    def close(self):
+        for venvs in self.idle.values():
+            for venv in venvs:
+                venv.shutdown()
+        self.idle.clear()
+
+    def release(self, venv: SharedMemoryVecEnv):
+        self.idle[venv.key].append(venv)
+
+
+POOL = WorkerPool()
@@ -1,3 +1,5 @@
+from typing import Optional
+
 import gym
 import numpy as np
 import torch
@@ -94,6 +96,15 @@ class VecPyTorch(VecEnvWrapper):
         reward = torch.from_numpy(reward).float()
         return obs, reward, done, info
 
+    def step_async_workers(self, actions: torch.Tensor, workers):
+        self.venv.step_async_workers(actions.cpu().numpy(), workers)
+
+    def step_wait_any(self, timeout: float, limit: Optional[float] = None):
+        obs, reward, done, info, stepped = self.venv.step_wait_any(timeout, limit)
+        obs = torch.from_numpy(self.extract_numpy(obs)).float().to(self.device)
+        reward = torch.from_numpy(reward).float()
+        return obs, reward, done, info, stepped
+
     def to(self, device):
         self.device = device
         if self.action_bounds is not None: